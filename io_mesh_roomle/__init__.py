@@ -16,8 +16,6 @@
 import logging
 from pathlib import Path
 from re import DEBUG
-from .scene_handler import SceneHandler
-from .material_exporter import export_materials
 
 bl_info = {
     "name": "Roomle Configurator Script",
@@ -32,15 +30,23 @@ bl_info = {
     "warning": "Beta version",
 }
 
+import os,sys,subprocess,time
+from functools import lru_cache
+
+# only the operator modules are imported when the addon is registered, the export
+# machinery (script, materials, numpy) is imported by the first export
 if "bpy" in locals():
     import importlib
-    importlib.reload(roomle_script)
     importlib.reload(optimize_operator)
+    importlib.reload(preflight_operator)
+    importlib.reload(watch)
+    if __name__ + '.roomle_script' in sys.modules:
+        importlib.reload(sys.modules[__name__ + '.roomle_script'])
 else:
-    from . import roomle_script
     from . import optimize_operator
+    from . import preflight_operator
+    from . import watch
 
-import os,sys,subprocess
 import bpy
 
 from bpy.props import (
@@ -61,7 +67,8 @@ from bpy.types import (
     )
 
 
-# find path for executable
+# find path for executable, searched once per session on first use
+@lru_cache(maxsize=None)
 def check_for_exe( name ):
     #check for executable path with where/whereis
     exe_path = None
@@ -101,13 +108,18 @@ class ExportRoomleScriptPreferences(bpy.types.AddonPreferences):
    corto_exe: bpy.props.StringProperty(
       name="Location of corto executable",
       subtype="FILE_PATH",
-      default=check_for_exe('corto')
+      default=''
    )
 
+   @property
+   def corto_path(self):
+      """the configured corto executable, or the one found on the path"""
+      return self.corto_exe or check_for_exe('corto')
+
    def draw(self, context):
       layout = self.layout
       layout.prop(self, 'corto_exe')
-      layout.label(text="Pluging will try to auto-find corto, if no path found, or you would like to use a different path, set it here.")
+      layout.label(text="Pluging will try to auto-find corto when exporting, if no path found, or you would like to use a different path, set it here.")
 
 class ExportRoomleScript( Operator, ExportHelper ):
     """Save a Roomle Script from the active object"""
@@ -141,12 +153,85 @@ class ExportRoomleScript( Operator, ExportHelper ):
         default=False,
         )
 
+    deduplicate_materials: BoolProperty(
+        name="Merge Identical Materials",
+        description="Export materials with identical settings and texture content (e.g. Wood, Wood.001) once and refer to this one in the script",
+        default=True,
+        )
+
+    texture_atlas: BoolProperty(
+        name="Texture Atlas",
+        description="Pack small, non-tiling diffuse textures into shared atlas images and move the UVs of their faces into the atlas regions",
+        default=False,
+        )
+
+    atlas_max_texture_size: IntProperty(
+        name="Max Atlas Texture Size",
+        description="Textures up to this width and height (pixels) are packed into atlases",
+        default=256,
+        min=16,
+        max=1024,
+    )
+
+    texture_formats = [
+        ("ORIGINAL", "Original", "Export textures in their own file format", 1),
+        ("WEBP", "WebP", "Lossy WebP for color and ORM maps, near-lossless WebP for normal maps", 2),
+        ("JPEG", "JPEG", "JPEG for color and ORM maps, PNG for normal maps and textures with alpha", 3),
+    ]
+
+    texture_format: EnumProperty(
+        items=texture_formats,
+        name="Texture Format",
+        description="Re-encode exported textures with the lowest quality that reaches the quality target",
+        default="ORIGINAL",
+        )
+
+    texture_metrics = [
+        ("SSIM", "SSIM", "Structural similarity, 1 is identical", 1),
+        ("PSNR", "PSNR", "Peak signal to noise ratio in dB", 2),
+    ]
+
+    texture_metric: EnumProperty(
+        items=texture_metrics,
+        name="Quality Metric",
+        description="How re-encoded textures are compared with the original pixels",
+        default="SSIM",
+        )
+
+    texture_target_ssim: FloatProperty(
+        name="Target SSIM",
+        description="Lowest structural similarity of a re-encoded texture",
+        default=0.98,
+        min=0.5,
+        max=1.0,
+    )
+
+    texture_target_psnr: FloatProperty(
+        name="Target PSNR (dB)",
+        description="Lowest peak signal to noise ratio of a re-encoded texture",
+        default=40.0,
+        min=20.0,
+        max=60.0,
+    )
+
+    materials_upsert: BoolProperty(
+        name="Update Existing Materials CSV",
+        description="Merge the materials into an existing materials/materials.csv instead of overwriting it. Textures of unchanged materials are not written again",
+        default=False,
+        )
+
     apply_rotations: BoolProperty(
         name="Apply Rotations",
         description="Apply all rotations into vertex data",
         default=True,
         )
 
+    bake_transforms: BoolProperty(
+        name="Bake Static Transforms",
+        description="Bake the whole world transform, non-uniform scale included, into the meshes. Only objects with the custom property 'roomle_dynamic' keep transform commands, relative to their nearest dynamic parent",
+        default=False,
+        )
+
     advanced: BoolProperty(
             name="Advanced Settings",
             description="Show advanced settings",
@@ -173,6 +258,20 @@ class ExportRoomleScript( Operator, ExportHelper ):
         default="AUTO",
         )
 
+    auto_request_overhead: FloatProperty(
+        name="External Request Cost",
+        description="Cost of loading an external mesh file (additional request), in script bytes. Used by the automatic mesh export method",
+        default=6000.0,
+        min=0.0,
+    )
+
+    auto_external_weight: FloatProperty(
+        name="External Byte Weight",
+        description="Cost of one byte of external mesh file relative to one byte of script. Used by the automatic mesh export method",
+        default=1.0,
+        min=0.0,
+    )
+
     uv_float_precision: IntProperty(
         name="UV Precision",
         description="Max floating point fraction precision of UVs in decimal digits when creating script commands",
@@ -189,6 +288,125 @@ class ExportRoomleScript( Operator, ExportHelper ):
         max=8
     )
             
+    precision_modes = [
+        ("FIXED", "Fixed", "Positions and translations with 0.1mm precision", 1),
+        ("RELATIVE", "Relative", "Coarsest precision within a tolerance relative to the object's size", 2),
+        ("ABSOLUTE", "Absolute", "Coarsest precision within a tolerance in mm", 3),
+    ]
+
+    precision_mode: EnumProperty(
+        items=precision_modes,
+        name="Position Precision",
+        description="How many decimal digits are written for vertex positions and translations",
+        default="FIXED",
+        )
+
+    precision_relative: FloatProperty(
+        name="Relative Tolerance",
+        description="Max positional error in percent of the object's size (bounding box diagonal)",
+        default=0.05,
+        min=0.0,
+        max=10.0,
+        subtype='PERCENTAGE',
+    )
+
+    precision_tolerance: FloatProperty(
+        name="Tolerance (mm)",
+        description="Max positional error in mm",
+        default=0.1,
+        min=0.0,
+    )
+
+    elide_normals: BoolProperty(
+        name="Omit Matching Normals",
+        description="Leave out the normals of inline meshes when the smooth normals calculated at run-time match them within the normal tolerance",
+        default=True,
+        )
+
+    normal_tolerance: FloatProperty(
+        name="Normal Tolerance",
+        description="Max angle in degrees between exported and run-time calculated normals for leaving the normals out",
+        default=1.0,
+        min=0.0,
+        max=45.0,
+    )
+
+    package_zip: BoolProperty(
+        name="Export as Zip Archive",
+        description="Write script, external meshes and materials into one zip archive next to the script path instead of separate files",
+        default=False,
+        )
+
+    out_of_core: BoolProperty(
+        name="Out-of-Core Meshes",
+        description="Export huge inline meshes chunk by chunk through temporary files, so memory use does not grow with the mesh size",
+        default=False,
+        )
+
+    out_of_core_threshold: IntProperty(
+        name="Out-of-Core Triangles",
+        description="Inline meshes with at least this many triangles are exported out-of-core",
+        default=1000000,
+        min=1000,
+    )
+
+    parallel_encoding: BoolProperty(
+        name="Parallel Mesh Encoding",
+        description="Format inline meshes in worker processes on all cores, Blender only reads the mesh data",
+        default=False,
+        )
+
+    encoder_workers: IntProperty(
+        name="Worker Processes",
+        description="Number of worker processes, 0 uses all cores but one",
+        default=0,
+        min=0,
+        max=64,
+    )
+
+    optimize_script: BoolProperty(
+        name="Optimize Script Size",
+        description="Drop comments, shorten group names, remove empty groups and merge the transform commands of every object. Has no effect in debug mode",
+        default=False,
+        )
+
+    optimize_tolerance: FloatProperty(
+        name="Transform Tolerance (mm)",
+        description="Max distance any point may move when transform commands are merged",
+        default=0.01,
+        min=0.0,
+    )
+
+    flatten_hierarchy: BoolProperty(
+        name="Flatten Hierarchy",
+        description="Dissolve groups with a single child and groups that only hold groups, their transforms are composed into the children. Groups of objects with the custom property 'roomle_keep_group' or 'roomle_dynamic' are kept",
+        default=False,
+        )
+
+    write_group_map: BoolProperty(
+        name="Write Group Names",
+        description="Write the original names of the shortened groups into a .groups.json file next to the script",
+        default=False,
+        )
+
+    watch: BoolProperty(
+        name="Watch Mode",
+        description="Track changes after the export. File > Export > Update Roomle Export (or saving) exports again, regenerating only changed objects and materials",
+        default=False,
+        )
+
+    write_report: BoolProperty(
+            name="Write Export Report",
+            description="Write the per-object export decisions into a .report.json file next to the script",
+            default=False,
+            )
+
+    background: BoolProperty(
+            name="Background Export",
+            description="Export in small time slices so Blender stays responsive. Shows the progress in the status bar, press Esc to cancel",
+            default=False,
+            )
+
     debug: BoolProperty(
             name="Debug mode",
             description="Creates a script that is easier to read and debug for changes/errors.",
@@ -203,8 +421,22 @@ class ExportRoomleScript( Operator, ExportHelper ):
         layout.prop(self, 'use_selection')
         layout.prop(self, 'export_normals')
         layout.prop(self, 'export_materials')
+        if self.export_materials:
+            layout.prop(self, 'deduplicate_materials')
+            layout.prop(self, 'texture_atlas')
+            if self.texture_atlas:
+                layout.prop(self, 'atlas_max_texture_size')
+            layout.prop(self, 'texture_format')
+            if self.texture_format != 'ORIGINAL':
+                layout.prop(self, 'texture_metric')
+                layout.prop(self, 'texture_target_ssim' if self.texture_metric == 'SSIM' else 'texture_target_psnr')
+            layout.prop(self, 'materials_upsert')
         layout.prop(self, 'apply_rotations')
+        layout.prop(self, 'bake_transforms')
         layout.prop(self, 'use_corto')
+        layout.prop(self, 'package_zip')
+        layout.prop(self, 'background')
+        layout.prop(self, 'watch')
         # TODO: remove warning once it's tested and stable
         if self.apply_rotations:
             layout.label(text='Apply rotation is experimental',icon=icon_exp)
@@ -213,55 +445,174 @@ class ExportRoomleScript( Operator, ExportHelper ):
             box=layout.box()
             box.label(text='Advanced',icon=icon_adv)
             box.prop(self, 'mesh_export_option')
+            if self.mesh_export_option == 'AUTO':
+                box.prop(self, 'auto_request_overhead')
+                box.prop(self, 'auto_external_weight')
             # box.prop(self, 'mesh_format_option')
+            box.prop(self, 'precision_mode')
+            if self.precision_mode == 'RELATIVE':
+                box.prop(self, 'precision_relative')
+            elif self.precision_mode == 'ABSOLUTE':
+                box.prop(self, 'precision_tolerance')
             box.prop(self, 'uv_float_precision')
             box.prop(self, 'normal_float_precision')
-
-    def execute(self, context):
+            box.prop(self, 'elide_normals')
+            if self.elide_normals:
+                box.prop(self, 'normal_tolerance')
+            box.prop(self, 'out_of_core')
+            if self.out_of_core:
+                box.prop(self, 'out_of_core_threshold')
+            box.prop(self, 'parallel_encoding')
+            if self.parallel_encoding:
+                box.prop(self, 'encoder_workers')
+            box.prop(self, 'optimize_script')
+            if self.optimize_script:
+                box.prop(self, 'optimize_tolerance')
+                box.prop(self, 'flatten_hierarchy')
+                box.prop(self, 'write_group_map')
+            box.prop(self, 'write_report')
+
+    def export_keywords(self) -> dict:
+        return self.as_keywords(ignore=("axis_forward",
+                                        "axis_up",
+                                        "global_scale",
+                                        "check_existing",
+                                        "filter_glob",
+                                        "use_scene_unit",
+                                        "use_mesh_modifiers",
+                                        "advanced",
+                                        "background",
+                                        ))
+
+    def export_steps(self, context, keywords):
+        """
+        The complete export as generator, yields (phase, done, total) after every unit of work.
+        Closing it early cancels the export and removes all temporary data.
+        """
         from mathutils import Matrix, Vector
         from . import roomle_script
+        from .material_exporter import iter_export_materials
+        from .packaging import create_sink
+        from .scene_handler import SceneHandler
 
-        
         preferences = bpy.context.preferences.addons[__name__].preferences
 
+        # all files of the export are written through the sink (folder or zip archive)
+        with create_sink(**keywords) as sink:
+            scene_handler = None
+            try:
+                if keywords['export_materials']:
+                    scene_handler = SceneHandler(bpy.context.scene)
+                    scene_handler.copy_scene()
+                    materials = iter_export_materials(sink=sink, **keywords)
+                    while True:
+                        try:
+                            done, total = next(materials)
+                        except StopIteration as result:
+                            # SetObjSurface refers to the canonical one of equivalent materials
+                            keywords['material_aliases'] = result.value.aliases
+                            keywords['texture_reports'] = result.value.textures
+                            break
+                        yield 'Materials', done, total
+
+
+                global_scale = 1000
+                
+                mat_axis = axis_conversion(to_forward='-Y',to_up='Z',).to_4x4()
+                mat_global_scale = Matrix.Scale(global_scale, 4)
+                mat_flip = Matrix.Scale(-1,4,Vector((1,0,0)))
+
+                global_matrix = mat_axis @ mat_global_scale @ mat_flip
+
+                for done, total in roomle_script.iter_roomle_script( self, preferences, bpy.context, global_matrix=global_matrix, sink=sink, **keywords):
+                    yield 'Script', done, total
+
+                if keywords.get('watch'):
+                    refused = watch.watcher.start(keywords, global_matrix)
+                    if refused:
+                        self.report({'WARNING'}, refused)
+            except (GeneratorExit, Exception):
+                # cancelled or failed: no partial archive that looks like a finished export
+                sink.abort()
+                raise
+            finally:
+                if scene_handler is not None:
+                    scene_handler.remove_export_scene()
+
+    def execute(self, context):
+
         if self.filepath == '':
             raise Exception('no filepath provided')
         
-        keywords = self.as_keywords(ignore=("axis_forward",
-                                            "axis_up",
-                                            "global_scale",
-                                            "check_existing",
-                                            "filter_glob",
-                                            "use_scene_unit",
-                                            "use_mesh_modifiers",
-                                            "advanced"
-                                            ))
-
-        if keywords['export_materials']:
-            scene_handler = SceneHandler(bpy.context.scene)
-            scene_handler.copy_scene()
-            export_materials(**keywords)
-
-
-        global_scale = 1000
-        
-        mat_axis = axis_conversion(to_forward='-Y',to_up='Z',).to_4x4()
-        mat_global_scale = Matrix.Scale(global_scale, 4)
-        mat_flip = Matrix.Scale(-1,4,Vector((1,0,0)))
+        keywords = self.export_keywords()
 
-        global_matrix = mat_axis @ mat_global_scale @ mat_flip
+        if self.background:
+            return self.start_background(context, keywords)
 
         try:
-            roomle_script.write_roomle_script( self, preferences, bpy.context, global_matrix=global_matrix, **keywords)
+            for _ in self.export_steps(context, keywords):
+                pass
         except Exception as e:
             self.report({'ERROR'}, str(e))
             return {'CANCELLED'}
-
-        if keywords['export_materials']:
-            scene_handler.remove_export_scene()
             
         return {'FINISHED'}
 
+    # seconds of export work between two UI updates in background mode
+    TIME_SLICE = 0.1
+
+    def start_background(self, context, keywords):
+        wm = context.window_manager
+        self._phases = (['Materials'] if keywords['export_materials'] else []) + ['Script']
+        self._steps = self.export_steps(context, keywords)
+        self._start_time = time.perf_counter()
+        self._timer = wm.event_timer_add(0.01, window=context.window)
+        wm.progress_begin(0, 100)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def finish_background(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+
+    def update_progress(self, context, phase, done, total):
+        phase_index = self._phases.index(phase)
+        fraction = (phase_index + (done / total if total else 1)) / len(self._phases)
+        elapsed = time.perf_counter() - self._start_time
+        eta = elapsed / fraction - elapsed if fraction > 0 else 0
+        context.window_manager.progress_update(int(fraction * 100))
+        context.workspace.status_text_set(
+            f'Roomle export: {phase} {done}/{total} | {fraction:.0%} | ETA {eta:.0f}s | Esc to cancel'
+        )
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            # closing the generator removes the export scene and incomplete archives
+            self._steps.close()
+            self.finish_background(context)
+            self.report({'WARNING'}, 'Roomle export cancelled')
+            return {'CANCELLED'}
+
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        slice_end = time.perf_counter() + self.TIME_SLICE
+        try:
+            while time.perf_counter() < slice_end:
+                phase, done, total = next(self._steps)
+        except StopIteration:
+            self.finish_background(context)
+            return {'FINISHED'}
+        except Exception as e:
+            self.finish_background(context)
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+
+        self.update_progress(context, phase, done, total)
+        return {'RUNNING_MODAL'}
+
 
 def menu_export(self, context):
     default_path = os.path.splitext(bpy.data.filepath)[0] + ".txt"
@@ -277,8 +628,12 @@ def register():
     bpy.utils.register_class(ExportRoomleScriptPreferences)
     bpy.types.TOPBAR_MT_file_export.append(menu_export)
     optimize_operator.register()
+    preflight_operator.register()
+    watch.register()
 
 def unregister():
+    watch.unregister()
+    preflight_operator.unregister()
     optimize_operator.unregister()
     bpy.types.TOPBAR_MT_file_export.remove(menu_export)
     bpy.utils.unregister_class(ExportRoomleScriptPreferences)
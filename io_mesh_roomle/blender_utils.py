@@ -15,96 +15,199 @@
 
 import bpy
 import bmesh
+import numpy as np
+from dataclasses import dataclass, field
 from mathutils import Vector,Matrix
 
+FRAME_MODES = ('VERTICES','BOUNDS','HULL')
+
 def is_zero(vector):
 	return not any(f!=0 for f in vector)
 
 def get_scene_bounding_box():
 	return get_bounding_box(bpy.context.scene.objects)
 
-def get_bounding_box( objects ):
+def get_local_coords( mesh ):
+	"""
+	Read all vertex positions of a mesh with one bulk read into a (n,3) array
+	"""
+	coords = np.empty(len(mesh.vertices)*3, dtype=np.float32)
+	mesh.vertices.foreach_get('co', coords)
+	return coords.reshape(-1,3)
+
+def transform_coords( coords, matrix ):
+	"""
+	Transform a (n,3) array of points by a 4x4 matrix with one batched multiply
+	"""
+	m = np.array(matrix, dtype=np.float64)
+	return coords @ m[:3,:3].T + m[:3,3]
+
+def get_world_coords( obj ):
+	return transform_coords( get_local_coords(obj.data), obj.matrix_world )
 
-	scene_min = Vector( [float('inf')]*3 )
-	scene_max = Vector( [float('-inf')]*3 )
+def get_bounding_box( objects, ignore=None ):
+	"""
+	ignore: optional dict of mesh -> boolean mask of vertices to leave out
+	"""
+
+	scene_min = np.full(3, float('inf'))
+	scene_max = np.full(3, float('-inf'))
 
 	for obj in objects:
-		if obj.type !='MESH':
+		if obj.type !='MESH' or len(obj.data.vertices)==0:
 			continue
-		for vert in obj.data.vertices:
-			v = obj.matrix_world @ vert.co
-			for i in range(3):
-				scene_min[i] = min(scene_min[i],v[i])
-				scene_max[i] = max(scene_max[i],v[i])
+		coords = get_world_coords(obj)
+		if ignore and obj.data in ignore:
+			coords = coords[~ignore[obj.data]]
+			if len(coords)==0:
+				continue
+		scene_min = np.minimum(scene_min, coords.min(axis=0))
+		scene_max = np.maximum(scene_max, coords.max(axis=0))
+
+	scene_min = Vector(scene_min.tolist())
+	scene_max = Vector(scene_max.tolist())
 
 	center = (scene_min+scene_max)*0.5
 	dimensions = scene_max-scene_min
 	return center,dimensions
 
-def frame_object_bounding_box( camera, objects ):
+def get_hull_coords( obj ):
+	"""
+	Local positions of the convex hull vertices of a mesh.
+	Falls back to all vertices for degenerate (e.g. flat) meshes.
+	"""
+	bm = bmesh.new()
+	try:
+		bm.from_mesh(obj.data)
+		result = bmesh.ops.convex_hull(bm, input=bm.verts[:], use_existing_faces=False)
+		hull = [ele.co[:] for ele in result['geom'] if isinstance(ele, bmesh.types.BMVert)]
+	except (RuntimeError, ValueError):
+		hull = []
+	finally:
+		bm.free()
 
-	points = list()
+	if not hull:
+		return get_local_coords(obj.data)
+	return np.array(hull, dtype=np.float32)
+
+def get_framing_points( obj, mode='VERTICES' ):
+	"""
+	World space points of one object that a camera has to fit
+
+	VERTICES: every vertex
+	BOUNDS: the 8 corners of the object's bounding box
+	HULL: the vertices of the object's convex hull
+	"""
+	if mode == 'BOUNDS':
+		coords = np.array([c[:] for c in obj.bound_box], dtype=np.float32)
+	elif mode == 'HULL':
+		coords = get_hull_coords(obj)
+	elif mode == 'VERTICES':
+		coords = get_local_coords(obj.data)
+	else:
+		raise ValueError('unknown frame mode {}, expected one of {}'.format(mode,FRAME_MODES))
+	return transform_coords( coords, obj.matrix_world )
+
+def fit_camera( camera, points ):
+	if len(points)==0:
+		return
+	depsgraph = bpy.context.evaluated_depsgraph_get()
+	pos = camera.camera_fit_coords( depsgraph, np.asarray(points).ravel().tolist() )
+	camera.location = pos[0]
 
-	center,dimensions = get_bounding_box( objects )
+def frame_object_bounding_box( camera, objects ):
 
-	extends = dimensions*0.5
+	center,dimensions = get_bounding_box( objects )
 
-	for i in range(8):
-		e = extends.copy()
-		if (i & 1) > 0:
-			e.x *= -1
-		if (i & 1<<1) > 0:
-			e.y *= -1
-		if (i & 1<<2) > 0:
-			e.z *= -1
+	extends = np.array(dimensions)*0.5
 
-		#print(e)
+	# all 8 sign combinations of the extends
+	signs = np.array([
+		[-1 if (i & 1<<axis) > 0 else 1 for axis in range(3)]
+		for i in range(8)
+		])
 
-		p = center+e
-		points += p.to_tuple()
+	points = np.array(center) + signs*extends
 
-	pos = camera.camera_fit_coords( bpy.context.scene, points )
+	fit_camera( camera, points )
 
-	camera.location = pos[0]
+def frame_object( camera, objects, mode='VERTICES' ):
+	"""
+	Fit the camera to the objects.
+	With mode BOUNDS or HULL only the per-object bounding box corners or convex
+	hull vertices are used, which frames the same (BOUNDS: similar) view with
+	a fraction of the points.
+	"""
 
-def frame_object( camera, objects ):
+	points = [
+		get_framing_points(obj, mode)
+		for obj in objects
+		if obj.type =='MESH' and len(obj.data.vertices)>0
+		]
 
-	points = list()
+	if not points:
+		return
 
-	for obj in objects:
-		if obj.type !='MESH':
-			continue
-		for vert in obj.data.vertices:
-			points += (obj.matrix_world @ vert.co).to_tuple()
-			
 	# print('found {} points'.format(len(points)))
-	pos = camera.camera_fit_coords( bpy.context.scene, points )
-
-	camera.location = pos[0]
-
-def remove_loose_vertices( obj ):
+	fit_camera( camera, np.concatenate(points) )
+
+@dataclass
+class OptimizeReport:
+	dry_run: bool = False
+	messages: list = field(default_factory=list)
+	loose_vertices: int = 0
+	transformed_objects: int = 0
+	center_delta: Vector = None
+
+	def summary(self):
+		return '{}{} loose vertices, {} transforms to apply, scene {}'.format(
+			'Dry run: ' if self.dry_run else '',
+			self.loose_vertices,
+			self.transformed_objects,
+			'centered' if self.center_delta is None else 'moved by {}'.format(self.center_delta.to_tuple(4)),
+			)
+
+def get_loose_vertex_mask( mesh ):
+	"""
+	Boolean mask of all vertices that are not used by any face,
+	found from the face corners' vertex indices
+	"""
+	loop_vertices = np.empty(len(mesh.loops), dtype=np.int32)
+	mesh.loops.foreach_get('vertex_index', loop_vertices)
+	loose = np.ones(len(mesh.vertices), dtype=bool)
+	loose[loop_vertices] = False
+	return loose
+
+def remove_loose_vertices( obj, loose=None, dry_run=False ):
 	messages = []
 
 	me = obj.data
 
+	if loose is None:
+		loose = get_loose_vertex_mask(me)
+
+	removed_count = int(np.count_nonzero(loose))
+	if removed_count<1:
+		return messages
+
+	if dry_run:
+		messages.append( 'Object {}: Would remove {} loose vertices'.format(obj.name,removed_count) )
+		return messages
+
 	# Get a BMesh representation
 	bm = bmesh.new()
-	bm.from_mesh(me)
-
-	# Find vertices without faces and remove them
-	removed_count = 0
-	for v in bm.verts:
-		l=len(v.link_faces)
-		if l<1:
-			removed_count += 1
-			bm.verts.remove(v)
-	if removed_count>0:
-		messages.append( 'Object {}: Removed {} loose vertices'.format(obj.name,removed_count) )
+	try:
+		bm.from_mesh(me)
+		bm.verts.ensure_lookup_table()
+		loose_verts = [bm.verts[i] for i in np.flatnonzero(loose)]
+		bmesh.ops.delete(bm, geom=loose_verts, context='VERTS')
 		# Show the updates in the viewport
 		# and recalculate n-gon tessellation.
 		bm.to_mesh(me)
+	finally:
 		bm.free()
 
+	messages.append( 'Object {}: Removed {} loose vertices'.format(obj.name,removed_count) )
 	return messages
 	
 def get_root_objects(scene):
@@ -119,31 +222,32 @@ def move_all( delta ):
 	for obj in objects:
 		obj.location += delta
 
-def reset_transform(obj):
+def reset_transform(obj, bases=None):
+	"""
+	Apply the object's transform into its mesh data and hand it on to its children.
+	If a dict `bases` (object -> matrix_basis) is given, only the matrices in there
+	are updated and the scene is left untouched (dry run).
+	"""
 
 	messages = []
 
-	mat = obj.matrix_basis.copy()
+	mat = obj.matrix_basis.copy() if bases is None else bases[obj]
 
 	if mat == Matrix():
 		return messages
 
-	me = obj.data
-
-	# Get a BMesh representation
-	bm = bmesh.new()
-	bm.from_mesh(me)
+	if bases is not None:
+		messages.append( 'Object {}: would apply transform {}'.format(obj.name,mat) )
+		bases[obj] = Matrix()
+		for child in obj.children:
+			bases[child] = mat @ bases[child]
+		return messages
 
-	for v in bm.verts:
-		v.co = mat @ v.co
+	obj.data.transform(mat)
+	obj.data.update()
 	
 	messages.append( 'Object {}: applied transform {}'.format(obj.name,mat) )
 
-	# Show the updates in the viewport
-	# and recalculate n-gon tessellation.
-	bm.to_mesh(me)
-	bm.free()
-
 	obj.matrix_basis = Matrix() # identity
 
 	for child in obj.children:
@@ -151,32 +255,58 @@ def reset_transform(obj):
 
 	return messages
 
-def optimize_scene( center_scene=True, reset_transforms=True ):
-	messages = []
-	for obj in bpy.context.scene.objects:
-		if obj.type!='MESH':
+def optimize_scene( center_scene=True, reset_transforms=True, dry_run=False ):
+	"""
+	Remove loose vertices, center the scene and apply transforms into mesh data.
+	With dry_run the scene is not modified, the returned report lists what would change.
+	"""
+	report = OptimizeReport(dry_run=dry_run)
+	messages = report.messages
+	scene = bpy.context.scene
+
+	mesh_objects = [obj for obj in scene.objects if obj.type=='MESH']
+
+	# meshes can be shared between objects, analyze each of them once
+	loose_masks = {}
+	for obj in mesh_objects:
+		if obj.data in loose_masks:
 			continue
-		messages += remove_loose_vertices(obj)
+		loose = get_loose_vertex_mask(obj.data)
+		loose_masks[obj.data] = loose
+		report.loose_vertices += int(np.count_nonzero(loose))
+		messages += remove_loose_vertices(obj, loose=loose, dry_run=dry_run)
+
+	bases = {obj: obj.matrix_basis.copy() for obj in scene.objects} if dry_run else None
 
 	if center_scene:
-		c,d = get_scene_bounding_box()
+		if dry_run:
+			c,d = get_bounding_box(scene.objects, ignore=loose_masks)
+		else:
+			c,d = get_scene_bounding_box()
 
 		delta = -c
 		delta.z += d.z/2
 
 		if not is_zero(delta):
+			report.center_delta = delta
 			messages.append( 'Scene is not centered (delta: {})'.format(delta) )
-			move_all( delta )
+			if dry_run:
+				for obj in get_root_objects(scene):
+					bases[obj] = Matrix.Translation(delta) @ bases[obj]
+			else:
+				move_all( delta )
 
 	if reset_transforms:
-		for obj in bpy.context.scene.objects:
-			if obj.type!='MESH':
-				continue
-			messages += reset_transform(obj)
+		for obj in mesh_objects:
+			transform_messages = reset_transform(obj, bases=bases)
+			report.transformed_objects += bool(transform_messages)
+			messages += transform_messages
 
 	for msg in messages:
 		print(msg)
 
+	return report
+
 if __name__ == "__main__":
 
-	optimize_scene()
\ No newline at end of file
+	optimize_scene()
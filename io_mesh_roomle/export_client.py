@@ -0,0 +1,140 @@
+# -----------------------------------------------------------------------
+#
+#  Copyright 2019 Roomle GmbH. All Rights Reserved.
+#
+#  This Software is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND.
+#
+#  NOTICE: All information contained herein is, and remains
+#  the property of Roomle. The intellectual and technical concepts contained
+#  herein are proprietary to Roomle and are protected by copyright law.
+#  Dissemination of this information or reproduction of this material
+#  is strictly forbidden unless prior written permission is obtained
+#  from Roomle.
+# -----------------------------------------------------------------------
+
+"""
+Client of the export worker service (`export_service.py`), does not need Blender.
+
+    with ExportClient.start('/path/to/blender') as client:
+        for blend in blends:
+            result = client.export(blend, blend.replace('.blend', '/product.txt'), catalog_id='shop')
+
+    python io_mesh_roomle/export_client.py --blender /path/to/blender out/product.txt a.blend b.blend
+"""
+
+import argparse
+import itertools
+import json
+import os
+import socket
+import subprocess
+import sys
+
+from typing import BinaryIO, Optional
+
+SERVICE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'export_service.py')
+
+
+class ExportServiceError(Exception):
+    pass
+
+
+class ExportClient:
+    """sends requests as JSON lines and reads one JSON line back per request"""
+
+    def __init__(self, reader: BinaryIO, writer: BinaryIO, process: Optional[subprocess.Popen] = None, connection: Optional[socket.socket] = None) -> None:
+        self._reader = reader
+        self._writer = writer
+        self._process = process
+        self._connection = connection
+        self._ids = itertools.count(1)
+
+    @classmethod
+    def start(cls, blender: str, *blender_args: str) -> 'ExportClient':
+        """start a service speaking over stdin/stdout, it ends with the client"""
+        process = subprocess.Popen(
+            [blender, '--background', '--factory-startup', *blender_args, '--python', SERVICE, '--'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        return cls(process.stdout, process.stdin, process=process)
+
+    @classmethod
+    def connect(cls, port: int, host: str = '127.0.0.1') -> 'ExportClient':
+        """connect to a service started with `--port`"""
+        connection = socket.create_connection((host, port))
+        return cls(connection.makefile('rb'), connection.makefile('wb'), connection=connection)
+
+    def request(self, request: dict) -> dict:
+        request = dict(request, id=next(self._ids))
+        self._writer.write(json.dumps(request).encode('utf-8') + b'\n')
+        self._writer.flush()
+        line = self._reader.readline()
+        if not line:
+            raise ExportServiceError('export service closed the connection')
+        response = json.loads(line)
+        if response.get('id') != request['id']:
+            raise ExportServiceError(f'response {response.get("id")} to request {request["id"]}')
+        return response
+
+    def ping(self) -> dict:
+        return self.request({'command': 'ping'})
+
+    def export(self, blend: Optional[str], filepath: str, **options) -> dict:
+        """
+        export a blend file (None: the currently loaded scene) to the script `filepath`,
+        the options are properties of the export operator
+        """
+        return self.request({
+            'blend': None if blend is None else os.path.abspath(blend),
+            'filepath': os.path.abspath(filepath),
+            'options': options,
+        })
+
+    def close(self):
+        try:
+            self.request({'command': 'quit'})
+        except (OSError, ValueError, ExportServiceError):
+            pass
+        for stream in (self._writer, self._reader):
+            stream.close()
+        if self._connection is not None:
+            self._connection.close()
+        if self._process is not None:
+            self._process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export blend files with one running Blender')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--blender', help='Blender executable to start the service with')
+    group.add_argument('--port', type=int, help='port of a running service')
+    parser.add_argument('--options', default='{}', help='export options as JSON')
+    parser.add_argument('filepath', help='script file name, written into a folder per blend file')
+    parser.add_argument('blends', nargs='+')
+    args = parser.parse_args(argv)
+
+    options = json.loads(args.options)
+    client = ExportClient.start(args.blender) if args.port is None else ExportClient.connect(args.port)
+    failed = 0
+    with client:
+        for blend in args.blends:
+            folder = os.path.splitext(blend)[0]
+            result = client.export(blend, os.path.join(folder, os.path.basename(args.filepath)), **options)
+            if result['ok']:
+                print(f'{blend}: {result["seconds"]:.2f}s (load {result["load_seconds"]:.2f}s, export {result["export_seconds"]:.2f}s)')
+            else:
+                failed += 1
+                print(f'{blend}: {result["error"]}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
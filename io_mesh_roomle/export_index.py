@@ -0,0 +1,175 @@
+# -----------------------------------------------------------------------
+# 
+#  Copyright 2019 Roomle GmbH. All Rights Reserved.
+# 
+#  This Software is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND.
+# 
+#  NOTICE: All information contained herein is, and remains
+#  the property of Roomle. The intellectual and technical concepts contained
+#  herein are proprietary to Roomle and are protected by copyright law.
+#  Dissemination of this information or reproduction of this material
+#  is strictly forbidden unless prior written permission is obtained
+#  from Roomle.
+# -----------------------------------------------------------------------
+
+import bpy
+
+from mathutils import Matrix
+
+# custom property of objects the configurator moves or parameterizes, they keep
+# their transform commands when static transforms are baked
+DYNAMIC_PROPERTY = 'roomle_dynamic'
+# custom property of objects whose group is meaningful to the configurator,
+# it is not dissolved when the hierarchy is flattened
+KEEP_GROUP_PROPERTY = 'roomle_keep_group'
+
+
+class ExportIndex:
+    """
+    Pre-pass over the object hierarchy of an export.
+
+    Holds the exportable objects as a set, marks all objects whose subtree
+    contains something to export (`live`) and caches the world scale and
+    rotation of every object, so the traversal can skip dead subtrees and
+    does not decompose a matrix more than once.
+
+    For baked transforms it also caches the matrices relative to the nearest
+    dynamic ancestor (`anchor`), see `baked_matrix`.
+
+    `instance_bodies` caches the commands of instanced collections
+    (collection -> commands), it can be shared with the indices of the
+    collections' content.
+    """
+
+    def __init__(self, root_objects, object_list=None, instance_bodies=None) -> None:
+        self.roots = [obj for obj in root_objects if obj]
+        self.exportable = None if object_list is None else set(object_list)
+        self.live = set()
+        self.instance_bodies = {} if instance_bodies is None else instance_bodies
+        # instancer -> depsgraph instances, collected on first use
+        self.depsgraph_instances = None
+        # object -> (smallest coordinate tolerance in its subtree, nested translations), on first use
+        self.translation_budgets = None
+
+        self._collections = {}
+        self._children = {}
+        self._scales = {}
+        self._rotations = {}
+        self._anchors = {}
+        self._runtime_matrices = {}
+
+        # same content and order as `Object.children`, which scans all objects on every access
+        for obj in bpy.data.objects:
+            if obj.parent:
+                self._children.setdefault(obj.parent, []).append(obj)
+
+        self._mark_live()
+
+    def is_exportable(self, obj) -> bool:
+        return self.exportable is None or obj in self.exportable
+
+    def exports_mesh(self, obj) -> bool:
+        return self.is_exportable(obj) and isinstance(obj.data, bpy.types.Mesh)
+
+    def exports_instance(self, obj) -> bool:
+        """the object instances a collection that contains meshes"""
+        if obj.instance_type != 'COLLECTION' or obj.instance_collection is None or not self.is_exportable(obj):
+            return False
+        collection = obj.instance_collection
+        if collection not in self._collections:
+            self._collections[collection] = any(isinstance(o.data, bpy.types.Mesh) for o in collection.all_objects)
+        return self._collections[collection]
+
+    def children(self, obj) -> list:
+        return self._children.get(obj, [])
+
+    def live_children(self, obj) -> list:
+        return [child for child in self.children(obj) if child in self.live]
+
+    def live_roots(self) -> list:
+        return [root for root in self.roots if root in self.live]
+
+    def walk(self):
+        """iterate all live objects in export order (parents before their children)"""
+        stack = list(reversed(self.live_roots()))
+        while stack:
+            obj = stack.pop()
+            yield obj
+            stack.extend(reversed(self.live_children(obj)))
+
+    def _mark_live(self):
+        # iterative post-order walk: children are decided before their parent
+        stack = [(root, False) for root in reversed(self.roots)]
+        while stack:
+            obj, visited = stack.pop()
+            if visited:
+                if (
+                    self.exports_mesh(obj)
+                    or self.exports_instance(obj)
+                    or any(child in self.live for child in self.children(obj))
+                ):
+                    self.live.add(obj)
+            else:
+                stack.append((obj, True))
+                stack.extend((child, False) for child in self.children(obj))
+
+    def world_scale(self, obj):
+        """world scale of the object or `None` if it is not scaled"""
+        if obj not in self._scales:
+            scale = obj.matrix_world.to_scale()
+            if scale.x==1 and scale.y==1 and scale.z==1:
+                scale = None
+            self._scales[obj] = scale
+        return self._scales[obj]
+
+    def world_rotation(self, obj):
+        """world rotation of the object as quaternion or `None` if it is not rotated"""
+        if obj not in self._rotations:
+            rotation = obj.matrix_world.to_quaternion()
+            if rotation.x==0 and rotation.y==0 and rotation.z==0 and rotation.w==1:
+                rotation = None
+            self._rotations[obj] = rotation
+        return self._rotations[obj]
+
+    def is_dynamic(self, obj) -> bool:
+        """the object is marked to keep its transform commands"""
+        return bool(obj.get(DYNAMIC_PROPERTY))
+
+    def keeps_group(self, obj) -> bool:
+        """the object's group has to stay: it is marked as meaningful or moved by the configurator"""
+        return bool(obj.get(KEEP_GROUP_PROPERTY)) or self.is_dynamic(obj)
+
+    def anchor(self, obj):
+        """the object itself if it is dynamic, else its nearest dynamic ancestor or `None` (the scene)"""
+        if obj not in self._anchors:
+            # resolve the uncached part of the parent chain, topmost first
+            chain = []
+            node = obj
+            while node is not None and node not in self._anchors:
+                chain.append(node)
+                node = node.parent
+            anchor = None if node is None else self._anchors[node]
+            for node in reversed(chain):
+                if self.is_dynamic(node):
+                    anchor = node
+                self._anchors[node] = anchor
+        return self._anchors[obj]
+
+    def runtime_matrix(self, anchor) -> Matrix:
+        """world matrix the runtime builds for an anchor from its commands: translation and rotation"""
+        if anchor is None:
+            return Matrix.Identity(4)
+        if anchor not in self._runtime_matrices:
+            world = anchor.matrix_world
+            self._runtime_matrices[anchor] = Matrix.Translation(world.translation) @ world.to_quaternion().to_matrix().to_4x4()
+        return self._runtime_matrices[anchor]
+
+    def baked_matrix(self, obj) -> Matrix:
+        """transform (including scale and shear) baked into the object's mesh, relative to its anchor"""
+        return self.runtime_matrix(self.anchor(obj)).inverted() @ obj.matrix_world
+
+    def dynamic_matrix(self, obj) -> Matrix:
+        """transform of a dynamic object relative to the anchor of its parent, without scale"""
+        parent = None if obj.parent is None else self.anchor(obj.parent)
+        return self.runtime_matrix(parent).inverted() @ self.runtime_matrix(obj)
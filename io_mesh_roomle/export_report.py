@@ -0,0 +1,83 @@
+# -----------------------------------------------------------------------
+# 
+#  Copyright 2019 Roomle GmbH. All Rights Reserved.
+# 
+#  This Software is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND.
+# 
+#  NOTICE: All information contained herein is, and remains
+#  the property of Roomle. The intellectual and technical concepts contained
+#  herein are proprietary to Roomle and are protected by copyright law.
+#  Dissemination of this information or reproduction of this material
+#  is strictly forbidden unless prior written permission is obtained
+#  from Roomle.
+# -----------------------------------------------------------------------
+
+import json
+
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import Dict, List, Union
+
+
+@dataclass
+class ObjectReport:
+    """what the exporter decided for one object"""
+    name: str
+    mesh: str = ''
+    placement: str = ''             # INLINE or EXTERNAL
+    estimate: Union[dict, None] = None
+    normals: str = ''               # EXPORTED or ELIDED for inline meshes with normals
+    normal_deviation: Union[float, None] = None     # degrees, runtime vs. Blender normals
+    precision: Union[int, None] = None              # decimal digits of inline mesh positions
+    position_error: Union[float, None] = None       # max error of the printed positions in mm
+    move_precision: Union[int, None] = None         # decimal digits of MoveMatrixBy
+    move_error: Union[float, None] = None           # error of the translations of the object and its parents
+
+
+@dataclass
+class ExportReport:
+    """
+    Collects per-object decisions during an export.
+    Written next to the script as `<script>.report.json` if requested.
+    """
+    objects: Dict[str, ObjectReport] = field(default_factory=dict)
+    # format, quality and byte savings of re-encoded textures
+    textures: List[dict] = field(default_factory=list)
+    # sizes, groups, group depth and transforms before and after the script optimizer
+    script: dict = field(default_factory=dict)
+
+    def object(self, obj) -> ObjectReport:
+        if obj.name not in self.objects:
+            self.objects[obj.name] = ObjectReport(name=obj.name)
+        return self.objects[obj.name]
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data['objects'] = list(data['objects'].values())
+        return data
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def write(self, path: Path):
+        Path(path).write_text(self.to_json(), encoding='utf-8')
+
+    def summary(self) -> str:
+        placements = [o.placement for o in self.objects.values() if o.placement]
+        elided = sum(o.normals == 'ELIDED' for o in self.objects.values())
+        summary = '{} meshes exported ({} inline, {} external), normals left out for {}'.format(
+            len(placements),
+            placements.count('INLINE'),
+            placements.count('EXTERNAL'),
+            elided,
+        )
+        if self.textures:
+            saved = sum(t['saved_bytes'] for t in self.textures)
+            summary += ', textures {} KB smaller'.format(saved // 1024)
+        if self.script:
+            saved = self.script['characters_before'] - self.script['characters_after']
+            summary += ', script {} KB smaller'.format(saved // 1024)
+            if self.script['groups_flattened']:
+                summary += ', group depth {} -> {}'.format(self.script['depth_before'], self.script['depth_after'])
+        return summary
@@ -0,0 +1,180 @@
+# -----------------------------------------------------------------------
+#
+#  Copyright 2019 Roomle GmbH. All Rights Reserved.
+#
+#  This Software is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND.
+#
+#  NOTICE: All information contained herein is, and remains
+#  the property of Roomle. The intellectual and technical concepts contained
+#  herein are proprietary to Roomle and are protected by copyright law.
+#  Dissemination of this information or reproduction of this material
+#  is strictly forbidden unless prior written permission is obtained
+#  from Roomle.
+# -----------------------------------------------------------------------
+
+"""
+Long-lived export worker: Blender is started and the addon registered once,
+then export jobs are read as JSON lines until the input is closed.
+
+    blender --background --factory-startup --python io_mesh_roomle/export_service.py -- [--port PORT]
+
+Without `--port` the jobs are read from stdin and the results written to the
+original stdout, everything Blender itself prints goes to stderr. With `--port`
+one client at a time is served on localhost (port 0 picks a free one, the port
+is printed as `listening on <port>`).
+
+A job is `{"id": ..., "blend": <blend file or null>, "filepath": <script file>, "options": {...}}`,
+the options are properties of `export_mesh.roomle_script`. `{"command": "ping"}`
+and `{"command": "quit"}` are answered as well. See `export_client.py`.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+import zipfile
+
+import bpy
+
+ADDON = 'io_mesh_roomle'
+
+
+def enable_addon():
+    """register the addon of this checkout, unless Blender has it enabled already"""
+    import addon_utils
+
+    if ADDON in bpy.context.preferences.addons:
+        return
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    addon_utils.enable(ADDON, default_set=True)
+    if ADDON not in bpy.context.preferences.addons:
+        raise RuntimeError(f'could not enable {ADDON} from {root}')
+
+
+def written_files(directory: str, since: float) -> list:
+    files = []
+    for folder, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(folder, name)
+            if os.path.getmtime(path) >= since:
+                files.append(path)
+    return sorted(files)
+
+
+def read_report(filepath: str, package_zip: bool):
+    """the export report the job wrote next to its script, None if there is none"""
+    base = os.path.splitext(filepath)[0]
+    name = os.path.basename(base) + '.report.json'
+    try:
+        if package_zip:
+            with zipfile.ZipFile(base + '.zip') as archive:
+                return json.loads(archive.read(name))
+        with open(os.path.join(os.path.dirname(filepath), name), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def run_job(job: dict) -> dict:
+    start = time.perf_counter()
+    result = {'id': job.get('id'), 'ok': False}
+    try:
+        filepath = os.path.abspath(job['filepath'])
+        options = dict(job.get('options') or {})
+        options.setdefault('write_report', True)
+        # a job runs to completion, there is no UI to show the progress in
+        options['background'] = False
+        options['watch'] = False
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+        if job.get('blend'):
+            bpy.ops.wm.open_mainfile(filepath=os.path.abspath(job['blend']), load_ui=False)
+        loaded = time.perf_counter()
+
+        since = time.time()
+        bpy.ops.export_mesh.roomle_script(filepath=filepath, **options)
+        exported = time.perf_counter()
+
+        package_zip = options.get('package_zip', False)
+        files = written_files(os.path.dirname(filepath), since)
+        # the script export reports its errors but does not raise them
+        script = os.path.splitext(filepath)[0] + '.zip' if package_zip else filepath
+        if script not in files:
+            raise RuntimeError('Export did not write ' + script)
+
+        result.update(
+            ok=True,
+            files=files,
+            report=read_report(filepath, package_zip) if options['write_report'] else None,
+            load_seconds=loaded - start,
+            export_seconds=exported - loaded,
+        )
+    except Exception as e:
+        result.update(error=str(e), traceback=traceback.format_exc())
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def serve_stream(reader, writer):
+    """answer one JSON line per request until the reader is closed or `quit` is sent"""
+    for line in reader:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            response = {'ok': False, 'error': f'invalid request: {e}'}
+            request = {}
+        else:
+            command = request.get('command', 'export')
+            if command == 'ping':
+                response = {'id': request.get('id'), 'ok': True, 'blender': bpy.app.version_string}
+            elif command == 'quit':
+                response = {'id': request.get('id'), 'ok': True}
+            else:
+                response = run_job(request)
+        writer.write(json.dumps(response).encode('utf-8') + b'\n')
+        writer.flush()
+        if request.get('command') == 'quit':
+            return False
+    return True
+
+
+def serve_stdin():
+    # the protocol gets the original stdout, prints of Blender and the export go to stderr
+    writer = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    serve_stream(sys.stdin.buffer, writer)
+
+
+def serve_socket(port: int):
+    with socket.create_server(('127.0.0.1', port)) as server:
+        print(f'listening on {server.getsockname()[1]}', flush=True)
+        while True:
+            connection, _ = server.accept()
+            with connection, connection.makefile('rb') as reader, connection.makefile('wb') as writer:
+                if not serve_stream(reader, writer):
+                    return
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='export_service')
+    parser.add_argument('--port', type=int, help='serve on this localhost port instead of stdin/stdout')
+    args = parser.parse_args(argv)
+
+    enable_addon()
+    if args.port is None:
+        serve_stdin()
+    else:
+        serve_socket(args.port)
+
+
+if __name__ == '__main__':
+    main(sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else [])
@@ -1,10 +1,17 @@
 import logging
+import tempfile
 import bpy
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Iterable, List, Union, TYPE_CHECKING
+from typing import Dict, Iterable, List, Union, TYPE_CHECKING
 
 from io_mesh_roomle.material_exporter._exporter import BlenderMaterialForExport, TextureNameManager
 from io_mesh_roomle.material_exporter._roomle_material_csv import MaterialDefinition, RoomleMaterialsCsv
+from io_mesh_roomle.material_exporter._dedup import MaterialDeduplicator
+from io_mesh_roomle.material_exporter._atlas import build_atlases
+from io_mesh_roomle.material_exporter._transcode import TextureReport, texture_channels, transcode_image
+from io_mesh_roomle.enums import SUPPORTED_TEXTURE_FILE_FORMATS
+from io_mesh_roomle.packaging import DirectorySink
 
 log = logging.getLogger('legacy csv')
 log.setLevel(logging.DEBUG)
@@ -97,7 +104,44 @@ def get_materials_used_by_objs(objects: Iterable[bpy.types.Object]) -> set:
 
 
 
-def export_materials(**keywords):
+def save_image(image: bpy.types.Image, relpath: str, sink: DirectorySink):
+    """write an image file into the export
+
+    packed images that are already in the requested format are written as they are,
+    without decoding and encoding them again
+    """
+    packed = image.packed_file
+    suffix = SUPPORTED_TEXTURE_FILE_FORMATS.get(image.file_format)
+    if packed is not None and not image.is_dirty and suffix and relpath.lower().endswith(suffix):
+        sink.write_bytes(relpath, packed.data)
+        return
+    with sink.stage(relpath) as path:
+        image.save(filepath=str(path))
+
+
+@dataclass
+class MaterialExportResult:
+    # material id -> canonical material id of collapsed duplicates
+    aliases: Dict[str, str] = field(default_factory=dict)
+    # one entry per transcoded texture
+    textures: List[TextureReport] = field(default_factory=list)
+
+
+def export_materials(**keywords) -> MaterialExportResult:
+    """export all materials at once, see `iter_export_materials`"""
+    steps = iter_export_materials(**keywords)
+    while True:
+        try:
+            next(steps)
+        except StopIteration as result:
+            return result.value
+
+
+def iter_export_materials(**keywords):
+    """
+    export the materials step by step, yields (done, total) after every unit of work
+    and returns a `MaterialExportResult`
+    """
 
     log.info(f"\n{'='*80}\n{'STARTING MATERIAL EXPORT':^80}\n{'='*80}")
     # Rough outline
@@ -113,6 +157,7 @@ def export_materials(**keywords):
 
     out_path = Path(keywords['filepath']).parent
     use_selection = keywords["use_selection"]
+    sink = keywords.get('sink') or DirectorySink(out_path)
 
     csv_exporter = RoomleMaterialsCsv()
     texture_name_manager = TextureNameManager()
@@ -122,41 +167,125 @@ def export_materials(**keywords):
 
     mesh_objs_to_export = get_mesh_objects_for_export(use_selection)
 
+    # rough estimate until the materials are known: objects + csv
+    total = len(mesh_objs_to_export) + 1
+    done = 0
+
+    # watch mode updates only export the named materials and leave the scene as it is
+    material_names = keywords.get('material_names')
+
     # ------------- [ separate objects by materials ] --------------
     extracted_meshes = set()
-    for obj in mesh_objs_to_export:
+    for obj in (mesh_objs_to_export if material_names is None else ()):
         material_parts = split_object_by_materials(obj)
         # add new mesh fragments to export
         extracted_meshes.update(material_parts)
+        done += 1
+        yield done, total
     mesh_objs_to_export.update(extracted_meshes)
 
     # ==================================================
 
     materials = get_materials_used_by_objs(mesh_objs_to_export)
+    if material_names is not None:
+        materials = {m for m in materials if m.name in material_names}
 
+    # sorted, so the first of equivalent materials (e.g. `Wood` before `Wood.001`) is canonical
     material_exports: list[BlenderMaterialForExport]= [
         BlenderMaterialForExport(material)
-        for material in materials
+        for material in sorted(materials, key=lambda m: m.name)
     ]
+    # duplicates are found among the exported materials, named subsets (watch mode) contain
+    # the materials they were merged with
+    dedup = MaterialDeduplicator() if keywords.get('deduplicate_materials', True) else None
+
+    total = done + len(material_exports) + 1
+
+    # upsert: merge into the existing csv and keep the textures of unchanged rows
+    existing_rows = None
+    if keywords.get('materials_upsert'):
+        existing_csv = sink.read_text('materials/materials.csv')
+        existing_rows = RoomleMaterialsCsv.parse_rows(existing_csv) if existing_csv else {}
 
     for m in material_exports:
         m.pbr = PBR_ShaderData(m.material)
-        pass
-        for channel in m.pbr.all_pbr_channels:
-            channel.map = texture_name_manager.validate_name(channel.map)
-        for tex in m.used_tex_nodes:
-            name = texture_name_manager.validate_name(tex.image)
-            tex.image.save(filepath=str(out_path / 'materials' / name))
 
-
-    for mat in material_exports:
-        csv_exporter.add_material_definition(
-            pbr_2_material_definition(mat)
+    # small non-tiling diffuse textures are packed into atlases, UVs are moved into their regions
+    atlases = {}
+    if keywords.get('texture_atlas') and material_names is None:
+        atlases = build_atlases(material_exports, mesh_objs_to_export, keywords.get('atlas_max_texture_size', 256))
+        for m in material_exports:
+            if m.material in atlases:
+                m.pbr.diffuse.map = atlases[m.material].image
+
+    # re-encode the textures by the policy of their channel, before the file names are given
+    transcoded = {}
+    if keywords.get('texture_format', 'ORIGINAL') != 'ORIGINAL':
+        channels = texture_channels(material_exports)
+        total += len(channels)
+        with tempfile.TemporaryDirectory() as directory:
+            for image, channel in channels.items():
+                transcoded[image] = transcode_image(image, channel, directory, **keywords)
+                done += 1
+                yield done, total
+
+    def texture_name(image):
+        if image in transcoded:
+            return texture_name_manager.validate_name(image, transcoded[image].file_format)
+        return texture_name_manager.validate_name(image)
+
+    written = set()
+    for m in material_exports:
+        atlas = atlases.get(m.material)
+        for channel in m.pbr.all_pbr_channels:
+            channel.map = texture_name(channel.map)
+        definition = pbr_2_material_definition(m)
+        if atlas is None:
+            images = {texture_name(tex.image): tex.image for tex in m.used_tex_nodes}
+        else:
+            definition.diffuse_map.tileable = False
+            images = {texture_name(atlas.image): atlas.image}
+        done += 1
+
+        # duplicates are referenced by their canonical material, no row and no textures
+        if dedup is not None and dedup.add(definition, images) is not None:
+            yield done, total
+            continue
+
+        unchanged = (
+            existing_rows is not None
+            and existing_rows.get(definition.material_id) == RoomleMaterialsCsv.csv_row(definition)
         )
-    csv_exporter.write(out_path / 'materials/materials.csv')
+        for name, image in images.items():
+            relpath = f'materials/{name}'
+            if relpath in written:
+                continue
+            written.add(relpath)
+            if unchanged and not image.is_dirty and sink.exists(relpath):
+                log.debug(f'unchanged texture {relpath}')
+                continue
+            if image in transcoded and transcoded[image].data is not None:
+                sink.write_bytes(relpath, transcoded[image].data)
+            else:
+                save_image(image, relpath, sink)
+        csv_exporter.add_material_definition(definition)
+        yield done, total
+
+    sink.write_text('materials/materials.csv', csv_exporter.to_text(existing_rows))
+
+    for image in {atlas.image for atlas in atlases.values()}:
+        bpy.data.images.remove(image)
 
     # ==================================================
 
-    bpy.ops.object.select_all(action='DESELECT')
-    for obj in mesh_objs_to_export:  # | selection_to_restore:
-        obj.select_set(True)
+    if material_names is None:
+        bpy.ops.object.select_all(action='DESELECT')
+        for obj in mesh_objs_to_export:  # | selection_to_restore:
+            obj.select_set(True)
+
+    yield total, total
+
+    return MaterialExportResult(
+        aliases={} if dedup is None else dedup.aliases,
+        textures=[t.report for t in transcoded.values()],
+    )
@@ -0,0 +1,230 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import bpy
+import numpy as np
+
+log = logging.getLogger('texture atlas')
+
+ATLAS_SIZE = 2048
+# pixels around every region, filled with its edge pixels against bleeding
+PADDING = 2
+# UVs may be slightly outside of 0...1 without tiling
+UV_EPSILON = 1e-4
+
+
+@dataclass
+class AtlasRegion:
+    image: bpy.types.Image
+    x: int
+    y: int
+    width: int
+    height: int
+
+
+@dataclass
+class Atlas:
+    name: str
+    width: int = 0
+    height: int = 0
+    regions: Dict[bpy.types.Image, AtlasRegion] = field(default_factory=dict)
+    image: Optional[bpy.types.Image] = None
+
+    def uv_transform(self, image: bpy.types.Image) -> Tuple[float, float, float, float]:
+        """scale u, scale v, offset u, offset v that map the image's UVs into its region"""
+        region = self.regions[image]
+        return (
+            region.width / self.width,
+            region.height / self.height,
+            region.x / self.width,
+            region.y / self.height,
+        )
+
+
+def pack_shelves(sizes: Dict[object, Tuple[int, int]], atlas_size: int = ATLAS_SIZE, padding: int = PADDING) -> List[Dict[object, Tuple[int, int]]]:
+    """
+    Shelf packing of rectangles (key -> width, height), highest first.
+    Returns one dict key -> (x, y) per atlas that was needed.
+    """
+    atlases = []
+    positions = {}
+    x = y = shelf_height = 0
+    for key, (width, height) in sorted(sizes.items(), key=lambda item: (-item[1][1], -item[1][0])):
+        w, h = width + 2*padding, height + 2*padding
+        if x + w > atlas_size:
+            x, y, shelf_height = 0, y + shelf_height, 0
+        if y + h > atlas_size:
+            atlases.append(positions)
+            positions = {}
+            x = y = shelf_height = 0
+        positions[key] = (x + padding, y + padding)
+        x += w
+        shelf_height = max(shelf_height, h)
+    if positions:
+        atlases.append(positions)
+    return atlases
+
+
+def is_identity_mapping(node) -> bool:
+    """a Mapping node that passes the vectors through unchanged"""
+    if node.vector_type == 'NORMAL':
+        return False
+    for name, attribute, identity in (('Location', 'translation', 0.0), ('Rotation', 'rotation', 0.0), ('Scale', 'scale', 1.0)):
+        socket = node.inputs.get(name)
+        if socket is None:
+            # before Blender 2.81 the mapping is a property of the node
+            values = getattr(node, attribute, (identity,)*3)
+        elif socket.is_linked:
+            return False
+        else:
+            values = socket.default_value
+        if any(abs(v - identity) > UV_EPSILON for v in values):
+            return False
+    return True
+
+
+def reads_uvs(socket) -> bool:
+    """
+    the vector input of an image node gets the UVs unchanged: unlinked, from the UV
+    output of a Texture Coordinate node or through identity Mapping nodes
+    """
+    while socket.is_linked:
+        link = socket.links[0]
+        node = link.from_node
+        if node.type == 'TEX_COORD':
+            return link.from_socket.identifier == 'UV'
+        if node.type != 'MAPPING' or not is_identity_mapping(node):
+            return False
+        socket = node.inputs['Vector']
+    return True
+
+
+def atlas_candidate(material_export, max_size: int) -> Optional[bpy.types.Image]:
+    """
+    The diffuse image of a material that can move into an atlas:
+    its only texture, reading the UVs unchanged and not bigger than `max_size`.
+    Whether it tiles is decided by the UVs of the faces using it, see `build_atlases`.
+    """
+    tex_nodes = material_export.used_tex_nodes
+    if len(tex_nodes) != 1:
+        return None
+    node = tex_nodes[0]
+    image = node.image
+    if image is None or not reads_uvs(node.inputs['Vector']):
+        return None
+    if material_export.pbr.diffuse.map is not image:
+        return None
+    width, height = image.size
+    if width == 0 or height == 0 or max(width, height) > max_size:
+        return None
+    return image
+
+
+def loop_materials(obj: bpy.types.Object) -> Tuple[np.ndarray, list]:
+    """material slot index of every face corner and the slots' materials"""
+    mesh = obj.data
+    material_index = np.empty(len(mesh.polygons), dtype=np.int32)
+    loop_total = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get('material_index', material_index)
+    mesh.polygons.foreach_get('loop_total', loop_total)
+    return np.repeat(material_index, loop_total), [slot.material for slot in obj.material_slots]
+
+
+def read_uvs(mesh: bpy.types.Mesh) -> Optional[np.ndarray]:
+    uv_layer = mesh.uv_layers.active
+    if uv_layer is None:
+        return None
+    uvs = np.empty(len(mesh.loops)*2, dtype=np.float32)
+    uv_layer.data.foreach_get('uv', uvs)
+    return uvs.reshape(-1, 2)
+
+
+def read_rgba(image: bpy.types.Image) -> np.ndarray:
+    width, height = image.size
+    channels = image.channels
+    pixels = np.empty(width*height*channels, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    pixels = pixels.reshape(height, width, channels)
+    if channels == 4:
+        return pixels
+    rgba = np.ones((height, width, 4), dtype=np.float32)
+    rgba[..., :3] = pixels[..., :1] if channels < 3 else pixels[..., :3]
+    return rgba
+
+
+def build_atlases(material_exports: Iterable, objects: Iterable[bpy.types.Object], max_size: int, atlas_size: int = ATLAS_SIZE) -> Dict[bpy.types.Material, Atlas]:
+    """
+    Pack the small non-tiling diffuse textures of the materials into atlas images
+    and rewrite the UVs of the faces using them to their atlas regions.
+    Returns material -> atlas for all materials that use an atlas now.
+    The atlas images are new Blender images, the caller removes them when saved.
+    """
+    candidates = {}
+    for m in material_exports:
+        image = atlas_candidate(m, max_size)
+        if image is not None:
+            candidates[m.material] = image
+
+    # faces that use a candidate have to stay inside its image, otherwise it tiles
+    meshes = {}
+    for obj in objects:
+        if obj.type != 'MESH' or obj.data in meshes:
+            continue
+        corner_materials, slots = loop_materials(obj)
+        uvs = read_uvs(obj.data)
+        meshes[obj.data] = (corner_materials, slots, uvs)
+        for slot_index, material in enumerate(slots):
+            if material not in candidates:
+                continue
+            used = corner_materials == slot_index
+            if not used.any():
+                continue
+            if uvs is None or ((uvs[used] < -UV_EPSILON) | (uvs[used] > 1 + UV_EPSILON)).any():
+                log.debug(f'{material.name} is used with tiling UVs')
+                del candidates[material]
+
+    images = set(candidates.values())
+    if len(images) < 2:
+        return {}
+
+    atlases = {}
+    packed = pack_shelves({image: tuple(image.size) for image in images}, atlas_size)
+    for n, positions in enumerate(packed):
+        atlas = Atlas(name=f'atlas_{n}')
+        for image, (x, y) in positions.items():
+            width, height = image.size
+            atlas.regions[image] = AtlasRegion(image, x, y, width, height)
+            atlas.width = max(atlas.width, x + width + PADDING)
+            atlas.height = max(atlas.height, y + height + PADDING)
+
+        pixels = np.zeros((atlas.height, atlas.width, 4), dtype=np.float32)
+        for image, region in atlas.regions.items():
+            padded = np.pad(read_rgba(image), ((PADDING, PADDING), (PADDING, PADDING), (0, 0)), mode='edge')
+            pixels[region.y - PADDING:region.y + region.height + PADDING, region.x - PADDING:region.x + region.width + PADDING] = padded
+
+        atlas.image = bpy.data.images.new(atlas.name, atlas.width, atlas.height, alpha=True)
+        atlas.image.file_format = 'PNG'
+        atlas.image.pixels.foreach_set(pixels.ravel())
+        for image in atlas.regions:
+            atlases[image] = atlas
+        log.info(f'{atlas.name}: {len(atlas.regions)} textures, {atlas.width}x{atlas.height}')
+
+    # move the UVs into the regions, once per mesh
+    for mesh, (corner_materials, slots, uvs) in meshes.items():
+        changed = False
+        for slot_index, material in enumerate(slots):
+            if material not in candidates:
+                continue
+            image = candidates[material]
+            used = corner_materials == slot_index
+            if not used.any():
+                continue
+            scale_u, scale_v, offset_u, offset_v = atlases[image].uv_transform(image)
+            uvs[used] = uvs[used] * (scale_u, scale_v) + (offset_u, offset_v)
+            changed = True
+        if changed:
+            mesh.uv_layers.active.data.foreach_set('uv', uvs.ravel())
+            mesh.update()
+
+    return {material: atlases[image] for material, image in candidates.items()}
@@ -0,0 +1,74 @@
+import hashlib
+import logging
+import os
+from typing import Dict, Optional
+
+import bpy
+import numpy as np
+
+from io_mesh_roomle.material_exporter._roomle_material_csv import CsvHeaders, MaterialDefinition, RoomleMaterialsCsv
+
+log = logging.getLogger('material dedup')
+
+# columns that name a material but do not change how it looks
+IDENTITY_COLUMNS = {'material_id', 'label_en', 'label_de'}
+
+
+def image_digest(image: bpy.types.Image) -> str:
+    """content hash of an image: its packed or file bytes, or its pixels if it has unsaved changes"""
+    digest = hashlib.sha1()
+    path = bpy.path.abspath(image.filepath_raw) if image.filepath_raw else ''
+    if image.packed_file is not None and not image.is_dirty:
+        digest.update(image.packed_file.data)
+    elif path and os.path.isfile(path) and not image.is_dirty:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    else:
+        pixels = np.empty(len(image.pixels), dtype=np.float32)
+        image.pixels.foreach_get(pixels)
+        digest.update(str(tuple(image.size)).encode())
+        digest.update(pixels.tobytes())
+    return digest.hexdigest()
+
+
+class MaterialDeduplicator:
+    """
+    Collapses materials whose definitions only differ in their id and labels
+    and whose textures have the same content (e.g. `Wood`, `Wood.001`, ...).
+    The first material of a kind is canonical, the others become aliases.
+    """
+
+    def __init__(self) -> None:
+        # material id -> canonical material id
+        self.aliases: Dict[str, str] = {}
+        self._canonical: Dict[str, str] = {}
+        self._digests: Dict[int, str] = {}
+
+    def digest(self, image: bpy.types.Image) -> str:
+        key = image.as_pointer()
+        if key not in self._digests:
+            self._digests[key] = image_digest(image)
+        return self._digests[key]
+
+    def key(self, definition: MaterialDefinition, images: Dict[str, bpy.types.Image]) -> str:
+        """the definition's csv row without identity columns and texture names replaced by content hashes"""
+        textures = {f'zip://{name}': self.digest(image) for name, image in images.items()}
+        row = RoomleMaterialsCsv.csv_row(definition)
+        return '\x1f'.join(
+            '' if label in IDENTITY_COLUMNS else textures.get(value, value)
+            for label, value in zip(CsvHeaders.ordered_labels, row)
+        )
+
+    def add(self, definition: MaterialDefinition, images: Dict[str, bpy.types.Image]) -> Optional[str]:
+        """
+        Register a material with its textures (file name -> image).
+        Returns the canonical material id if it is a duplicate, `None` if not.
+        """
+        key = self.key(definition, images)
+        canonical = self._canonical.setdefault(key, definition.material_id)
+        if canonical == definition.material_id:
+            return None
+        log.debug(f'{definition.material_id} is a duplicate of {canonical}')
+        self.aliases[definition.material_id] = canonical
+        return canonical
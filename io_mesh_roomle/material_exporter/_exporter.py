@@ -43,24 +43,24 @@ class TextureNameManager:
         # filename : imagenode_id
         self.names = {}
 
-    def validate_name(self, image: ObjectToRegister) -> str:
+    def validate_name(self, image: ObjectToRegister, file_format: str = None) -> str:
         """returns a valid name by checking the requested name against already used ones.
         also registers the name in the class dictionaries
 
         Args:
             image (bpy.types.Image): the image node to check
-            name_to_use (str): the desired name
+            file_format (str): the format the image is exported in, defaults to its own
 
         Returns:
             str: a valid filename without the path
         """
         if image is None:
             return None
-        file_format = image.file_format
+        file_format = file_format or image.file_format
         if not file_format in SUPPORTED_TEXTURE_FILE_FORMATS:
             raise Exception(f'unsupported texture type {file_format}')
 
-        suffix = SUPPORTED_TEXTURE_FILE_FORMATS[image.file_format]
+        suffix = SUPPORTED_TEXTURE_FILE_FORMATS[file_format]
         if image.name.endswith(suffix):
             name_to_use = image.name
         else:
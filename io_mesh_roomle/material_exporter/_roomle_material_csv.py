@@ -2,9 +2,10 @@ from pathlib import Path
 from abc import ABC
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Union
+from typing import Dict, List, Optional, Union
 import json
 import csv
+import io
 
 import logging
 
@@ -182,13 +183,52 @@ class RoomleMaterialsCsv:
     def add_material_definition(self, definition: MaterialDefinition):
         self.lines.append(definition)
 
+    @staticmethod
+    def csv_row(line: CsvLine) -> List[str]:
+        """the line as the strings it is written (and read back) as"""
+        return ['' if value is None else str(value) for value in line.print_line()]
+
+    @staticmethod
+    def parse_rows(text: str) -> Dict[str, List[str]]:
+        """
+        Material rows of an existing csv keyed by material_id, in file order.
+        Columns are matched by their header label, missing ones are left empty.
+        """
+        reader = csv.reader(io.StringIO(text), delimiter=',')
+        header = next(reader, None)
+        if not header:
+            return {}
+        rows = {}
+        for row in reader:
+            if not row:
+                continue
+            values = dict(zip(header, row))
+            rows[values.get('material_id', '')] = [values.get(label, '') for label in CsvHeaders.ordered_labels]
+        return rows
+
+    def to_text(self, existing_rows: Optional[Dict[str, List[str]]] = None) -> str:
+        """
+        The csv text. With `existing_rows` (see `parse_rows`) the materials are upserted:
+        rows of known material ids are replaced in place, new materials are appended.
+        """
+        header, *definitions = self.lines
+        if existing_rows is None:
+            arr = [x.print_line() for x in self.lines]
+        else:
+            rows = dict(existing_rows)
+            for definition in definitions:
+                rows[definition.material_id] = self.csv_row(definition)
+            arr = [header.print_line()] + list(rows.values())
+        csv_file = io.StringIO()
+        csv_writer = csv.writer(csv_file, delimiter=',')
+        csv_writer.writerows(arr)
+        return csv_file.getvalue()
+
     def write(self, csv_path:Path):
         assert str(csv_path).lower().endswith('.csv')
         csv_path.parent.mkdir(exist_ok=True)
-        arr = [x.print_line() for x in self.lines]
         with open(csv_path, 'w', encoding='utf-8') as csv_file:
-            csv_writer = csv.writer(csv_file, delimiter=',')
-            csv_writer.writerows(arr)
+            csv_file.write(self.to_text())
 
 
 
@@ -0,0 +1,199 @@
+import logging
+import os
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import bpy
+import numpy as np
+
+from io_mesh_roomle.enums import SUPPORTED_TEXTURE_FILE_FORMATS
+from io_mesh_roomle.material_exporter._atlas import read_rgba
+from io_mesh_roomle.material_exporter.utils.image_metrics import psnr, ssim
+
+log = logging.getLogger('texture transcode')
+
+# how the textures of a pbr channel may be encoded
+LOSSY = 'LOSSY'
+NEAR_LOSSLESS = 'NEAR_LOSSLESS'     # lossy WebP against a strict target, PNG otherwise
+LOSSLESS = 'LOSSLESS'
+
+CHANNEL_POLICIES = {
+    'diffuse': LOSSY,
+    'roughness': LOSSY,             # the ORM map
+    'normal': NEAR_LOSSLESS,        # block artifacts show up as bumps in the shading
+}
+
+METRICS: Dict[str, Callable[[np.ndarray, np.ndarray], float]] = {
+    'SSIM': ssim,
+    'PSNR': psnr,
+}
+
+# target of the NEAR_LOSSLESS policy, or the user's target if it is stricter
+NEAR_LOSSLESS_TARGETS = {
+    'SSIM': 0.995,
+    'PSNR': 45.0,
+}
+
+MIN_QUALITY = 30
+MAX_QUALITY = 98
+
+
+@dataclass
+class TextureReport:
+    """what the transcoding stage decided for one texture"""
+    name: str
+    channel: str
+    format: str = ''
+    quality: int = 0                # 0: not re-encoded lossy
+    metric: str = ''
+    score: Optional[float] = None   # metric of the chosen encoding against the original pixels
+    original_bytes: int = 0
+    bytes: int = 0
+
+    @property
+    def saved_bytes(self) -> int:
+        return self.original_bytes - self.bytes
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data['saved_bytes'] = self.saved_bytes
+        return data
+
+
+@dataclass
+class TranscodedTexture:
+    file_format: str
+    data: Optional[bytes]           # None: the image is saved as it is
+    report: TextureReport
+
+
+def texture_channels(material_exports: Iterable) -> Dict[bpy.types.Image, str]:
+    """image -> pbr channel it is used for, by the first material that uses it"""
+    channels = {}
+    for m in material_exports:
+        for channel in CHANNEL_POLICIES:
+            image = getattr(m.pbr, channel).map
+            if isinstance(image, bpy.types.Image):
+                channels.setdefault(image, channel)
+    return channels
+
+
+def original_size(image: bpy.types.Image) -> int:
+    """bytes of the image as it would be exported without transcoding, 0 if unknown"""
+    if image.packed_file is not None and not image.is_dirty:
+        return image.packed_file.size
+    path = bpy.path.abspath(image.filepath_raw) if image.filepath_raw else ''
+    if path and os.path.isfile(path) and not image.is_dirty:
+        return os.path.getsize(path)
+    return 0
+
+
+class ImageProbe:
+    """
+    Encodes the pixels of an image with different formats and qualities
+    and decodes the result again to measure it against the original
+    """
+
+    def __init__(self, image: bpy.types.Image, directory: str) -> None:
+        self.directory = directory
+        self.pixels = read_rgba(image)
+        self.has_alpha = bool((self.pixels[..., 3] < 1).any())
+        self.colorspace = image.colorspace_settings.name
+        width, height = image.size
+        self.image = bpy.data.images.new(f'probe_{image.name}', width, height, alpha=self.has_alpha)
+        self.image.colorspace_settings.name = self.colorspace
+        self.image.pixels.foreach_set(self.pixels.ravel())
+
+    def encode(self, file_format: str, quality: int) -> bytes:
+        path = os.path.join(self.directory, 'probe' + SUPPORTED_TEXTURE_FILE_FORMATS[file_format])
+        self.image.filepath_raw = path
+        self.image.file_format = file_format
+        self.image.save(filepath=path, quality=quality)
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def decode(self, data: bytes, file_format: str) -> np.ndarray:
+        path = os.path.join(self.directory, 'decoded' + SUPPORTED_TEXTURE_FILE_FORMATS[file_format])
+        with open(path, 'wb') as f:
+            f.write(data)
+        decoded = bpy.data.images.load(path, check_existing=False)
+        try:
+            decoded.colorspace_settings.name = self.colorspace
+            return read_rgba(decoded)
+        finally:
+            bpy.data.images.remove(decoded)
+
+    def measure(self, file_format: str, quality: int, metric: str) -> Tuple[float, bytes]:
+        data = self.encode(file_format, quality)
+        channels = 4 if self.has_alpha else 3
+        decoded = self.decode(data, file_format)
+        return METRICS[metric](self.pixels[..., :channels], decoded[..., :channels]), data
+
+    def remove(self):
+        bpy.data.images.remove(self.image)
+
+
+def search_quality(measure: Callable[[int], Tuple[float, bytes]], target: float, low: int = MIN_QUALITY, high: int = MAX_QUALITY) -> Optional[Tuple[int, float, bytes]]:
+    """
+    Binary search for the lowest quality whose score reaches the target,
+    assuming the score grows with the quality. Returns (quality, score, data) or `None`.
+    """
+    best = None
+    while low <= high:
+        quality = (low + high) // 2
+        score, data = measure(quality)
+        if score >= target:
+            best = (quality, score, data)
+            high = quality - 1
+        else:
+            low = quality + 1
+    return best
+
+
+def transcode_image(image: bpy.types.Image, channel: str, directory: str, texture_format: str = 'WEBP', texture_metric: str = 'SSIM', texture_target_ssim: float = 0.98, texture_target_psnr: float = 40.0, **keywords) -> TranscodedTexture:
+    """
+    Encode the image by the policy of its channel with the lowest quality that reaches the target.
+    The image keeps its original file if that is smaller or no encoding reaches the target.
+    """
+    target = texture_target_ssim if texture_metric == 'SSIM' else texture_target_psnr
+    policy = CHANNEL_POLICIES[channel]
+    report = TextureReport(name=image.name, channel=channel, metric=texture_metric, original_bytes=original_size(image))
+    keep = TranscodedTexture(image.file_format, None, report)
+
+    probe = ImageProbe(image, directory)
+    try:
+        file_format = texture_format
+        # JPEG has no alpha channel
+        if file_format == 'JPEG' and probe.has_alpha:
+            policy = LOSSLESS
+        if policy == NEAR_LOSSLESS:
+            if file_format == 'WEBP':
+                target = max(target, NEAR_LOSSLESS_TARGETS[texture_metric])
+            else:
+                policy = LOSSLESS
+
+        if policy == LOSSLESS:
+            file_format, quality, score = 'PNG', 0, None
+            data = probe.encode(file_format, 100)
+        else:
+            found = search_quality(lambda q: probe.measure(file_format, q, texture_metric), target)
+            if found is None:
+                log.debug(f'{image.name}: {file_format} does not reach {texture_metric} {target}')
+                report.format, report.bytes = image.file_format, report.original_bytes
+                return keep
+            quality, score, data = found
+
+        if not report.original_bytes:
+            # generated or modified image, it would be saved as PNG otherwise
+            report.original_bytes = len(data) if file_format == 'PNG' else len(probe.encode('PNG', 100))
+    finally:
+        probe.remove()
+
+    if len(data) >= report.original_bytes:
+        report.format = image.file_format
+        report.bytes = report.original_bytes
+        return keep
+
+    report.format, report.quality, report.score, report.bytes = file_format, quality, score, len(data)
+    log.info(f'{image.name}: {file_format} q{quality}, {report.original_bytes} -> {report.bytes} bytes')
+    return TranscodedTexture(file_format, data, report)
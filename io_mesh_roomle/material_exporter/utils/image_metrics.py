@@ -0,0 +1,48 @@
+import numpy as np
+
+
+def psnr(reference: np.ndarray, test: np.ndarray) -> float:
+    """peak signal to noise ratio in dB of two images with values 0...1"""
+    mse = float(np.mean((np.asarray(reference, dtype=np.float32) - np.asarray(test, dtype=np.float32)) ** 2))
+    if mse == 0:
+        return float('inf')
+    return 10 * np.log10(1 / mse)
+
+
+def box_mean(x: np.ndarray, size: int) -> np.ndarray:
+    """mean of every `size` x `size` window (valid windows only), from an integral image"""
+    integral = np.pad(x, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+    window = (
+        integral[size:, size:]
+        - integral[:-size, size:]
+        - integral[size:, :-size]
+        + integral[:-size, :-size]
+    )
+    return window / (size * size)
+
+
+def ssim(reference: np.ndarray, test: np.ndarray, window: int = 7) -> float:
+    """
+    Mean structural similarity of two (height, width, channels) images with values 0...1,
+    with a uniform window, averaged over the channels
+    """
+    reference = np.asarray(reference, dtype=np.float64)
+    test = np.asarray(test, dtype=np.float64)
+    if reference.ndim == 2:
+        reference, test = reference[..., None], test[..., None]
+    size = max(1, min(window, reference.shape[0], reference.shape[1]))
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+
+    values = []
+    for channel in range(reference.shape[2]):
+        a, b = reference[..., channel], test[..., channel]
+        mu_a, mu_b = box_mean(a, size), box_mean(b, size)
+        var_a = box_mean(a * a, size) - mu_a * mu_a
+        var_b = box_mean(b * b, size) - mu_b * mu_b
+        covariance = box_mean(a * b, size) - mu_a * mu_b
+        ssim_map = (
+            (2 * mu_a * mu_b + c1) * (2 * covariance + c2)
+            / ((mu_a * mu_a + mu_b * mu_b + c1) * (var_a + var_b + c2))
+        )
+        values.append(ssim_map.mean())
+    return float(np.mean(values))
@@ -0,0 +1,411 @@
+# -----------------------------------------------------------------------
+#
+#  Copyright 2019 Roomle GmbH. All Rights Reserved.
+#
+#  This Software is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND.
+#
+#  NOTICE: All information contained herein is, and remains
+#  the property of Roomle. The intellectual and technical concepts contained
+#  herein are proprietary to Roomle and are protected by copyright law.
+#  Dissemination of this information or reproduction of this material
+#  is strictly forbidden unless prior written permission is obtained
+#  from Roomle.
+# -----------------------------------------------------------------------
+
+"""
+Encoding of mesh arrays into Roomle script commands, without Blender.
+
+Blender's main thread only extracts the meshes into shared memory, the
+`AddMesh` text is produced by worker processes running this file as a
+script: `python mesh_encoder.py` reads one job per line from stdin (JSON
+naming the shared memory blocks and the encoding parameters) and answers
+with a JSON header line followed by the encoded bytes on stdout.
+The script holds a placeholder per job, the results are stitched in in
+the order of the placeholders, which is the order of the hierarchy.
+"""
+
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+
+from dataclasses import dataclass
+from math import floor, log10
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+ENCODED_PATTERN = re.compile(r'/\*@encoded (\d+)\*/')
+
+
+@dataclass
+class PrecisionChoice:
+    precision: int      # decimal digits after the point
+    error: float        # max distance between exact and printed positions
+
+
+def rounding_error(coords: np.ndarray, precision: int) -> float:
+    """max distance between (n,3) positions and the same positions rounded to `precision` digits"""
+    if len(coords) == 0:
+        return 0.0
+    coords = np.asarray(coords, dtype=np.float64)
+    return float(np.linalg.norm(np.round(coords, precision) - coords, axis=1).max())
+
+
+def choose_precision(coords: np.ndarray, tolerance: float, min_precision: int = 0, max_precision: int = 4) -> PrecisionChoice:
+    """
+    The coarsest decimal precision that keeps the max positional error within `tolerance`.
+    If even `max_precision` does not, that is used.
+    """
+    for precision in range(min_precision, max_precision + 1):
+        error = rounding_error(coords, precision)
+        if error <= tolerance:
+            break
+    return PrecisionChoice(precision, error)
+
+
+def smooth_normals(positions: np.ndarray, triangles: np.ndarray) -> np.ndarray:
+    """
+    Area weighted vertex normals over the given triangles, as a runtime derives them
+    for meshes without normals. Vertices without area get a zero normal.
+    """
+    corners = positions[triangles]
+    face_normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    normals = np.zeros_like(positions)
+    for corner in range(3):
+        np.add.at(normals, triangles[:, corner], face_normals)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    return np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+
+
+def normal_deviation(normals: np.ndarray, reference: np.ndarray) -> float:
+    """largest angle between two sets of normals in degrees, zero normals count as 180"""
+    if len(normals) == 0:
+        return 0.0
+    lengths = np.linalg.norm(normals, axis=1) * np.linalg.norm(reference, axis=1)
+    dots = np.einsum('ij,ij->i', normals, reference)
+    cosines = np.divide(dots, lengths, out=np.full_like(dots, -1.0), where=lengths > 0)
+    return float(np.degrees(np.arccos(np.clip(cosines.min(), -1.0, 1.0))))
+
+
+def transform_normals(normals: np.ndarray, linear: np.ndarray) -> np.ndarray:
+    """normals of positions transformed by the 3x3 `linear`: through its inverse transpose, unit length"""
+    normals = np.asarray(normals, dtype=np.float64) @ np.linalg.inv(linear)
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    return np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+
+
+def format_floats(values: np.ndarray, precision: int) -> List[str]:
+    """`floatFormat` of every value: rounded to `precision` digits, without trailing zeros"""
+    texts = np.char.mod(f'%.{precision}f', np.asarray(values, dtype=np.float64)).tolist()
+    if precision > 0:
+        texts = [text.rstrip('0').rstrip('.') for text in texts]
+    return ['0' if text == '-0' else text for text in texts]
+
+
+def format_vectors(rows: np.ndarray, precision: int) -> str:
+    """`{x,y,z},...` of the rows"""
+    columns = [format_floats(rows[:, k], precision) for k in range(rows.shape[1])]
+    return ','.join('{' + ','.join(values) + '}' for values in zip(*columns))
+
+
+def uv_precision(uvs: np.ndarray, uv_float_precision: int) -> int:
+    """digits of UVs, fewer the bigger the largest UV is"""
+    maxvalue = max(1.0, float(np.abs(uvs).max())) if len(uvs) else 1.0
+    return max(0, uv_float_precision - floor(log10(maxvalue)))
+
+
+def encode_add_mesh(arrays: Dict[str, np.ndarray], params: dict) -> Tuple[bytes, dict]:
+    """
+    `AddMesh` command of a welded mesh.
+
+    arrays: `positions` and `normals` per source vertex, `sources` (source vertex of every
+    exported vertex), `indices` (triangles of exported vertices) and optional `uvs` per exported vertex
+    params: `matrix` (4x4 to script space), `normal_linear` (3x3 scale and applied rotation),
+    `bake_normals` (transform the exported normals by `normal_linear` too),
+    `precision` or `tolerance` of positions, `uv_float_precision`, `normal_float_precision`,
+    `export_normals`, `elide_normals`, `normal_tolerance` and the `comment` before the command
+    Returns the command and what was decided (precision, position error, normals, normal deviation).
+    """
+    sources = arrays['sources']
+    positions = arrays['positions'][sources].astype(np.float64)
+    # flipped triangle order, as in the in-memory export
+    triangles = np.asarray(arrays['indices'], dtype=np.int64).reshape(-1, 3)[:, (0, 2, 1)]
+    normals = -arrays['normals'][sources].astype(np.float64)
+    uvs = arrays.get('uvs')
+
+    matrix = np.array(params['matrix'], dtype=np.float64)
+    coords = positions @ matrix[:3, :3].T + matrix[:3, 3]
+
+    # leave out normals the runtime would calculate (almost) identically
+    export_normals = params['export_normals']
+    linear = np.array(params['normal_linear'], dtype=np.float64)
+    reference = None
+    if params.get('bake_normals'):
+        # baked transforms: the normals are turned here instead of by the runtime
+        normals = reference = transform_normals(normals, linear)
+
+    deviation = None
+    if export_normals and params['elide_normals'] and len(triangles):
+        if reference is None:
+            reference = normals @ np.linalg.inv(linear)
+        deviation = normal_deviation(smooth_normals(positions @ linear.T, triangles), reference)
+        if deviation <= params['normal_tolerance']:
+            export_normals = False
+
+    if params['tolerance'] is None:
+        precision = params['precision']
+        error = rounding_error(coords, precision)
+    else:
+        choice = choose_precision(coords, params['tolerance'])
+        precision, error = choice.precision, choice.error
+
+    parts = [params['comment'], 'AddMesh(Vector3f[', format_vectors(coords, precision), '],[']
+    parts.append(','.join(map(str, triangles.ravel().tolist())))
+    parts.append(']')
+    if uvs is not None and len(uvs):
+        parts += [',Vector2f[', format_vectors(uvs, uv_precision(uvs, params['uv_float_precision'])), ']']
+    if export_normals:
+        parts += [',Vector3f[', format_vectors(normals, params['normal_float_precision']), ']']
+    parts.append(');\n')
+
+    decisions = {
+        'precision': precision,
+        'position_error': round(error, 4),
+        'normals': 'EXPORTED' if export_normals else ('ELIDED' if deviation is not None else ''),
+        'normal_deviation': None if deviation is None else round(deviation, 3),
+    }
+    return ''.join(parts).encode('utf-8'), decisions
+
+
+def attach(name: str) -> shared_memory.SharedMemory:
+    """open a block created by another process, without taking over its cleanup"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before Python 3.13 every attaching process registers the block for unlinking
+        from multiprocessing import resource_tracker
+        block = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(block._name, 'shared_memory')
+        return block
+
+
+def run_job(job: dict) -> Tuple[bytes, dict]:
+    blocks = {role: attach(spec['name']) for role, spec in job['arrays'].items()}
+    arrays = {
+        role: np.ndarray(tuple(spec['shape']), dtype=np.dtype(spec['dtype']), buffer=blocks[role].buf)
+        for role, spec in job['arrays'].items()
+    }
+    try:
+        return encode_add_mesh(arrays, job['params'])
+    finally:
+        arrays.clear()
+        for block in blocks.values():
+            block.close()
+
+
+def serve(stdin=None, stdout=None):
+    """worker loop: one job per line until stdin is closed"""
+    stdin = stdin or sys.stdin.buffer
+    stdout = stdout or sys.stdout.buffer
+    for line in stdin:
+        try:
+            data, decisions = run_job(json.loads(line))
+        except Exception as e:
+            data, decisions = b'', {'error': repr(e)}
+        decisions['length'] = len(data)
+        stdout.write(json.dumps(decisions).encode('utf-8') + b'\n')
+        stdout.write(data)
+        stdout.flush()
+
+
+class EncodeJob:
+    """
+    Arrays of one mesh in shared memory. `array` has the interface of the
+    out-of-core store, so meshes can be extracted straight into shared memory.
+    """
+
+    def __init__(self) -> None:
+        self._blocks: List[shared_memory.SharedMemory] = []
+        self._owned: Dict[int, Tuple[np.ndarray, shared_memory.SharedMemory]] = {}
+        self.roles: Dict[str, dict] = {}
+
+    def array(self, shape, dtype) -> np.ndarray:
+        dtype = np.dtype(dtype)
+        size = max(1, int(np.prod(shape)) * dtype.itemsize)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        self._blocks.append(block)
+        array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        array.fill(0)
+        self._owned[id(array)] = (array, block)
+        return array
+
+    def share(self, role: str, array: np.ndarray):
+        """hand an array to the worker, arrays not created by `array` are copied once"""
+        if id(array) in self._owned:
+            block = self._owned[id(array)][1]
+        else:
+            shared = self.array(array.shape, array.dtype)
+            shared[...] = array
+            block = self._owned[id(shared)][1]
+        self.roles[role] = {'name': block.name, 'shape': list(array.shape), 'dtype': np.dtype(array.dtype).str}
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        by_name = {block.name: block for block in self._blocks}
+        return {
+            role: np.ndarray(tuple(spec['shape']), dtype=np.dtype(spec['dtype']), buffer=by_name[spec['name']].buf)
+            for role, spec in self.roles.items()
+        }
+
+    def release(self):
+        self._owned.clear()
+        for block in self._blocks:
+            try:
+                block.close()
+            except BufferError:
+                # still viewed by an array, the memory goes with it
+                pass
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+        self._blocks.clear()
+
+
+class ParallelEncoder:
+    """
+    Pool of worker processes encoding `AddMesh` commands.
+    `submit` returns a placeholder for the script, `stitch` replaces the
+    placeholders by the encoded commands. Without a Python executable to
+    start workers with, the jobs are encoded in this process.
+    """
+
+    def __init__(self, workers: Optional[int] = None, python: Optional[str] = None) -> None:
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.python = python or sys.executable
+        self._processes: List[subprocess.Popen] = []
+        self._threads: List[threading.Thread] = []
+        self._pending: List[Tuple[int, EncodeJob, dict]] = []
+        self._jobs: Dict[int, Tuple[EncodeJob, Optional[Callable[[dict], None]]]] = {}
+        self._results: Dict[int, Tuple[bytes, dict]] = {}
+        self._condition = threading.Condition()
+        # jobs in flight, bounds the shared memory held at once
+        self._slots = threading.Semaphore(2 * self.workers)
+        self._started = False
+        self._closing = False
+
+    def _start(self):
+        self._started = True
+        try:
+            for _ in range(self.workers):
+                process = subprocess.Popen(
+                    [self.python, os.path.abspath(__file__)],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                )
+                thread = threading.Thread(target=self._serve, args=(process,), daemon=True)
+                self._processes.append(process)
+                self._threads.append(thread)
+                thread.start()
+        except OSError:
+            self.close()
+            self._processes, self._threads = [], []
+
+    def _next(self) -> Optional[Tuple[int, EncodeJob, dict]]:
+        with self._condition:
+            while not self._pending:
+                if self._closing:
+                    return None
+                self._condition.wait()
+            return self._pending.pop(0)
+
+    def _serve(self, process: subprocess.Popen):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            number, job, params = item
+            try:
+                process.stdin.write(json.dumps({'arrays': job.roles, 'params': params}).encode('utf-8') + b'\n')
+                process.stdin.flush()
+                decisions = json.loads(process.stdout.readline())
+                data = process.stdout.read(decisions['length'])
+            except Exception as e:
+                data, decisions = b'', {'error': repr(e)}
+            self._finish(number, job, data, decisions)
+
+    def _finish(self, number: int, job: EncodeJob, data: bytes, decisions: dict):
+        job.release()
+        self._slots.release()
+        with self._condition:
+            self._results[number] = (data, decisions)
+            self._condition.notify_all()
+
+    def submit(self, job: EncodeJob, params: dict, on_done: Optional[Callable[[dict], None]] = None) -> str:
+        """queue a job, `on_done` is called with the decisions when it is stitched"""
+        if not self._started:
+            self._start()
+        number = len(self._jobs)
+        self._jobs[number] = (job, on_done)
+        self._slots.acquire()
+        if not self._processes:
+            try:
+                data, decisions = encode_add_mesh(job.arrays(), params)
+            except Exception as e:
+                data, decisions = b'', {'error': repr(e)}
+            self._finish(number, job, data, decisions)
+        else:
+            with self._condition:
+                self._pending.append((number, job, params))
+                self._condition.notify_all()
+        return f'/*@encoded {number}*/'
+
+    def result(self, number: int) -> Tuple[bytes, dict]:
+        with self._condition:
+            while number not in self._results:
+                self._condition.wait()
+            return self._results.pop(number)
+
+    def stitch(self, script: str) -> str:
+        """the script with every placeholder replaced by its encoded command"""
+        def replace(match):
+            number = int(match.group(1))
+            data, decisions = self.result(number)
+            if 'error' in decisions:
+                raise Exception(f'mesh encoding failed: {decisions["error"]}')
+            on_done = self._jobs[number][1]
+            if on_done is not None:
+                on_done(decisions)
+            return data.decode('utf-8')
+        return ENCODED_PATTERN.sub(replace, script)
+
+    def close(self):
+        with self._condition:
+            # cancelled exports leave jobs behind
+            self._closing = True
+            self._pending.clear()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        for process in self._processes:
+            process.stdin.close()
+            process.wait()
+            process.stdout.close()
+        for job, _ in self._jobs.values():
+            job.release()
+        self._jobs.clear()
+        self._results.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,185 @@
+# -----------------------------------------------------------------------
+# 
+#  Copyright 2019 Roomle GmbH. All Rights Reserved.
+# 
+#  This Software is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND.
+# 
+#  NOTICE: All information contained herein is, and remains
+#  the property of Roomle. The intellectual and technical concepts contained
+#  herein are proprietary to Roomle and are protected by copyright law.
+#  Dissemination of this information or reproduction of this material
+#  is strictly forbidden unless prior written permission is obtained
+#  from Roomle.
+# -----------------------------------------------------------------------
+
+import bpy
+import numpy as np
+
+from dataclasses import dataclass, asdict
+
+# pure numpy helpers, shared with the worker processes of the mesh encoder
+from .mesh_encoder import (
+    PrecisionChoice,
+    choose_precision,
+    normal_deviation,
+    rounding_error,
+    smooth_normals,
+)
+
+
+@dataclass
+class MeshStats:
+    """
+    Statistics of a modifier-evaluated mesh, as the exporter would see it
+    """
+    vertices: int = 0       # vertices used by faces (loose vertices are not exported)
+    triangles: int = 0
+    uv_splits: int = 0      # additional vertices created for UV seams
+    has_uvs: bool = False
+
+    @property
+    def exported_vertices(self) -> int:
+        return self.vertices + self.uv_splits
+
+    @property
+    def split_uvs(self) -> bool:
+        return self.uv_splits > 0
+
+
+@dataclass
+class CostWeights:
+    """
+    Tunable weights of the AUTO mesh placement cost model.
+    Sizes are in bytes, the weights scale what a byte of script or
+    external file costs relative to each other.
+    """
+    inline_weight: float = 1.0
+    external_weight: float = 1.0
+    # additional request and its latency, expressed in bytes
+    request_overhead_bytes: float = 6000.0
+    # compressed external mesh file size
+    external_vertex_bytes: float = 6.0
+    external_triangle_bytes: float = 2.0
+    # AddExternalMesh command in the script
+    external_command_bytes: float = 100.0
+
+
+@dataclass
+class PlacementEstimate:
+    inline_bytes: int
+    external_bytes: int
+    inline_cost: float
+    external_cost: float
+
+    @property
+    def extern(self) -> bool:
+        return self.external_cost < self.inline_cost
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data['extern'] = self.extern
+        return data
+
+
+def mean_index_digits(count: int) -> float:
+    """average number of decimal digits of the indices 0...count-1"""
+    if count <= 0:
+        return 0.0
+    digits = 0
+    lower, upper, d = 0, 10, 1
+    while lower < count:
+        digits += (min(upper, count) - lower) * d
+        lower, upper, d = upper, upper*10, d+1
+    return digits / count
+
+
+def collect_mesh_stats(obj: bpy.types.Object, depsgraph=None) -> MeshStats:
+    """
+    Evaluate the object's modifiers and count what the exporter would write
+    """
+    if depsgraph is None:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+
+    obj_eval = obj.evaluated_get(depsgraph)
+    mesh = obj_eval.to_mesh()
+    try:
+        mesh.calc_loop_triangles()
+
+        loop_vertices = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get('vertex_index', loop_vertices)
+        used_vertices = len(np.unique(loop_vertices))
+
+        stats = MeshStats(
+            vertices=used_vertices,
+            triangles=len(mesh.loop_triangles),
+        )
+
+        uv_layer = mesh.uv_layers.active
+        if uv_layer is not None and len(loop_vertices):
+            uvs = np.empty(len(mesh.loops)*2, dtype=np.float32)
+            uv_layer.data.foreach_get('uv', uvs)
+
+            # a vertex is duplicated for every distinct UV it is used with
+            corners = np.empty(len(loop_vertices), dtype=[('v', np.int32), ('u', np.float32), ('w', np.float32)])
+            corners['v'] = loop_vertices
+            corners['u'] = uvs[0::2]
+            corners['w'] = uvs[1::2]
+
+            stats.has_uvs = True
+            stats.uv_splits = len(np.unique(corners)) - used_vertices
+    finally:
+        obj_eval.to_mesh_clear()
+
+    return stats
+
+
+def cost_weights_from_args(**args) -> CostWeights:
+    weights = CostWeights()
+    if 'auto_request_overhead' in args:
+        weights.request_overhead_bytes = args['auto_request_overhead']
+    if 'auto_external_weight' in args:
+        weights.external_weight = args['auto_external_weight']
+    return weights
+
+
+def estimate_placement(
+    stats: MeshStats,
+    export_normals: bool = True,
+    uv_float_precision: int = 4,
+    normal_float_precision: int = 5,
+    weights: CostWeights = None,
+    **args
+) -> PlacementEstimate:
+    """
+    Estimate the inline `AddMesh` size against an external mesh file plus its request
+    """
+    if weights is None:
+        weights = cost_weights_from_args(**args)
+
+    vertices = stats.exported_vertices
+
+    # '{-123.4,56.7,8.9},' at 0.1mm precision
+    position_chars = 3*5.5 + 4
+    uv_chars = 2*(uv_float_precision + 2.5) + 4
+    normal_chars = 3*(normal_float_precision + 3) + 4
+    index_chars = mean_index_digits(vertices) + 1
+
+    inline_bytes = 20 + vertices*position_chars + stats.triangles*3*index_chars
+    if stats.has_uvs:
+        inline_bytes += vertices*uv_chars
+    if export_normals or stats.split_uvs:
+        inline_bytes += vertices*normal_chars
+
+    external_bytes = (
+        weights.external_command_bytes
+        + vertices*weights.external_vertex_bytes
+        + stats.triangles*weights.external_triangle_bytes
+    )
+
+    return PlacementEstimate(
+        inline_bytes=int(inline_bytes),
+        external_bytes=int(external_bytes),
+        inline_cost=inline_bytes*weights.inline_weight,
+        external_cost=external_bytes*weights.external_weight + weights.request_overhead_bytes,
+    )
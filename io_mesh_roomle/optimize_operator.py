@@ -17,8 +17,6 @@ import bpy
 
 from bpy.props import BoolProperty
 
-from .blender_utils import optimize_scene
-
 class OptimizeSceneOperator(bpy.types.Operator):
     # Tooltip
     """Optimize Roomle static"""
@@ -29,14 +27,17 @@ class OptimizeSceneOperator(bpy.types.Operator):
 
     center_scene: BoolProperty(name="Center Scene", description="center scene horizontally and place it on x-y plane vertically.", default=True)
     reset_transforms: BoolProperty(name="Reset Transforms", description="Remove hierarchy, apply scale/rotation/translation", default=True)
+    dry_run: BoolProperty(name="Dry Run", description="Only report what would change and the estimated vertex savings, without touching the scene", default=False)
 
     @classmethod
     def poll(cls, context):
         return context.scene is not None and context.mode=='OBJECT'
 
     def execute(self, context):
-        optimize_scene(center_scene=self.center_scene, reset_transforms=self.reset_transforms)
-        self.report({'INFO'},'Optimized!')
+        from .blender_utils import optimize_scene
+
+        report = optimize_scene(center_scene=self.center_scene, reset_transforms=self.reset_transforms, dry_run=self.dry_run)
+        self.report({'INFO'},report.summary() if self.dry_run else 'Optimized!')
         return {'FINISHED'}
 
 def register():
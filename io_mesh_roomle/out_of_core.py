@@ -0,0 +1,312 @@
+# -----------------------------------------------------------------------
+#
+#  Copyright 2019 Roomle GmbH. All Rights Reserved.
+#
+#  This Software is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND.
+#
+#  NOTICE: All information contained herein is, and remains
+#  the property of Roomle. The intellectual and technical concepts contained
+#  herein are proprietary to Roomle and are protected by copyright law.
+#  Dissemination of this information or reproduction of this material
+#  is strictly forbidden unless prior written permission is obtained
+#  from Roomle.
+# -----------------------------------------------------------------------
+
+"""
+Out-of-core export of huge inline meshes.
+
+The mesh arrays are staged in memory-mapped temporary files, welded and
+formatted chunk by chunk and the `AddMesh` command is streamed into a
+fragment file. The script only holds a placeholder for it, the fragments
+are copied into the script file when it is written.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, Optional, TextIO, Tuple
+
+import bpy
+import numpy as np
+
+from .mesh_encoder import format_vectors, rounding_error, transform_normals
+
+# triangles (or vertices) per processing step, bounds the memory of every step
+CHUNK_SIZE = 1 << 18
+# source vertices per welding bucket
+BUCKET_VERTICES = 1 << 18
+
+FRAGMENT_PATTERN = re.compile(r'/\*@fragment (\d+)\*/')
+
+_KEY = np.dtype([('vertex', np.int32), ('u', np.float32), ('v', np.float32)])
+_RECORD = np.dtype([('vertex', np.int32), ('u', np.float32), ('v', np.float32), ('corner', np.int64)])
+
+
+class OutOfCoreStore:
+    """
+    Temporary folder of one export holding memory-mapped arrays and script fragments
+    """
+
+    def __init__(self) -> None:
+        self._directory = tempfile.TemporaryDirectory(prefix='roomle_ooc_', ignore_cleanup_errors=True)
+        self._count = 0
+        self.fragments: Dict[int, str] = {}
+
+    def _path(self, suffix: str) -> str:
+        self._count += 1
+        return os.path.join(self._directory.name, f'{self._count}{suffix}')
+
+    def array(self, shape, dtype) -> np.ndarray:
+        """zero-filled array backed by a temporary file"""
+        if np.prod(shape) == 0:
+            return np.zeros(shape, dtype)
+        return np.memmap(self._path('.npy'), dtype=dtype, mode='w+', shape=shape)
+
+    @contextmanager
+    def fragment(self) -> Iterator[Tuple[str, TextIO]]:
+        """yields the placeholder to put into the script and the file to write its text into"""
+        path = self._path('.txt')
+        number = len(self.fragments)
+        with open(path, 'w', encoding='utf-8') as f:
+            yield f'/*@fragment {number}*/', f
+        self.fragments[number] = path
+
+    def write_script(self, sink, relpath: str, script: str):
+        """write the script into the sink, replacing placeholders by their fragments"""
+        if not self.fragments:
+            sink.write_text(relpath, script)
+            return
+        with sink.stage(relpath) as path:
+            with open(path, 'w', encoding='utf-8') as out:
+                position = 0
+                for match in FRAGMENT_PATTERN.finditer(script):
+                    out.write(script[position:match.start()])
+                    with open(self.fragments[int(match.group(1))], 'r', encoding='utf-8') as fragment:
+                        shutil.copyfileobj(fragment, out)
+                    position = match.end()
+                out.write(script[position:])
+
+    def close(self):
+        self.fragments.clear()
+        self._directory.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class MemoryStore:
+    """`OutOfCoreStore.array` in memory, for meshes that fit"""
+
+    def array(self, shape, dtype) -> np.ndarray:
+        return np.zeros(shape, dtype)
+
+
+@dataclass
+class StagedMesh:
+    positions: np.ndarray               # (vertices, 3)
+    normals: np.ndarray                 # (vertices, 3)
+    triangles: np.ndarray               # (triangles, 3) vertex indices
+    loops: np.ndarray                   # (triangles, 3) loop indices
+    uvs: Optional[np.ndarray] = None    # (loops, 2) of the active UV layer
+
+
+@dataclass
+class WeldedMesh:
+    sources: np.ndarray                 # source vertex of every exported vertex
+    uvs: Optional[np.ndarray]           # UV of every exported vertex
+    indices: np.ndarray                 # (triangles, 3) exported vertex indices
+    split_uvs: bool                     # vertices were duplicated for different UVs
+
+    @property
+    def vertex_count(self) -> int:
+        return len(self.sources)
+
+
+def iter_chunks(count: int, size: int = CHUNK_SIZE) -> Iterator[Tuple[int, int]]:
+    for start in range(0, count, size):
+        yield start, min(start + size, count)
+
+
+def evaluated_triangle_count(obj: bpy.types.Object, depsgraph=None) -> int:
+    """triangles of the modifier-evaluated mesh, without triangulating it"""
+    if depsgraph is None:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+    mesh = obj.evaluated_get(depsgraph).data
+    loop_total = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get('loop_total', loop_total)
+    return int((loop_total - 2).sum())
+
+
+def stage_mesh(mesh: bpy.types.Mesh, store: OutOfCoreStore) -> StagedMesh:
+    """copy what the export needs from the mesh into memory-mapped arrays"""
+    mesh.calc_loop_triangles()
+    vertex_count, triangle_count = len(mesh.vertices), len(mesh.loop_triangles)
+
+    staged = StagedMesh(
+        positions=store.array((vertex_count, 3), np.float32),
+        normals=store.array((vertex_count, 3), np.float32),
+        triangles=store.array((triangle_count, 3), np.int32),
+        loops=store.array((triangle_count, 3), np.int32),
+    )
+    mesh.vertices.foreach_get('co', staged.positions.reshape(-1))
+    mesh.vertices.foreach_get('normal', staged.normals.reshape(-1))
+    mesh.loop_triangles.foreach_get('vertices', staged.triangles.reshape(-1))
+    mesh.loop_triangles.foreach_get('loops', staged.loops.reshape(-1))
+
+    uv_layer = mesh.uv_layers.active
+    if uv_layer is not None:
+        staged.uvs = store.array((len(mesh.loops), 2), np.float32)
+        uv_layer.data.foreach_get('uv', staged.uvs.reshape(-1))
+    return staged
+
+
+def weld(staged: StagedMesh, store: OutOfCoreStore, bucket_vertices: int = BUCKET_VERTICES) -> WeldedMesh:
+    """
+    One exported vertex per distinct (vertex, UV) pair used by the triangles, like the
+    vertex variants of the in-memory export. The corners are bucket sorted by source vertex
+    first, so only the corners of one bucket are deduplicated in memory at a time.
+    Loose vertices are not exported.
+    """
+    triangle_count = len(staged.triangles)
+    buckets = max(1, -(-len(staged.positions) // bucket_vertices))
+
+    counts = np.zeros(buckets, dtype=np.int64)
+    for start, end in iter_chunks(triangle_count):
+        counts += np.bincount(staged.triangles[start:end].ravel() // bucket_vertices, minlength=buckets)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    cursors = offsets[:-1].copy()
+
+    records = store.array((triangle_count*3,), _RECORD)
+    for start, end in iter_chunks(triangle_count):
+        chunk = np.zeros((end - start)*3, dtype=_RECORD)
+        chunk['vertex'] = staged.triangles[start:end].ravel()
+        if staged.uvs is not None:
+            uvs = staged.uvs[staged.loops[start:end].ravel()]
+            chunk['u'], chunk['v'] = uvs[:, 0], uvs[:, 1]
+        chunk['corner'] = np.arange(start*3, end*3)
+
+        bucket = chunk['vertex'] // bucket_vertices
+        order = np.argsort(bucket, kind='stable')
+        chunk, bucket = chunk[order], bucket[order]
+        bounds = np.searchsorted(bucket, np.arange(buckets + 1))
+        for b in np.nonzero(np.diff(bounds))[0]:
+            n = bounds[b+1] - bounds[b]
+            records[cursors[b]:cursors[b] + n] = chunk[bounds[b]:bounds[b+1]]
+            cursors[b] += n
+
+    indices = store.array((triangle_count*3,), np.int32)
+    sources = store.array((triangle_count*3,), np.int32)
+    welded_uvs = None if staged.uvs is None else store.array((triangle_count*3, 2), np.float32)
+    count = distinct = 0
+    for b in range(buckets):
+        bucket = np.asarray(records[offsets[b]:offsets[b+1]])
+        if not len(bucket):
+            continue
+        keys = np.empty(len(bucket), dtype=_KEY)
+        for name in _KEY.names:
+            keys[name] = bucket[name]
+        unique, inverse = np.unique(keys, return_inverse=True)
+        n = len(unique)
+        indices[bucket['corner']] = count + inverse.ravel()
+        sources[count:count + n] = unique['vertex']
+        if welded_uvs is not None:
+            welded_uvs[count:count + n, 0] = unique['u']
+            welded_uvs[count:count + n, 1] = unique['v']
+        count += n
+        distinct += len(np.unique(unique['vertex']))
+
+    return WeldedMesh(
+        sources=sources[:count],
+        uvs=None if welded_uvs is None else welded_uvs[:count],
+        indices=indices.reshape(-1, 3),
+        split_uvs=count > distinct,
+    )
+
+
+def iter_positions(staged: StagedMesh, welded: WeldedMesh, matrix: np.ndarray) -> Iterator[np.ndarray]:
+    """transformed positions of the exported vertices, chunk by chunk"""
+    linear, offset = matrix[:3, :3], matrix[:3, 3]
+    for start, end in iter_chunks(welded.vertex_count):
+        yield staged.positions[welded.sources[start:end]].astype(np.float64) @ linear.T + offset
+
+
+def choose_chunked_precision(chunks: Iterable[np.ndarray], tolerance: float, min_precision: int = 0, max_precision: int = 4) -> Tuple[int, float]:
+    """`mesh_stats.choose_precision` over positions that come in chunks, returns (precision, error)"""
+    precisions = range(min_precision, max_precision + 1)
+    errors = dict.fromkeys(precisions, 0.0)
+    for chunk in chunks:
+        for precision in precisions:
+            errors[precision] = max(errors[precision], rounding_error(chunk, precision))
+    for precision in precisions:
+        if errors[precision] <= tolerance:
+            break
+    return precision, errors[precision]
+
+
+def max_abs(values: np.ndarray) -> float:
+    result = 0.0
+    for start, end in iter_chunks(len(values)):
+        result = max(result, float(np.abs(values[start:end]).max()))
+    return result
+
+
+def write_add_mesh(
+    out: TextIO,
+    staged: StagedMesh,
+    welded: WeldedMesh,
+    matrix: np.ndarray,
+    precision: int,
+    uv_precision: int,
+    normal_precision: int,
+    export_normals: bool,
+    normal_linear: Optional[np.ndarray] = None,
+):
+    """
+    stream the `AddMesh` command chunk by chunk, the normals are transformed
+    by `normal_linear` (3x3) if given
+    """
+    def write_chunks(texts):
+        for n, text in enumerate(texts):
+            if n:
+                out.write(',')
+            out.write(text)
+
+    out.write('AddMesh(Vector3f[')
+    write_chunks(format_vectors(positions, precision) for positions in iter_positions(staged, welded, matrix))
+    out.write('],[')
+    # flipped triangle order, as in the in-memory export
+    write_chunks(
+        ','.join(map(str, welded.indices[start:end][:, (0, 2, 1)].ravel().tolist()))
+        for start, end in iter_chunks(len(welded.indices))
+    )
+    out.write(']')
+
+    if welded.uvs is not None and welded.vertex_count:
+        out.write(',Vector2f[')
+        write_chunks(
+            format_vectors(welded.uvs[start:end], uv_precision)
+            for start, end in iter_chunks(welded.vertex_count)
+        )
+        out.write(']')
+
+    if export_normals:
+        out.write(',Vector3f[')
+        def normals(start, end):
+            chunk = -staged.normals[welded.sources[start:end]]
+            return chunk if normal_linear is None else transform_normals(chunk, normal_linear)
+
+        write_chunks(
+            format_vectors(normals(start, end), normal_precision)
+            for start, end in iter_chunks(welded.vertex_count)
+        )
+        out.write(']')
+
+    out.write(');\n')
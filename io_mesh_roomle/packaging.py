@@ -0,0 +1,152 @@
+# -----------------------------------------------------------------------
+# 
+#  Copyright 2019 Roomle GmbH. All Rights Reserved.
+# 
+#  This Software is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND.
+# 
+#  NOTICE: All information contained herein is, and remains
+#  the property of Roomle. The intellectual and technical concepts contained
+#  herein are proprietary to Roomle and are protected by copyright law.
+#  Dissemination of this information or reproduction of this material
+#  is strictly forbidden unless prior written permission is obtained
+#  from Roomle.
+# -----------------------------------------------------------------------
+
+import os
+import tempfile
+import zipfile
+
+from contextlib import contextmanager
+from pathlib import Path, PurePosixPath
+from typing import Optional, Union
+
+# already compressed formats, deflating them again only costs time
+STORED_SUFFIXES = {'.jpg', '.jpeg', '.webp', '.png', '.crt'}
+
+
+class DirectorySink:
+    """
+    Destination of all export artifacts (script, external meshes, materials),
+    addressed by paths relative to the script's folder.
+    Writes them as files, which is the default export layout.
+    """
+
+    def __init__(self, root: Union[str, Path]) -> None:
+        self.root = Path(root)
+
+    def path(self, relpath: str) -> Path:
+        path = self.root / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def exists(self, relpath: str) -> bool:
+        return (self.root / relpath).is_file()
+
+    def read_text(self, relpath: str) -> Optional[str]:
+        """content of a file that already exists in the destination, `None` if there is none"""
+        path = self.root / relpath
+        return path.read_text(encoding='utf-8') if path.is_file() else None
+
+    def write_text(self, relpath: str, text: str):
+        with open(self.path(relpath), 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def write_bytes(self, relpath: str, data: bytes):
+        self.path(relpath).write_bytes(data)
+
+    @contextmanager
+    def stage(self, relpath: str):
+        """
+        Yields a file system path for writers that can only write files
+        (Blender operators, image saving, corto). Whatever exists at that
+        path when the context exits is part of the export.
+        """
+        yield self.path(relpath)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        """export was cancelled, files written so far are left in place"""
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ZipSink(DirectorySink):
+    """
+    Streams all export artifacts into one zip archive as they are produced.
+    Text is deflated, already compressed formats are stored as they are.
+    Files that only Blender's writers can produce are moved into the archive
+    right after they are written, so there is never more than one of them on disk.
+    """
+
+    def __init__(self, archive_path: Union[str, Path]) -> None:
+        self.archive_path = Path(archive_path)
+        self.archive = zipfile.ZipFile(self.archive_path, 'w', compression=zipfile.ZIP_DEFLATED)
+        self._staging = tempfile.TemporaryDirectory(prefix='roomle_export_')
+        super().__init__(self._staging.name)
+        self._written = set()
+
+    @staticmethod
+    def compress_type(relpath: str) -> int:
+        if PurePosixPath(relpath).suffix.lower() in STORED_SUFFIXES:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def _claim(self, relpath: str) -> bool:
+        # shared meshes and textures can be produced more than once
+        relpath = PurePosixPath(relpath).as_posix()
+        if relpath in self._written:
+            return False
+        self._written.add(relpath)
+        return True
+
+    def exists(self, relpath: str) -> bool:
+        return PurePosixPath(relpath).as_posix() in self._written
+
+    def read_text(self, relpath: str) -> Optional[str]:
+        # every export creates a new archive
+        return None
+
+    def write_text(self, relpath: str, text: str):
+        self.write_bytes(relpath, text.encode('utf-8'))
+
+    def write_bytes(self, relpath: str, data: bytes):
+        if self._claim(relpath):
+            self.archive.writestr(relpath, data, compress_type=self.compress_type(relpath))
+
+    @contextmanager
+    def stage(self, relpath: str):
+        path = self.path(relpath)
+        try:
+            yield path
+            if path.is_file() and self._claim(relpath):
+                self.archive.write(path, relpath, compress_type=self.compress_type(relpath))
+        finally:
+            if path.is_file():
+                os.remove(path)
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+            self._staging.cleanup()
+
+    def abort(self):
+        """export was cancelled, drop the incomplete archive"""
+        self.close()
+        if self.archive_path.is_file():
+            os.remove(self.archive_path)
+
+
+def create_sink(filepath: str, package_zip: bool = False, **args) -> DirectorySink:
+    """sink for an export to `filepath` (the script file)"""
+    if package_zip:
+        return ZipSink(os.path.splitext(filepath)[0] + '.zip')
+    return DirectorySink(os.path.dirname(filepath))
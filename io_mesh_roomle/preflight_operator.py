@@ -0,0 +1,273 @@
+# -----------------------------------------------------------------------
+# 
+#  Copyright 2019 Roomle GmbH. All Rights Reserved.
+# 
+#  This Software is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND.
+# 
+#  NOTICE: All information contained herein is, and remains
+#  the property of Roomle. The intellectual and technical concepts contained
+#  herein are proprietary to Roomle and are protected by copyright law.
+#  Dissemination of this information or reproduction of this material
+#  is strictly forbidden unless prior written permission is obtained
+#  from Roomle.
+# -----------------------------------------------------------------------
+
+import json
+import os
+import time
+
+import bpy
+
+from dataclasses import dataclass, field, asdict
+from typing import List
+
+from bpy.props import IntProperty, StringProperty
+
+# defaults of the export operator, used if it has not been run in this session
+EXPORT_DEFAULTS = {
+    'use_selection': False,
+    'export_normals': True,
+    'export_materials': False,
+    'mesh_export_option': 'AUTO',
+    'uv_float_precision': 4,
+    'normal_float_precision': 5,
+}
+
+TEXT_NAME = 'roomle_preflight.json'
+
+
+@dataclass
+class ObjectEstimate:
+    name: str
+    placement: str
+    vertices: int
+    uv_splits: int
+    triangles: int
+    bytes: int
+
+
+@dataclass
+class TextureEstimate:
+    name: str
+    image: str
+    bytes: int
+
+
+@dataclass
+class PreflightReport:
+    objects: List[ObjectEstimate] = field(default_factory=list)
+    textures: List[TextureEstimate] = field(default_factory=list)
+    errors: List[str] = field(default_factory=list)
+    seconds: float = 0.0
+
+    @property
+    def script_bytes(self) -> int:
+        return sum(o.bytes for o in self.objects if o.placement == 'INLINE')
+
+    @property
+    def external_bytes(self) -> int:
+        return sum(o.bytes for o in self.objects if o.placement == 'EXTERNAL')
+
+    @property
+    def texture_bytes(self) -> int:
+        return sum(t.bytes for t in self.textures)
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data['totals'] = {
+            'script_bytes': self.script_bytes,
+            'external_bytes': self.external_bytes,
+            'texture_bytes': self.texture_bytes,
+        }
+        return data
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def summary(self) -> str:
+        return 'script ~{}, external meshes ~{}, textures ~{} ({} objects, {} textures, {:.2f}s)'.format(
+            format_bytes(self.script_bytes),
+            format_bytes(self.external_bytes),
+            format_bytes(self.texture_bytes),
+            len(self.objects),
+            len(self.textures),
+            self.seconds,
+        )
+
+
+def format_bytes(value: float) -> str:
+    for unit in ('B', 'KB', 'MB'):
+        if value < 1024:
+            return f'{value:.0f}{unit}' if unit == 'B' else f'{value:.1f}{unit}'
+        value /= 1024
+    return f'{value:.1f}GB'
+
+
+def estimate_image_bytes(image: bpy.types.Image) -> int:
+    """size of the image file as it would be saved, without saving it"""
+    if image.packed_file:
+        return image.packed_file.size
+    path = bpy.path.abspath(image.filepath_raw or image.filepath)
+    if path and os.path.isfile(path):
+        return os.path.getsize(path)
+    # generated or missing file: uncompressed size as upper bound
+    width, height = image.size
+    return width * height * image.channels
+
+
+def estimate_textures(objects, report: PreflightReport):
+    from .material_exporter import get_materials_used_by_objs
+    from .material_exporter._exporter import TextureNameManager
+    from .material_exporter.utils.materials import get_used_texture_nodes
+
+    texture_name_manager = TextureNameManager()
+    images = {}
+    for material in get_materials_used_by_objs(objects):
+        try:
+            for node in get_used_texture_nodes(material):
+                if node.image is not None:
+                    images[texture_name_manager.validate_name(node.image)] = node.image
+        except Exception as e:
+            report.errors.append(f'{material.name}: {e}')
+
+    for name, image in images.items():
+        report.textures.append(TextureEstimate(name=name, image=image.name, bytes=estimate_image_bytes(image)))
+    report.textures.sort(key=lambda t: t.bytes, reverse=True)
+
+
+def estimate_export(context, **keywords) -> PreflightReport:
+    """
+    Walk the objects the same way as the script export and estimate the output
+    sizes from evaluated mesh statistics, without formatting or writing anything
+    """
+    from .export_index import ExportIndex
+    from .mesh_stats import collect_mesh_stats, estimate_placement
+    from .roomle_script import get_visible_objects
+
+    start = time.perf_counter()
+    report = PreflightReport()
+
+    scene = context.scene
+    root_objects = [obj for obj in scene.objects if not obj.parent]
+    object_list = context.selected_objects if keywords['use_selection'] else get_visible_objects(context)
+
+    index = ExportIndex(root_objects, object_list)
+    depsgraph = context.evaluated_depsgraph_get()
+    method = keywords['mesh_export_option']
+
+    mesh_objects = []
+    for obj in index.walk():
+        if not index.exports_mesh(obj):
+            continue
+        mesh_objects.append(obj)
+        stats = collect_mesh_stats(obj, depsgraph)
+        estimate = estimate_placement(stats, **keywords)
+        extern = estimate.extern if method == 'AUTO' else method == 'EXTERNAL'
+        report.objects.append(ObjectEstimate(
+            name=obj.name,
+            placement='EXTERNAL' if extern else 'INLINE',
+            vertices=stats.exported_vertices,
+            uv_splits=stats.uv_splits,
+            triangles=stats.triangles,
+            bytes=estimate.external_bytes if extern else estimate.inline_bytes,
+        ))
+    report.objects.sort(key=lambda o: o.bytes, reverse=True)
+
+    if keywords['export_materials']:
+        estimate_textures(mesh_objects, report)
+
+    report.seconds = time.perf_counter() - start
+    return report
+
+
+def last_export_keywords(context) -> dict:
+    """the options the export operator was last run with"""
+    keywords = dict(EXPORT_DEFAULTS)
+    props = context.window_manager.operator_properties_last('export_mesh.roomle_script')
+    if props is not None:
+        for name in props.bl_rna.properties.keys():
+            if name != 'rna_type':
+                keywords[name] = getattr(props, name)
+    return keywords
+
+
+# last result, shown by the popup
+_last_report: PreflightReport = None
+
+
+class PreflightExportOperator(bpy.types.Operator):
+    # Tooltip
+    """Estimate the size of a Roomle export with the last used export options, without exporting"""
+
+    bl_idname = "export_mesh.roomle_preflight"
+    bl_label = "Roomle Export Pre-flight"
+
+    filepath: StringProperty(name="JSON File", description="Also write the estimate to this file", subtype='FILE_PATH', default='')
+    max_rows: IntProperty(name="Rows", description="Number of objects and textures listed", default=20, min=1)
+
+    @classmethod
+    def poll(cls, context):
+        return context.scene is not None and context.mode=='OBJECT'
+
+    def run(self, context):
+        global _last_report
+        _last_report = estimate_export(context, **last_export_keywords(context))
+
+        text = bpy.data.texts.get(TEXT_NAME) or bpy.data.texts.new(TEXT_NAME)
+        text.from_string(_last_report.to_json())
+        if self.filepath:
+            with open(bpy.path.abspath(self.filepath), 'w', encoding='utf-8') as f:
+                f.write(_last_report.to_json())
+
+        self.report({'INFO'}, _last_report.summary())
+
+    def execute(self, context):
+        self.run(context)
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        self.run(context)
+        return context.window_manager.invoke_popup(self, width=600)
+
+    def draw(self, context):
+        layout = self.layout
+        report = _last_report
+        if report is None:
+            return
+
+        layout.label(text=report.summary())
+        for error in report.errors:
+            layout.label(text=error, icon='ERROR')
+
+        table = layout.grid_flow(row_major=True, columns=5, even_columns=False, align=True)
+        for header in ('Object', 'Placement', 'Vertices', 'UV splits', 'Size'):
+            table.label(text=header)
+        for o in report.objects[:self.max_rows]:
+            table.label(text=o.name)
+            table.label(text=o.placement)
+            table.label(text=str(o.vertices))
+            table.label(text=str(o.uv_splits))
+            table.label(text=format_bytes(o.bytes))
+
+        if report.textures:
+            table = layout.grid_flow(row_major=True, columns=2, even_columns=False, align=True)
+            table.label(text='Texture')
+            table.label(text='Size')
+            for t in report.textures[:self.max_rows]:
+                table.label(text=t.name)
+                table.label(text=format_bytes(t.bytes))
+
+        layout.label(text=f'Full result in text block "{TEXT_NAME}"', icon='TEXT')
+
+
+def register():
+    bpy.utils.register_class(PreflightExportOperator)
+
+
+def unregister():
+    bpy.utils.unregister_class(PreflightExportOperator)
+
+
+if __name__ == "__main__":
+    register()
@@ -20,18 +20,46 @@ import os
 import re
 import subprocess
 import inspect
+import json
 
 from dataclasses import dataclass
 from decimal import Decimal
 from math import degrees,floor,log10
 from copy import deepcopy
 
-from mathutils import Vector
+import numpy as np
+
+from mathutils import Matrix, Vector
 
 from bpy_extras.io_utils import (
         axis_conversion,
         )
 
+from .export_index import ExportIndex
+from .export_report import ExportReport
+from .mesh_stats import (
+    collect_mesh_stats,
+    estimate_placement,
+    smooth_normals,
+    normal_deviation,
+    choose_precision,
+    rounding_error,
+)
+from .packaging import DirectorySink
+from .mesh_encoder import EncodeJob, ParallelEncoder, transform_normals
+from .script_optimizer import optimize_script
+from .out_of_core import (
+    MemoryStore,
+    OutOfCoreStore,
+    evaluated_triangle_count,
+    stage_mesh,
+    weld,
+    iter_positions,
+    choose_chunked_precision,
+    max_abs,
+    write_add_mesh,
+)
+
 @dataclass
 class VertexVariant:
     index: int
@@ -41,6 +69,16 @@ class VertexVariant:
 def getValidName(name):
     return re.sub('[^0-9a-zA-Z:_]+', '', name)
 
+def get_material_id(name, material_aliases=None, **args):
+    '''
+    Material ID used in SetObjSurface, the canonical one if the material was merged
+    with an identical one during the material export
+    '''
+    material_id = getValidName(name)
+    if material_aliases:
+        return material_aliases.get(material_id, material_id)
+    return material_id
+
 def isZero(self, precision=0):
     q = Decimal(10) ** -precision # 2 precision --> '0.01'
     if isinstance(self, float):
@@ -50,6 +88,23 @@ def isZero(self, precision=0):
             return False
     return True
 
+# decimal digits of positions and translations in mm (0.1mm) if not chosen adaptively
+POSITION_PRECISION = 1
+
+def coordinate_tolerance( object, **args ):
+    '''
+    Max positional error in mm allowed for the object's coordinates,
+    `None` for the fixed precision
+    '''
+    mode = args.get('precision_mode', 'FIXED')
+    if mode == 'ABSOLUTE':
+        return args['precision_tolerance']
+    if mode == 'RELATIVE':
+        size = object.dimensions.length * 1000
+        if size > 0:
+            return size * args['precision_relative'] / 100
+    return None
+
 def floatFormat( value, precision=0 ):
     """
     Converts a float to a string. Rounds to a certain precision and removed trailing zeros.
@@ -163,6 +218,7 @@ def indices_from_mesh(ob, use_mesh_modifiers=False):
                         
                         v_index = len(vertices)
                         vertices.append(mesh.vertices[orig_index].co)
+                        normals.append(mesh.vertices[orig_index].normal * -1)
                         indices.append(v_index)
                         uvs.append(uv_layer.data[loop_index].uv)
 
@@ -197,7 +253,27 @@ def indices_from_mesh(ob, use_mesh_modifiers=False):
 
     return vertices, indices, uvs, normals, split_uvs
         
-def create_mesh_command( object, global_matrix, use_mesh_modifiers = True, scale=None, rotation=None, **args ):
+def runtime_normal_deviation( vertices, indices, normals, scale=None, rotation=None, bake=None ):
+    '''
+    Largest angle (degrees) between the smooth normals a runtime derives from the
+    exported triangles and the normals Blender shows for the same vertices.
+    Both are compared after scale and (applied) rotation, or the baked transform.
+    '''
+    if bake is not None:
+        linear = np.array(bake.to_3x3(), dtype=np.float64)
+    else:
+        linear = np.diag(scale[:] if scale else (1.0,1.0,1.0))
+        if rotation:
+            linear = np.array(rotation.to_matrix()) @ linear
+
+    positions = np.array([v[:] for v in vertices], dtype=np.float64) @ linear.T
+    # normals transform with the inverse transpose
+    reference = np.array([n[:] for n in normals], dtype=np.float64) @ np.linalg.inv(linear)
+    triangles = np.array(indices, dtype=np.int64).reshape(-1,3)
+
+    return normal_deviation(smooth_normals(positions, triangles), reference)
+
+def create_mesh_command( object, global_matrix, use_mesh_modifiers = True, scale=None, rotation=None, bake=None, **args ):
     
     debug = args['debug']
 
@@ -210,25 +286,60 @@ def create_mesh_command( object, global_matrix, use_mesh_modifiers = True, scale
     
     export_normals |= split_uvs
 
+    # leave out normals the runtime would calculate (almost) identically
+    deviation = None
+    if export_normals and args.get('elide_normals', True) and indices:
+        deviation = runtime_normal_deviation(vertices, indices, normals, scale, rotation if apply_rotation else None, bake)
+        if deviation <= args.get('normal_tolerance', 1.0):
+            export_normals = False
+
+    report = args.get('report')
+    entry = None
+    if report is not None:
+        entry = report.object(object)
+        entry.normals = 'EXPORTED' if export_normals else ('ELIDED' if deviation is not None else '')
+        entry.normal_deviation = None if deviation is None else round(deviation, 3)
+
+    if bake is not None and export_normals:
+        # baked transforms: the normals are turned here instead of by the runtime
+        linear = np.array(bake.to_3x3(), dtype=np.float64)
+        normals = [Vector(n) for n in transform_normals([n[:] for n in normals], linear)]
+
     if debug:
         command += '\n// Vertex positions:\n'
-    command += 'Vector3f['
-    for i,vertex in enumerate(vertices):
-        if i>0:
-            command += ','
-        if debug:
-            command += '\n'
+    positions = []
+    for vertex in vertices:
         v=vertex.copy()
-        if scale:
+        if bake is not None:
+            v = bake @ v
+        elif scale:
             v.x *= scale.x
             v.y *= scale.y
             v.z *= scale.z
         if apply_rotation:
             v = rotation @ v
 
-        v = global_matrix @ v
+        positions.append(global_matrix @ v)
+
+    # the vertices get half of the error budget, the object's translation the other half
+    tolerance = coordinate_tolerance(object, **args)
+    coords = np.array([v[:] for v in positions]) if (tolerance is not None or entry is not None) else None
+    if tolerance is None:
+        precision = POSITION_PRECISION
+    else:
+        precision = choose_precision(coords, tolerance*0.5).precision
+
+    if entry is not None:
+        entry.precision = precision
+        entry.position_error = round(rounding_error(coords, precision), 4)
 
-        command +='{{{0},{1},{2}}}'.format( floatFormat(v.x,1), floatFormat(v.y,1), floatFormat(v.z,1) )
+    command += 'Vector3f['
+    for i,v in enumerate(positions):
+        if i>0:
+            command += ','
+        if debug:
+            command += '\n'
+        command +='{{{0},{1},{2}}}'.format( floatFormat(v.x,precision), floatFormat(v.y,precision), floatFormat(v.z,precision) )
     if debug:
         command += '\n'
     command += '],'
@@ -293,6 +404,125 @@ def create_mesh_command( object, global_matrix, use_mesh_modifiers = True, scale
     command+=');\n'
     return command
 
+def mesh_matrices( global_matrix, scale=None, rotation=None, bake=None ):
+    '''
+    Matrix from mesh to script space and the scale and rotation part of it
+    (or the linear part of the baked transform) the runtime normals are
+    compared in, both as numpy arrays
+    '''
+    if bake is not None:
+        transform = bake
+    else:
+        transform = Matrix.Diagonal((*(scale[:] if scale else (1.0,1.0,1.0)), 1.0))
+        if rotation:
+            transform = rotation.to_matrix().to_4x4() @ transform
+    return np.array(global_matrix @ transform, dtype=np.float64), np.array(transform.to_3x3(), dtype=np.float64)
+
+def create_mesh_command_parallel( object, global_matrix, scale=None, rotation=None, bake=None, parallel_encoder=None, **args ):
+    '''
+    AddMesh encoded by a worker process of the parallel encoder: only the mesh data is
+    read here, straight into shared memory. Returns the placeholder of the command.
+    '''
+    matrix, linear = mesh_matrices(global_matrix, scale, rotation if args['apply_rotations'] else None, bake)
+
+    job = EncodeJob()
+    object_eval = object.evaluated_get(bpy.context.evaluated_depsgraph_get())
+    mesh = object_eval.to_mesh()
+    try:
+        staged = stage_mesh(mesh, job)
+    finally:
+        object_eval.to_mesh_clear()
+    welded = weld(staged, MemoryStore())
+
+    job.share('positions', staged.positions)
+    job.share('normals', staged.normals)
+    job.share('sources', welded.sources)
+    job.share('indices', welded.indices)
+    if welded.uvs is not None:
+        job.share('uvs', welded.uvs)
+
+    tolerance = coordinate_tolerance(object, **args)
+    params = {
+        'comment': '/* Object:{} Mesh:{} */\n'.format(object.name,object.data.name),
+        'matrix': matrix.tolist(),
+        'normal_linear': linear.tolist(),
+        'bake_normals': bake is not None,
+        'precision': POSITION_PRECISION,
+        'tolerance': None if tolerance is None else tolerance*0.5,
+        'uv_float_precision': args['uv_float_precision'],
+        'normal_float_precision': args['normal_float_precision'],
+        'export_normals': args['export_normals'] or welded.split_uvs,
+        'elide_normals': args.get('elide_normals', True),
+        'normal_tolerance': args.get('normal_tolerance', 1.0),
+    }
+
+    on_done = None
+    report = args.get('report')
+    if report is not None:
+        entry = report.object(object)
+        def on_done(decisions):
+            for key in ('normals', 'normal_deviation', 'precision', 'position_error'):
+                setattr(entry, key, decisions[key])
+
+    return parallel_encoder.submit(job, params, on_done)
+
+def create_mesh_command_out_of_core( object, global_matrix, scale=None, rotation=None, bake=None, out_of_core_store=None, **args ):
+    '''
+    AddMesh of a huge mesh with bounded memory: the mesh is staged in memory-mapped
+    files and the command is streamed into a script fragment chunk by chunk.
+    Returns the fragment's placeholder. Normals are not elided and `debug` has no effect.
+    '''
+    store = out_of_core_store
+    matrix, linear = mesh_matrices(global_matrix, scale, rotation if args['apply_rotations'] else None, bake)
+
+    object_eval = object.evaluated_get(bpy.context.evaluated_depsgraph_get())
+    mesh = object_eval.to_mesh()
+    try:
+        staged = stage_mesh(mesh, store)
+    finally:
+        object_eval.to_mesh_clear()
+    welded = weld(staged, store)
+
+    export_normals = args['export_normals'] or welded.split_uvs
+
+    tolerance = coordinate_tolerance(object, **args)
+    if tolerance is None:
+        precision = POSITION_PRECISION
+        error = None
+    else:
+        precision, error = choose_chunked_precision(iter_positions(staged, welded, matrix), tolerance*0.5)
+
+    report = args.get('report')
+    if report is not None:
+        entry = report.object(object)
+        entry.normals = 'EXPORTED' if export_normals else ''
+        entry.precision = precision
+        if error is None:
+            _, error = choose_chunked_precision(iter_positions(staged, welded, matrix), 0, precision, precision)
+        entry.position_error = round(error, 4)
+
+    uv_precision = 0
+    if welded.uvs is not None:
+        maxvalue = max(1, max_abs(welded.uvs))
+        uv_precision = max( 0, args['uv_float_precision'] - floor(log10(maxvalue)))
+
+    with store.fragment() as (placeholder, out):
+        # fragments are copied as they are, the optimizer can not drop their comment
+        if not args.get('optimize_script'):
+            out.write('/* Object:{} Mesh:{} */\n'.format(object.name,object.data.name))
+        write_add_mesh(
+            out,
+            staged,
+            welded,
+            matrix,
+            precision,
+            uv_precision,
+            args['normal_float_precision'],
+            export_normals,
+            linear if bake is not None else None,
+        )
+    return placeholder
+
 def get_object_bounding_box( object ):
     corners = object.bound_box
 
@@ -312,6 +542,100 @@ def get_object_bounding_box( object ):
     center = Vector(( xmax+xmin, ymax+ymin, zmax+zmin ))*0.5
     return dim,center
 
+def write_extern_mesh(
+    preferences,
+    sink,
+    relpath,
+    tri_mesh,
+    use_mesh_modifiers = True,
+    scale=None,
+    rotation=None,
+    bake=None,
+    keep_custom_normals=False,
+    **args
+):
+    '''
+    Write a mesh data block triangulated as OBJ into the sink and convert it
+    to corto if a corto exe is found. The mesh data block is removed afterwards.
+    `scale` and `rotation`, or the whole `bake` matrix, are applied to the mesh.
+    Returns the bounding box (dim, center) of the written mesh.
+    '''
+    scene = bpy.context.scene
+    
+    bpy.ops.object.select_all(action='DESELECT')
+
+    tmp = bpy.data.objects.new('tmp_'+tri_mesh.name, tri_mesh) # create temporary object with same mesh data but without transformation
+    
+    triangulate_mod = tmp.modifiers.new('Triangulate','TRIANGULATE')
+    triangulate_mod.keep_custom_normals = keep_custom_normals
+
+    # put the object into the scene (link)
+    scene.collection.objects.link(tmp)
+
+    if bake is not None:
+        # into the mesh data, an object's matrix can not hold shear
+        tri_mesh.transform(bake)
+    if scale:
+        tmp.scale = scale
+    if rotation:
+        tmp.rotation_mode = 'QUATERNION'
+        tmp.rotation_quaternion = rotation
+
+    bpy.context.view_layer.objects.active = tmp  # set as the active object in the scene
+    tmp.select_set(True)  # select object
+        
+    # Apply transform (necessary to have correct boundings box)
+    bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
+
+    with sink.stage(relpath) as filepath:
+        filepath = str(filepath)
+        export_selected_obj(
+            filepath=filepath,
+            use_mesh_modifiers=use_mesh_modifiers,
+            export_normals=args['export_normals'],
+        )
+
+        dim, center = get_object_bounding_box(tmp)
+
+        bpy.data.objects.remove(tmp) # remove temporary object
+        bpy.data.meshes.remove(tri_mesh)
+
+        corto_exe = preferences.corto_path if args["use_corto"] else None
+        if corto_exe and os.path.isfile(corto_exe):
+            # corto writes its .crt file next to the obj
+            with sink.stage(os.path.splitext(relpath)[0] + '.crt'):
+                try:
+                    corto_process = subprocess.Popen( [corto_exe, '-v 12 -n 9 -u 10 -N delta', filepath])
+                    if corto_process.wait()!=0:
+                        raise Exception('corto error')
+                except Exception as e:
+                    print(e)
+                    pass
+                else:
+                    os.remove(filepath)
+            print(corto_exe)
+
+    return dim, center
+
+def format_extern_mesh_command( mesh_id, dim, center, **args ):
+    '''
+    AddExternalMesh command from a bounding box in Blender space
+    '''
+    # Convert to Roomle Script space
+    dim = dim * 1000
+    center = center * 1000
+    center.y *= -1
+    bb_origin = center - (dim*0.5)
+    dim_str = ( floatFormat(dim.x,1), floatFormat(dim.y,1), floatFormat(dim.z,1) )
+    center_str = ( floatFormat(bb_origin.x,1), floatFormat(bb_origin.y,1), floatFormat(bb_origin.z,1) )
+
+    return 'AddExternalMesh(\'{}:{}\',Vector3f{{{},{},{}}},Vector3f{{{},{},{}}});\n'.format(
+        args['catalog_id'],
+        mesh_id,
+        *dim_str,
+        *center_str
+        )
+
 def create_extern_mesh_command(
     preferences,
     extern_mesh_dir,
@@ -320,6 +644,7 @@ def create_extern_mesh_command(
     use_mesh_modifiers = True,
     scale=None,
     rotation=None,
+    bake=None,
     **args
 ):
     '''
@@ -328,7 +653,7 @@ def create_extern_mesh_command(
     '''
 
     apply_rotation = args['apply_rotations'] and rotation
-    name = object.name if (scale or apply_rotation) else object.data.name
+    name = object.name if (scale or apply_rotation or bake is not None) else object.data.name
 
     mesh = object.to_mesh(
         depsgraph=bpy.context.evaluated_depsgraph_get(),
@@ -346,48 +671,21 @@ def create_extern_mesh_command(
     bm.to_mesh(tri_mesh)
     bm.free()
 
-    if not os.path.isdir(extern_mesh_dir):
-        os.makedirs(extern_mesh_dir)
-
     script_name = os.path.basename(extern_mesh_dir)
-    
-    scene = bpy.context.scene
-    
-    bpy.ops.object.select_all(action='DESELECT')
-
-    tmp = bpy.data.objects.new('tmp_'+name, tri_mesh) # create temporary object with same mesh data but without transformation
-    
-    triangulate_mod = tmp.modifiers.new('Triangulate','TRIANGULATE')
-    triangulate_mod.keep_custom_normals = mesh.has_custom_normals
-
-    # put the object into the scene (link)
-    scene.collection.objects.link(tmp)
-
-    if scale:
-        tmp.scale = scale
-    if apply_rotation:
-        tmp.rotation_mode = 'QUATERNION'
-        tmp.rotation_quaternion = rotation
+    sink = args.get('sink') or DirectorySink(os.path.dirname(extern_mesh_dir))
 
-    bpy.context.view_layer.objects.active = tmp  # set as the active object in the scene
-    tmp.select_set(True)  # select object
-        
-    # Apply transform (necessary to have correct boundings box)
-    bpy.ops.object.transform_apply(location=True, rotation=True, scale=True)
-
-    filepath = os.path.join(extern_mesh_dir,f'{script_name}_{name}')
-
-    filepath += '.obj'
-    export_selected_obj(
-        filepath=filepath,
+    dim, center = write_extern_mesh(
+        preferences,
+        sink,
+        f'{script_name}/{script_name}_{name}.obj',
+        tri_mesh,
         use_mesh_modifiers=use_mesh_modifiers,
-        export_normals=args['export_normals'],
-    )
-
-    dim, center = get_object_bounding_box(tmp)
-
-    bpy.data.objects.remove(tmp) # remove temporary object
-    bpy.data.meshes.remove(tri_mesh)
+        scale=scale,
+        rotation=rotation if apply_rotation else None,
+        bake=bake,
+        keep_custom_normals=mesh.has_custom_normals,
+        **args
+        )
 
     if scale:
         dim.x *= scale.x
@@ -398,57 +696,42 @@ def create_extern_mesh_command(
         center.y *= scale.y
         center.z *= scale.z
 
-    # Convert to Roomle Script space
-    dim *= 1000
-    center *= 1000
-    center.y *= -1
-    bb_origin = center - (dim*0.5)
-    dim_str = ( floatFormat(dim.x,1), floatFormat(dim.y,1), floatFormat(dim.z,1) )
-    center_str = ( floatFormat(bb_origin.x,1), floatFormat(bb_origin.y,1), floatFormat(bb_origin.z,1) )
+    return format_extern_mesh_command(f'{script_name}_{name}', dim, center, **args)
 
-    script = 'AddExternalMesh(\'{}:{}_{}\',Vector3f{{{},{},{}}},Vector3f{{{},{},{}}});\n'.format(
-        args['catalog_id'],
-        script_name,
-        name,
-        *dim_str,
-        *center_str
-        )
-
-    if args["use_corto"] and preferences.corto_exe and os.path.isfile(preferences.corto_exe):
-        try:
-            corto_process = subprocess.Popen( [preferences.corto_exe, '-v 12 -n 9 -u 10 -N delta', filepath])
-            if corto_process.wait()!=0:
-                raise Exception('corto error')
-        except Exception as e:
-            print(e)
-            pass
-        else:
-            os.remove(filepath)
-        print(preferences.corto_exe)
-    
-    return script
+def create_rotation_commands( rot ):
+    '''
+    RotateMatrixBy commands of an euler rotation (Blender space)
+    '''
+    command = ''
+    x,y,z = map(degrees, (-rot.x,rot.y,-rot.z))
+    rotation_precision = 2
+    if not isZero(x,rotation_precision):
+        command += "RotateMatrixBy(Vector3f{{1,0,0}},Vector3f{{0,0,0}},{});\n".format(floatFormat(x,rotation_precision))
+    if not isZero(y,rotation_precision):
+        command += "RotateMatrixBy(Vector3f{{0,1,0}},Vector3f{{0,0,0}},{});\n".format(floatFormat(y,rotation_precision))
+    if not isZero(z,rotation_precision):
+        command += "RotateMatrixBy(Vector3f{{0,0,1}},Vector3f{{0,0,0}},{});\n".format(floatFormat(z,rotation_precision))
+    return command
 
 def create_transform_commands(
     object,
     global_matrix,
     parent_scale=None,
     apply_rotation=True,
-    parent_rotation=None
+    parent_rotation=None,
+    tolerance=None,
+    inherited_error=0.0
     ):
+    '''
+    Rotation (unless applied) and move commands of an object, see `create_move_command`
+    for the precision and the returned error
+    '''
     command = ''
     pos = object.matrix_local.translation.copy()
 
     # rotation
     if not apply_rotation:
-        rot = object.matrix_local.to_euler()
-        x,y,z = map(degrees, (-rot.x,rot.y,-rot.z))
-        rotation_precision = 2
-        if not isZero(x,rotation_precision):
-            command += "RotateMatrixBy(Vector3f{{1,0,0}},Vector3f{{0,0,0}},{});\n".format(floatFormat(x,rotation_precision))
-        if not isZero(y,rotation_precision):
-            command += "RotateMatrixBy(Vector3f{{0,1,0}},Vector3f{{0,0,0}},{});\n".format(floatFormat(y,rotation_precision))
-        if not isZero(z,rotation_precision):
-            command += "RotateMatrixBy(Vector3f{{0,0,1}},Vector3f{{0,0,0}},{});\n".format(floatFormat(z,rotation_precision))
+        command += create_rotation_commands(object.matrix_local.to_euler())
     
     # translation
     if parent_scale:
@@ -459,125 +742,466 @@ def create_transform_commands(
     if apply_rotation and parent_rotation:
         pos = parent_rotation @ pos
 
-    pos = pos @ global_matrix
+    move, precision, error = create_move_command(pos @ global_matrix, tolerance, inherited_error)
+    return command + move, precision, error
+
+def create_move_command( pos, tolerance=None, inherited_error=0.0 ):
+    '''
+    MoveMatrixBy command of a translation in script space, empty if it rounds to zero.
+    Returns the command, its precision (`None` without command) and the rounding error
+    added to the `inherited_error` of the translations it is nested in: the errors of
+    nested translations add up in the positions of the content.
+    '''
+    if tolerance is None:
+        precision = POSITION_PRECISION
+    else:
+        precision = choose_precision(np.array([pos[:]]), tolerance).precision
+    error = inherited_error + rounding_error(np.array([pos[:]]), precision)
+
+    if isZero(pos,precision=precision):
+        return '', None, error
+    command = "MoveMatrixBy(Vector3f{{{0},{1},{2}}});\n".format(floatFormat(pos.x,precision),floatFormat(pos.y,precision),floatFormat(pos.z,precision))
+    return command, precision, error
+
+def create_dynamic_transform_commands( matrix, global_matrix, tolerance=None, inherited_error=0.0 ):
+    '''
+    Transform commands of a dynamic object when static transforms are baked:
+    its rotation and translation relative to the anchor of its parent (`matrix`)
+    '''
+    move, precision, error = create_move_command(matrix.translation @ global_matrix, tolerance, inherited_error)
+    return create_rotation_commands(matrix.to_euler()) + move, precision, error
+
+def translation_budgets( index, **args ):
+    '''
+    Smallest coordinate tolerance in the live subtree of every object (`None` if there is
+    none) and the number of nested translations down to its deepest descendant. Rounding
+    errors of a translation show up in the positions of everything below it.
+    '''
+    if index.translation_budgets is None:
+        budgets = {}
+        # children before their parents
+        for obj in reversed(list(index.walk())):
+            tolerance = None
+            if index.exports_mesh(obj) or index.exports_instance(obj):
+                tolerance = coordinate_tolerance(obj, **args)
+            levels = 1
+            for child in index.live_children(obj):
+                child_tolerance, child_levels = budgets[child]
+                if child_tolerance is not None:
+                    tolerance = child_tolerance if tolerance is None else min(tolerance, child_tolerance)
+                levels = max(levels, child_levels + 1)
+            budgets[obj] = (tolerance, levels)
+        index.translation_budgets = budgets
+    return index.translation_budgets
+
+def translation_tolerance( index, object, parent_error=0.0, **args ):
+    '''
+    Tolerance of the object's translation: half of the subtree's tolerance is shared by all
+    nested translations, minus what the parents used, split among the levels still below
+    '''
+    tolerance, levels = translation_budgets(index, **args).get(object, (coordinate_tolerance(object, **args), 1))
+    if tolerance is None:
+        return None
+    return max(0.0, tolerance*0.5 - parent_error) / levels
+
+class ObjectFrame:
+    """
+    State of one object while the hierarchy is walked
+    """
+    def __init__(self, object, parent_scale, parent_rotation, apply_transform, children):
+        self.object = object
+        self.parent_scale = parent_scale
+        self.parent_rotation = parent_rotation
+        self.apply_transform = apply_transform
+        self.children = iter(children)
+        self.child_commands = []
+        self.scale = None
+        self.rotation = None
+        # transform baked into the mesh, relative to the object's anchor (see `ExportIndex.anchor`)
+        self.bake = None
+        # transform commands of a dynamic object when transforms are baked
+        self.dynamic_matrix = None
+        # transform commands after the object, with the precision of the move and the
+        # rounding error of the translations of the object and its parents
+        self.transform = ''
+        self.move_precision = None
+        self.translation_error = 0.0
+        self.empty = True
+        self.mesh = ''
+        self.material = ''
+
+def create_mesh_and_material_commands( preferences, frame, extern_mesh_dir, global_matrix, **args ):
+    '''
+    Create the mesh and material commands of the frame's object
+    '''
+    object = frame.object
+
+    method = args['mesh_export_option']
+
+    estimate = None
+    if method=='AUTO':
+        # decide by the size of the modifier-evaluated mesh, not the base mesh
+        estimate = estimate_placement(collect_mesh_stats(object), **args)
+        extern = estimate.extern
+    else:
+        extern = method=='EXTERNAL'
+
+    report = args.get('report')
+    if report is not None:
+        entry = report.object(object)
+        entry.mesh = object.data.name
+        entry.placement = 'EXTERNAL' if extern else 'INLINE'
+        entry.estimate = None if estimate is None else estimate.to_dict()
+
+    if extern:
+        frame.mesh = create_extern_mesh_command(
+            preferences,
+             extern_mesh_dir,
+             object,
+             global_matrix,
+             scale=frame.scale,
+             rotation=frame.rotation,
+             bake=frame.bake,
+             **args
+             )
+    elif args.get('out_of_core_store') and evaluated_triangle_count(object) >= args.get('out_of_core_threshold', 1000000):
+        frame.mesh = create_mesh_command_out_of_core(object, global_matrix, scale=frame.scale, rotation=frame.rotation, bake=frame.bake, **args)
+    elif args.get('parallel_encoder') and not args['debug']:
+        frame.mesh = create_mesh_command_parallel(object, global_matrix, scale=frame.scale, rotation=frame.rotation, bake=frame.bake, **args)
+    else:
+        frame.mesh = create_mesh_command(object, global_matrix, scale=frame.scale, rotation=frame.rotation, bake=frame.bake, **args)
+
+    # Material
+    frame.material = ''
+    if object.material_slots:
+        material_name = get_material_id(object.material_slots[0].name, **args)
+        # TODO: 5959 create material definition
+        frame.material = "SetObjSurface('{}:{}');\n".format( args['catalog_id'], material_name )
+
+def create_instance_commands( preferences, index, object, extern_mesh_dir, global_matrix, **args ):
+    '''
+    Commands of an empty that instances a collection: the collection's content
+    as group, followed by the instance offset, the instance's scale and (applied)
+    rotation. The content is created once per collection and export and its
+    meshes are always external, so all instances share them.
+    '''
+    collection = object.instance_collection
+
+    body = index.instance_bodies.get(collection)
+    if body is None:
+        members = list(collection.all_objects)
+        member_set = set(members)
+        roots = [obj for obj in members if obj.parent not in member_set]
+        body_index = ExportIndex(roots, members, instance_bodies=index.instance_bodies)
+        body_args = dict(args, mesh_export_option='EXTERNAL')
+        try:
+            body = ''.join(
+                create_object_commands(preferences, root, members, extern_mesh_dir, global_matrix, index=body_index, **body_args)
+                for root in body_index.live_roots()
+            )
+        finally:
+            release_object_instances(body_index)
+        index.instance_bodies[collection] = body
+
+    command = "BeginObjGroup('{}');\n".format(getValidName(collection.name))
+    command += body
+    command += "EndObjGroup();\n"
+
+    if args.get('bake_transforms'):
+        # the body is shared, the instance's baked transform follows as commands
+        matrix = index.baked_matrix(object) @ Matrix.Translation(-collection.instance_offset)
+        pos, rotation, scale = matrix.decompose()
+        if not isZero(scale - Vector((1,1,1)), 4):
+            command += "ScaleMatrixBy(Vector3f{{{0},{1},{2}}});\n".format(*(floatFormat(v,4) for v in scale))
+        command += create_rotation_commands(rotation.to_euler())
+        command += create_move_command(pos @ global_matrix)[0]
+        return command
+
+    offset = -collection.instance_offset @ global_matrix
+    if not isZero(offset,precision=POSITION_PRECISION):
+        command += "MoveMatrixBy(Vector3f{{{0},{1},{2}}});\n".format(*(floatFormat(v,POSITION_PRECISION) for v in offset[:3]))
+
+    scale = index.world_scale(object)
+    if scale:
+        command += "ScaleMatrixBy(Vector3f{{{0},{1},{2}}});\n".format(*(floatFormat(v,4) for v in scale))
+
+    # without applied rotations the object's rotation follows with its transform commands
+    if args['apply_rotations']:
+        rotation = index.world_rotation(object)
+        if rotation:
+            command += create_rotation_commands(rotation.to_euler())
 
-    if not isZero(pos,precision=1):
-        command += "MoveMatrixBy(Vector3f{{{0},{1},{2}}});\n".format(floatFormat(pos.x,1),floatFormat(pos.y,1),floatFormat(pos.z,1))
-    
     return command
 
-def create_object_commands(
-    preferences,
-    object,
-    object_list,
-    extern_mesh_dir,
-    global_matrix,
-    parent_scale=None,
-    parent_rotation=None,
-    apply_transform=False,
-    **args
-    ):
+@dataclass
+class InstancedMesh:
+    '''
+    Realized geometry of depsgraph instances, shared by all instances of the same geometry
+    '''
+    name: str
+    mesh: object = None         # copy of the evaluated mesh, removed once it is written
+    material: str = ''
+    command: str = ''           # AddExternalMesh (and SetObjSurface) once it is written
 
+def collect_object_instances( index, depsgraph=None ):
     '''
-    Create all necessary commands for one object
-    this function gets called by the loop over all objects
+    Collect the instances of all exported objects (e.g. geometry nodes scattering,
+    vertex/face instancing) in one pass over `depsgraph.object_instances`.
+    Collection instances are left out, see `create_instance_commands`.
+    Returns instancer -> [(InstancedMesh, matrix_world)], the geometry is copied once
+    per distinct mesh since the evaluated data is only valid during the iteration.
     '''
+    if depsgraph is None:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+
+    meshes = {}
+    instances = {}
+    for instance in depsgraph.object_instances:
+        if not instance.is_instance or instance.parent is None:
+            continue
+        instancer = instance.parent.original
+        if instancer not in index.live or not index.exports_mesh(instancer) or instancer.instance_type == 'COLLECTION':
+            continue
+        obj = instance.object
+        if obj.type != 'MESH':
+            continue
+
+        key = obj.data.as_pointer()
+        shared = meshes.get(key)
+        if shared is None:
+            mesh = bpy.data.meshes.new_from_object(obj, preserve_all_data_layers=True, depsgraph=depsgraph)
+            shared = InstancedMesh(
+                name='instance{}_{}'.format(len(meshes), getValidName(obj.data.name)),
+                mesh=mesh,
+                material=mesh.materials[0].name if len(mesh.materials) and mesh.materials[0] else '',
+            )
+            meshes[key] = shared
+        instances.setdefault(instancer, []).append((shared, instance.matrix_world.copy()))
+
+    return instances
 
-    # TODO: separate out the mesh creation for better readability
+def get_object_instances( index ):
+    if index.depsgraph_instances is None:
+        index.depsgraph_instances = collect_object_instances(index)
+    return index.depsgraph_instances
+
+def release_object_instances( index ):
+    '''
+    Remove the mesh copies of depsgraph instances that were not written,
+    when an export is cancelled or fails
+    '''
+    for instances in (index.depsgraph_instances or {}).values():
+        for shared, _ in instances:
+            if shared.mesh is not None:
+                bpy.data.meshes.remove(shared.mesh)
+                shared.mesh = None
+
+def has_evaluated_faces( object ):
+    evaluated = object.evaluated_get(bpy.context.evaluated_depsgraph_get())
+    return len(evaluated.data.polygons) > 0
+
+def create_object_instance_commands( preferences, index, instances, object, extern_mesh_dir, global_matrix, **args ):
+    '''
+    Commands of the depsgraph instances of an object. Every distinct geometry is
+    written once as external mesh, each instance only adds an AddExternalMesh
+    with its scale, rotation and translation relative to the object.
+    '''
+    script_name = os.path.basename(extern_mesh_dir)
+    sink = args.get('sink') or DirectorySink(os.path.dirname(extern_mesh_dir))
+
+    # instances are placed relative to the transform the runtime applies to the object
+    if args.get('bake_transforms'):
+        runtime_matrix = index.runtime_matrix(index.anchor(object))
+    else:
+        runtime_matrix = Matrix.Translation(object.matrix_world.translation)
+        if not args['apply_rotations']:
+            runtime_matrix = runtime_matrix @ object.matrix_world.to_quaternion().to_matrix().to_4x4()
+    to_local = runtime_matrix.inverted()
 
     command = ''
-    
-    empty = True
-
-    mesh = ''
-    material = ''
-
-    scale = object.matrix_world.to_scale()
-    if scale.x==1 and scale.y==1 and scale.z==1:
-        scale = None
-
-    apply_rotation = args['apply_rotations']
-    rotation = None
-    if apply_rotation:
-        rotation = object.matrix_world.to_quaternion()
-        if rotation.x==0 and rotation.y==0 and rotation.z==0 and rotation.w==1:
-            rotation = None
-
-    if object_list==None or (object in object_list):
-        # Mesh
-        if object.data and isinstance(object.data,bpy.types.Mesh):
-            empty = False
-
-            method = args['mesh_export_option']
-
-            extern = (method=='EXTERNAL') or (method=='AUTO' and len(object.data.vertices) > 100)
-
-            if extern:
-                mesh = create_extern_mesh_command(
-                    preferences,
-                     extern_mesh_dir,
-                     object,
-                     global_matrix,
-                     scale=scale,
-                     rotation=rotation,
-                     **args
-                     )
-            else:
-                mesh = create_mesh_command(object, global_matrix, scale=scale, rotation=rotation, **args)
-
-            # Material
-            material = ''
-            if object.material_slots:
-                material_name = getValidName(object.material_slots[0].name)
-                # TODO: 5959 create material definition
-                material = "SetObjSurface('{}:{}');\n".format( args['catalog_id'], material_name )
-
-    # Children
-    childCommands = ''
-    if len(object.children)>0:
-        for child in object.children:
-            if child:
-                childCommands += create_object_commands (
-                    preferences,
-                    child,
-                    object_list,
-                    extern_mesh_dir,
-                    global_matrix, 
-                    parent_scale=scale,
-                    parent_rotation=rotation,
-                    **args
-                    )
+    for shared, matrix_world in instances:
+        if not shared.command:
+            dim, center = write_extern_mesh(
+                preferences,
+                sink,
+                f'{script_name}/{script_name}_{shared.name}.obj',
+                shared.mesh,
+                keep_custom_normals=shared.mesh.has_custom_normals,
+                **args
+                )
+            shared.mesh = None
+            shared.command = format_extern_mesh_command(f'{script_name}_{shared.name}', dim, center, **args)
+            if shared.material:
+                shared.command += "SetObjSurface('{}:{}');\n".format(args['catalog_id'], get_material_id(shared.material, **args))
+
+        command += shared.command
+
+        pos, rotation, scale = (to_local @ matrix_world).decompose()
+        if not isZero(scale - Vector((1,1,1)), 4):
+            command += "ScaleMatrixBy(Vector3f{{{0},{1},{2}}});\n".format(*(floatFormat(v,4) for v in scale))
+        command += create_rotation_commands(rotation.to_euler())
+        pos = pos @ global_matrix
+        if not isZero(pos,precision=POSITION_PRECISION):
+            command += "MoveMatrixBy(Vector3f{{{0},{1},{2}}});\n".format(*(floatFormat(v,POSITION_PRECISION) for v in pos[:3]))
+
+    return command
+
+def enter_object_frame( preferences, index, object, extern_mesh_dir, global_matrix, parent_scale=None, parent_rotation=None, apply_transform=False, parent_error=0.0, **args ):
+    frame = ObjectFrame(object, parent_scale, parent_rotation, apply_transform, index.live_children(object))
+    frame.translation_error = parent_error
+
+    if args.get('bake_transforms'):
+        # only dynamic objects keep transform commands, all others are baked into their meshes
+        frame.bake = index.baked_matrix(object)
+        if index.is_dynamic(object):
+            frame.dynamic_matrix = index.dynamic_matrix(object)
+            frame.transform, frame.move_precision, frame.translation_error = create_dynamic_transform_commands(
+                frame.dynamic_matrix,
+                global_matrix,
+                tolerance=translation_tolerance(index, object, parent_error, **args),
+                inherited_error=parent_error
+                )
+    else:
+        frame.scale = index.world_scale(object)
+        if args['apply_rotations']:
+            frame.rotation = index.world_rotation(object)
+        if not apply_transform:
+            frame.transform, frame.move_precision, frame.translation_error = create_transform_commands(
+                object,
+                global_matrix,
+                parent_scale=parent_scale,
+                apply_rotation=args['apply_rotations'],
+                parent_rotation=parent_rotation,
+                tolerance=translation_tolerance(index, object, parent_error, **args),
+                inherited_error=parent_error
+                )
+
+    if index.exports_mesh(object):
+        frame.empty = False
+        instances = get_object_instances(index).get(object)
+        # instancers often only output instances
+        if not instances or has_evaluated_faces(object):
+            # watch mode: unchanged objects keep their commands of the last update
+            cache = args.get('fragment_cache')
+            if cache is None or not cache.restore(frame):
+                create_mesh_and_material_commands(preferences, frame, extern_mesh_dir, global_matrix, **args)
+                if cache is not None:
+                    cache.store(frame)
+        if instances:
+            # grouped with the object, like its children
+            frame.child_commands.append(
+                create_object_instance_commands(preferences, index, instances, object, extern_mesh_dir, global_matrix, **args)
+            )
+    elif index.exports_instance(object):
+        frame.empty = False
+        frame.mesh = create_instance_commands(preferences, index, object, extern_mesh_dir, global_matrix, **args)
+
+    return frame
 
+def exit_object_frame( frame, global_matrix, **args ):
+    command = ''
+
+    childCommands = ''.join(frame.child_commands)
     hasChildren = bool(childCommands)
-    empty = empty and not hasChildren
+    empty = frame.empty and not hasChildren
 
     if hasChildren:
-        command += "BeginObjGroup('{}');\n".format(getValidName(object.name))
+        command += "BeginObjGroup('{}');\n".format(getValidName(frame.object.name))
 
-    command += mesh
-    command += material
+    command += frame.mesh
+    command += frame.material
 
     if hasChildren:
         command += childCommands
         command += "EndObjGroup();\n"
         
-    # Transform
-    if not apply_transform and not empty:
-        command += create_transform_commands(
-            object,
-            global_matrix,
-            parent_scale=parent_scale,
-            apply_rotation=apply_rotation,
-            parent_rotation=parent_rotation
-            )
+    # Transform, computed on enter: the children round their translations against what is left
+    if not empty:
+        command += frame.transform
+        report = args.get('report')
+        if report is not None and frame.move_precision is not None:
+            entry = report.object(frame.object)
+            entry.move_precision = frame.move_precision
+            entry.move_error = round(frame.translation_error, 4)
 
     return command
 
-def create_objects_commands(preferences,objects, object_list, extern_mesh_dir, global_matrix, apply_transform=False, **args):
+def run_to_end(generator):
     '''
-    Create the Roomle Script command
-    iterate over all objects and pass them
-    to the create_object_commands
+    Run a step-wise generator to its end and return its return value
+    '''
+    while True:
+        try:
+            next(generator)
+        except StopIteration as result:
+            return result.value
+
+def iter_object_commands(
+    preferences,
+    object,
+    object_list,
+    extern_mesh_dir,
+    global_matrix,
+    parent_scale=None,
+    parent_rotation=None,
+    apply_transform=False,
+    index=None,
+    **args
+    ):
+    '''
+    Generator version of `create_object_commands`, yields once after every
+    processed object and returns the commands
+    '''
+
+    if index is None:
+        index = ExportIndex([object], object_list)
+
+    if object not in index.live:
+        return ''
+
+    stack = [enter_object_frame(
+        preferences, index, object, extern_mesh_dir, global_matrix,
+        parent_scale=parent_scale,
+        parent_rotation=parent_rotation,
+        apply_transform=apply_transform,
+        **args
+        )]
+    yield object
+
+    while True:
+        frame = stack[-1]
+        child = next(frame.children, None)
+        if child is not None:
+            stack.append(enter_object_frame(
+                preferences, index, child, extern_mesh_dir, global_matrix,
+                parent_scale=frame.scale,
+                parent_rotation=frame.rotation,
+                parent_error=frame.translation_error,
+                **args
+                ))
+            yield child
+            continue
+
+        stack.pop()
+        command = exit_object_frame(frame, global_matrix, **args)
+        if not stack:
+            return command
+        stack[-1].child_commands.append(command)
+
+def create_object_commands(preferences, object, object_list, extern_mesh_dir, global_matrix, **args):
+    '''
+    Create all necessary commands for one object and its descendants
+    this function gets called by the loop over all objects
+
+    The hierarchy is walked with an explicit stack, subtrees without anything
+    to export are skipped (see `ExportIndex`)
+    '''
+    return run_to_end(iter_object_commands(preferences, object, object_list, extern_mesh_dir, global_matrix, **args))
+
+def iter_objects_commands(preferences,objects, object_list, extern_mesh_dir, global_matrix, apply_transform=False, index=None, **args):
+    '''
+    Generator version of `create_objects_commands`, yields once after every
+    processed object and returns the script
     '''
     command = ''
     if args['debug']:
@@ -586,11 +1210,21 @@ def create_objects_commands(preferences,objects, object_list, extern_mesh_dir, g
         from . import bl_info
         command += '/* Roomle script (Roomle Blender addon version {}) */\n'.format('.'.join( [str(x) for x in bl_info['version']] ))
 
-    for object in objects:
-        if object:
-            command += create_object_commands(preferences,object, object_list, extern_mesh_dir, global_matrix, **args)
+    if index is None:
+        index = ExportIndex(objects, object_list)
+
+    for object in index.live_roots():
+        command += yield from iter_object_commands(preferences,object, object_list, extern_mesh_dir, global_matrix, index=index, **args)
     return command.rstrip()
 
+def create_objects_commands(preferences,objects, object_list, extern_mesh_dir, global_matrix, **args):
+    '''
+    Create the Roomle Script command
+    iterate over all objects and pass them
+    to the create_object_commands
+    '''
+    return run_to_end(iter_objects_commands(preferences, objects, object_list, extern_mesh_dir, global_matrix, **args))
+
 
 def get_visible_objects(context: bpy.types.Context):
     view_layer = context.view_layer
@@ -635,16 +1269,17 @@ def export_selected_obj(filepath: str, use_mesh_modifiers: bool, export_normals:
         axis_up='Z',
     )
 
-def write_roomle_script( operator, preferences, context, filepath, global_matrix, **args ):
+def iter_roomle_script( operator, preferences, context, filepath, global_matrix, **args ):
     """
-    Write a roomle script file from faces,
+    Write a roomle script file step by step, yields (done, total) after every object.
+    Errors are raised, temporary data is removed in any case.
 
     filepath
        output filepath
-
-    faces
-       iterable of tuple of 3 vertex, vertex is tuple of 3 coordinates as float
     """
+    store = None
+    encoder = None
+    index = None
     try:
 
         scene = bpy.context.scene
@@ -657,15 +1292,72 @@ def write_roomle_script( operator, preferences, context, filepath, global_matrix
         object_list = bpy.context.selected_objects if args['use_selection'] else get_visible_objects(bpy.context)
 
         extern_mesh_dir = os.path.splitext(filepath)[0]
+        script_name = os.path.basename(extern_mesh_dir)
+
+        if args.get('sink') is None:
+            args['sink'] = DirectorySink(os.path.dirname(filepath))
+        sink = args['sink']
+
+        report = ExportReport(textures=[t.to_dict() for t in args.get('texture_reports', [])])
+
+        index = ExportIndex(root_objects, object_list)
+        total = len(index.live)
+
+        # huge inline meshes are streamed into fragments, stitched into the script when it is written
+        if args.get('out_of_core'):
+            store = OutOfCoreStore()
+            args['out_of_core_store'] = store
+        # inline meshes are encoded by worker processes and stitched in hierarchy order
+        if args.get('parallel_encoding'):
+            encoder = ParallelEncoder(args.get('encoder_workers') or None)
+            args['parallel_encoder'] = encoder
+
+        commands = iter_objects_commands(preferences,root_objects,object_list,extern_mesh_dir,global_matrix,index=index,report=report,**args)
+        done = 0
+        while True:
+            try:
+                next(commands)
+            except StopIteration as result:
+                script = result.value
+                break
+            done += 1
+            yield done, total
+
+        if encoder is not None:
+            script = encoder.stitch(script)
 
-        script = create_objects_commands(preferences,root_objects,object_list,extern_mesh_dir,global_matrix,**args)
         if not bool(script):
             raise Exception('Empty export! Make sure you have meshes selected.')
+
+        if args.get('optimize_script') and not args['debug']:
+            keep = {getValidName(obj.name) for obj in index.live if index.keeps_group(obj)}
+            optimized = optimize_script(script, args.get('optimize_tolerance', 0.01), args.get('flatten_hierarchy', False), keep)
+            script = optimized.script
+            report.script = optimized.stats.to_dict()
+            if args.get('write_group_map'):
+                sink.write_text(script_name + '.groups.json', json.dumps(optimized.groups, indent=2))
+
+        if store is not None:
+            store.write_script(sink, os.path.basename(filepath), script)
         else:
-            with open(filepath, 'w') as data:
-                data.write(script)
-    except Exception as e:
-        import traceback
-        print('Exception',e)
-        x = traceback.format_exc()
-        print(x)
+            sink.write_text(os.path.basename(filepath), script)
+
+        if args.get('write_report'):
+            sink.write_text(script_name + '.report.json', report.to_json())
+        operator.report({'INFO'}, report.summary())
+    finally:
+        if index is not None:
+            release_object_instances(index)
+        if store is not None:
+            store.close()
+        if encoder is not None:
+            encoder.close()
+
+def write_roomle_script( operator, preferences, context, filepath, global_matrix, **args ):
+    """
+    Write a roomle script file
+
+    filepath
+       output filepath
+    """
+    run_to_end(iter_roomle_script(operator, preferences, context, filepath, global_matrix, **args))
@@ -0,0 +1,501 @@
+# -----------------------------------------------------------------------
+#
+#  Copyright 2019 Roomle GmbH. All Rights Reserved.
+#
+#  This Software is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND.
+#
+#  NOTICE: All information contained herein is, and remains
+#  the property of Roomle. The intellectual and technical concepts contained
+#  herein are proprietary to Roomle and are protected by copyright law.
+#  Dissemination of this information or reproduction of this material
+#  is strictly forbidden unless prior written permission is obtained
+#  from Roomle.
+# -----------------------------------------------------------------------
+
+'''
+Size optimizer for finished Roomle scripts, pure Python (no Blender):
+
+    python script_optimizer.py product.txt optimized.txt [--groups groups.json] [--flatten] [--keep NAME ...]
+
+Comments are dropped, group names are replaced by short ids (the mapping to
+the original names can be kept), empty groups are removed and the transform
+commands of every object are merged into the fewest commands (scale, rotation,
+move) whose matrix moves no point of the scene by more than a tolerance.
+Mesh and surface commands are copied as they are.
+
+Optionally the hierarchy is flattened first: groups with a single child and
+groups of groups (e.g. the nested empties of CAD imports) are dissolved, their
+transforms are appended to those of their children. Kept groups are neither
+dissolved nor renamed.
+'''
+
+import argparse
+import io
+import itertools
+import json
+import math
+import os
+import re
+import sys
+
+from dataclasses import dataclass, field, asdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    from . import script_parser
+except ImportError:
+    # run as a script or loaded without the package
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import script_parser
+
+
+# fragments of out-of-core exports, kept in place as commands without content
+_PLACEHOLDER = re.compile(r'/\*@(\w+ \d+)\*/')
+PLACEHOLDER_COMMAND = '_Placeholder'
+
+_NAME = re.compile(r'\s*([A-Za-z_][A-Za-z0-9_]*)\s*\(')
+_POSITIONS = re.compile(r'Vector3f\s*\[')
+
+TRANSFORMS = ('MoveMatrixBy', 'ScaleMatrixBy', 'RotateMatrixBy')
+MESHES = ('AddMesh', 'AddExternalMesh', PLACEHOLDER_COMMAND)
+
+MAX_DECIMALS = 8
+_ID_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+@dataclass
+class Node:
+    kind: str                           # group, mesh or placeholder
+    text: str = ''                      # the command of meshes, the original name of groups
+    surface: str = ''
+    transforms: List[Tuple[str, list]] = field(default_factory=list)
+    children: List['Node'] = field(default_factory=list)
+    matrix: list = None
+    reach: float = 0.0                  # max distance of the content from the node's origin, before its transforms
+
+
+@dataclass
+class OptimizeStats:
+    characters_before: int = 0
+    characters_after: int = 0
+    comments: int = 0
+    groups_before: int = 0
+    groups_after: int = 0
+    groups_flattened: int = 0
+    depth_before: int = 0               # deepest group nesting
+    depth_after: int = 0
+    transforms_before: int = 0
+    transforms_after: int = 0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+@dataclass
+class OptimizedScript:
+    script: str
+    groups: Dict[str, str]              # short id -> original group name
+    stats: OptimizeStats
+
+
+# ------------------------------------------------------------ [ vectors ]
+
+def norm(vector) -> float:
+    return math.sqrt(sum(v * v for v in vector))
+
+
+def frobenius(matrix: list) -> float:
+    """bounds how much the linear part of `matrix` stretches any vector"""
+    return math.sqrt(sum(matrix[i][j] ** 2 for i in range(3) for j in range(3)))
+
+
+def linear_difference(a: list, b: list) -> float:
+    return math.sqrt(sum((a[i][j] - b[i][j]) ** 2 for i in range(3) for j in range(3)))
+
+
+def format_number(value: float, decimals: int) -> str:
+    text = f'{value:.{decimals}f}'
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    return '0' if text in ('-0', '') else text
+
+
+def format_vector(values, decimals: int) -> str:
+    return 'Vector3f{' + ','.join(format_number(v, decimals) for v in values) + '}'
+
+
+def short_id(number: int) -> str:
+    text = ''
+    while True:
+        number, digit = divmod(number, len(_ID_DIGITS))
+        text = _ID_DIGITS[digit] + text
+        if not number:
+            return text
+
+
+# ------------------------------------------------------------ [ transforms ]
+
+def decompose(matrix: list) -> Optional[Tuple[list, list, float, list]]:
+    """
+    (scale, axis, degrees, translation) with matrix = move @ rotation @ scale,
+    None if the linear part has a shear that scale and rotation can not express
+    """
+    columns = [[matrix[i][j] for i in range(3)] for j in range(3)]
+    scale = [norm(c) for c in columns]
+    if min(scale) < 1e-12:
+        return None
+    r = [[columns[j][i] / scale[j] for j in range(3)] for i in range(3)]
+    det = (
+        r[0][0] * (r[1][1]*r[2][2] - r[1][2]*r[2][1])
+        - r[0][1] * (r[1][0]*r[2][2] - r[1][2]*r[2][0])
+        + r[0][2] * (r[1][0]*r[2][1] - r[1][1]*r[2][0])
+    )
+    if det < 0:
+        scale[0] = -scale[0]
+        for i in range(3):
+            r[i][0] = -r[i][0]
+    for a in range(3):
+        for b in range(3):
+            dot = sum(r[i][a] * r[i][b] for i in range(3))
+            if abs(dot - (a == b)) > 1e-9:
+                return None
+
+    cos = max(-1.0, min(1.0, (r[0][0] + r[1][1] + r[2][2] - 1) / 2))
+    angle = math.acos(cos)
+    if angle < 1e-12:
+        axis = [0.0, 0.0, 1.0]
+    elif math.pi - angle < 1e-6:
+        # half turn: the axis from the diagonal, signs from the largest component
+        k = max(range(3), key=lambda i: r[i][i])
+        axis = [0.0, 0.0, 0.0]
+        axis[k] = math.sqrt(max(0.0, (r[k][k] + 1) / 2))
+        for i in range(3):
+            if i != k:
+                axis[i] = (r[i][k] + r[k][i]) / (4 * axis[k])
+    else:
+        s = 2 * math.sin(angle)
+        axis = [(r[2][1] - r[1][2]) / s, (r[0][2] - r[2][0]) / s, (r[1][0] - r[0][1]) / s]
+    return scale, axis, math.degrees(angle), [matrix[i][3] for i in range(3)]
+
+
+def linear_commands(scale: list, axis: list, angle: float, decimals: int) -> List[Tuple[str, str, list]]:
+    """(command name, text, parsed arguments) of scale and rotation, identities left out"""
+    commands = []
+    scale_text = [format_number(v, decimals) for v in scale]
+    if scale_text != ['1', '1', '1']:
+        commands.append(('ScaleMatrixBy', 'ScaleMatrixBy(Vector3f{' + ','.join(scale_text) + '})', [tuple(map(float, scale_text))]))
+    angle_text = format_number(angle, decimals)
+    axis_text = [format_number(v, decimals) for v in axis]
+    if float(angle_text) != 0 and axis_text != ['0', '0', '0']:
+        commands.append((
+            'RotateMatrixBy',
+            'RotateMatrixBy(Vector3f{' + ','.join(axis_text) + '},Vector3f{0,0,0},' + angle_text + ')',
+            [tuple(map(float, axis_text)), (0.0, 0.0, 0.0), float(angle_text)],
+        ))
+    return commands
+
+
+def commands_matrix(commands) -> list:
+    matrix = script_parser.IDENTITY
+    for name, _, args in commands:
+        matrix = script_parser.matmul(script_parser.transform_matrix(name, args), matrix)
+    return matrix
+
+
+def merged_commands(matrix: list, reach: float, budget: float) -> Optional[List[str]]:
+    """
+    at most one scale, rotation and move command for `matrix`, with the fewest decimals
+    that keep every point within `reach` of the origin inside `budget` of its position
+    """
+    parts = decompose(matrix)
+    if parts is None:
+        return None
+    scale, axis, angle, translation = parts
+
+    for decimals in range(MAX_DECIMALS + 1):
+        linear = linear_commands(scale, axis, angle, decimals)
+        error = linear_difference(commands_matrix(linear), matrix)
+        if error == 0 or error * reach <= budget / 2:
+            break
+    else:
+        return None
+
+    commands = [text for _, text, _ in linear]
+    for decimals in range(MAX_DECIMALS + 1):
+        rounded = [float(format_number(v, decimals)) for v in translation]
+        if norm([a - b for a, b in zip(rounded, translation)]) <= budget / 2:
+            break
+    else:
+        return None
+    if any(rounded):
+        commands.append('MoveMatrixBy(' + format_vector(rounded, decimals) + ')')
+    return commands
+
+
+def cleaned_commands(transforms: List[Tuple[str, list]]) -> List[str]:
+    """the original commands without identities, consecutive moves, scales and rotations around the same axis merged"""
+    merged: List[Tuple[str, list]] = []
+    for name, args in transforms:
+        args = list(args)
+        if merged and merged[-1][0] == name:
+            previous = merged[-1][1]
+            if name == 'MoveMatrixBy':
+                previous[0] = tuple(a + b for a, b in zip(previous[0], args[0]))
+                continue
+            if name == 'ScaleMatrixBy':
+                previous[0] = tuple(a * b for a, b in zip(previous[0], args[0]))
+                continue
+            if previous[0] == args[0] and previous[1] == args[1]:
+                previous[2] += args[2]
+                continue
+        merged.append((name, args))
+
+    commands = []
+    for name, args in merged:
+        if name == 'MoveMatrixBy' and any(args[0]):
+            commands.append(f'MoveMatrixBy({format_vector(args[0], MAX_DECIMALS)})')
+        elif name == 'ScaleMatrixBy' and args[0] != (1.0, 1.0, 1.0):
+            commands.append(f'ScaleMatrixBy({format_vector(args[0], MAX_DECIMALS)})')
+        elif name == 'RotateMatrixBy' and args[2] % 360 and any(args[0]):
+            axis, pivot, angle = args
+            commands.append(f'RotateMatrixBy({format_vector(axis, MAX_DECIMALS)},{format_vector(pivot, MAX_DECIMALS)},{format_number(angle, MAX_DECIMALS)})')
+    return commands
+
+
+def transform_commands(node: Node, budget: float) -> List[str]:
+    """the shorter of the merged and the cleaned commands of the node"""
+    cleaned = cleaned_commands(node.transforms)
+    if len(cleaned) <= 1:
+        return cleaned
+    merged = merged_commands(node.matrix, node.reach, budget)
+    if merged is None or sum(map(len, merged)) >= sum(map(len, cleaned)):
+        return cleaned
+    return merged
+
+
+# ------------------------------------------------------------ [ tree ]
+
+def mesh_reach(name: str, statement: str) -> float:
+    if name == PLACEHOLDER_COMMAND:
+        # the content is not known here, only exact changes are possible
+        return math.inf
+    if name == 'AddExternalMesh':
+        _, size, origin = script_parser.parse_arguments(statement[statement.index('(') + 1:statement.rindex(')')])
+        return norm(size) + norm(origin)
+    m = _POSITIONS.search(statement)
+    end = statement.index(']', m.end())
+    values = script_parser.parse_arguments(statement[m.start():end + 1])[0].values
+    return max((norm(values[i:i + 3]) for i in range(0, len(values), 3)), default=0.0)
+
+
+def build_tree(script: str, stats: OptimizeStats) -> Tuple[Node, int]:
+    """the objects of the script and the deepest group nesting"""
+    script = _PLACEHOLDER.sub(lambda m: f"{PLACEHOLDER_COMMAND}('{m.group(1)}');", script)
+    parse_stats = script_parser.ParseStats()
+
+    root = Node('group')
+    stack = [root]
+    last: Optional[Node] = None
+    depth = 1
+    for statement in script_parser.iter_statements(io.StringIO(script), stats=parse_stats):
+        if not statement:
+            continue
+        m = _NAME.match(statement)
+        if m is None or not statement.endswith(')'):
+            raise script_parser.ScriptSyntaxError(f'not a command: {statement[:40]!r}')
+        name = m.group(1)
+        if name == 'BeginObjGroup':
+            group = Node('group', text=script_parser.parse_arguments(statement[m.end():-1])[0])
+            stack[-1].children.append(group)
+            stack.append(group)
+            depth = max(depth, len(stack))
+            last = None
+            stats.groups_before += 1
+        elif name == 'EndObjGroup':
+            if len(stack) < 2:
+                raise script_parser.ScriptSyntaxError('EndObjGroup without open group')
+            last = stack.pop()
+        elif name in MESHES:
+            last = Node('placeholder' if name == PLACEHOLDER_COMMAND else 'mesh', text=statement)
+            last.reach = mesh_reach(name, statement)
+            stack[-1].children.append(last)
+        elif name == 'SetObjSurface':
+            if last is None or last.kind == 'group':
+                raise script_parser.ScriptSyntaxError('SetObjSurface without mesh')
+            last.surface = statement
+        elif name in TRANSFORMS:
+            if last is None:
+                raise script_parser.ScriptSyntaxError(f'{name} without object')
+            last.transforms.append((name, script_parser.parse_arguments(statement[m.end():-1])))
+            stats.transforms_before += 1
+        else:
+            raise script_parser.ScriptSyntaxError(f'unknown command {name}')
+    if len(stack) > 1:
+        raise script_parser.ScriptSyntaxError(f'group {stack[-1].text!r} is not closed')
+
+    stats.comments = parse_stats.comments
+    return root, depth
+
+
+def iter_post_order(root: Node) -> Iterator[Node]:
+    stack = [(root, False)]
+    while stack:
+        node, visited = stack.pop()
+        if visited:
+            yield node
+        else:
+            stack.append((node, True))
+            stack.extend((child, False) for child in node.children)
+
+
+def tree_depth(root: Node) -> int:
+    """deepest group nesting below the root"""
+    depth = 0
+    stack = [(root, 0)]
+    while stack:
+        node, level = stack.pop()
+        depth = max(depth, level)
+        stack.extend((child, level + 1) for child in node.children if child.kind == 'group')
+    return depth
+
+
+def dissolvable(node: Node, keep) -> bool:
+    """
+    a group that only passes its transforms on: one child or only groups as children,
+    kept groups do not take over the transforms of their parent
+    """
+    return (
+        node.kind == 'group'
+        and node.text not in keep
+        and bool(node.children)
+        and (len(node.children) == 1 or all(child.kind == 'group' for child in node.children))
+        and not any(child.kind == 'group' and child.text in keep for child in node.children)
+    )
+
+
+def flatten(root: Node, keep=()) -> int:
+    """
+    Dissolve groups into their parents, bottom up, the group's transforms follow the
+    transforms of each of its children. Returns the number of dissolved groups.
+    """
+    dissolved = 0
+    for node in iter_post_order(root):
+        if not any(dissolvable(child, keep) for child in node.children):
+            continue
+        children = []
+        for child in node.children:
+            if not dissolvable(child, keep):
+                children.append(child)
+                continue
+            for grandchild in child.children:
+                grandchild.transforms = grandchild.transforms + child.transforms
+                children.append(grandchild)
+            dissolved += 1
+        node.children = children
+    return dissolved
+
+
+def measure(root: Node):
+    """matrices of all nodes and the reach of groups"""
+    for node in iter_post_order(root):
+        node.matrix = script_parser.node_matrix(node)
+        if node.kind == 'group':
+            node.reach = max((
+                math.inf if child.reach == math.inf else frobenius(child.matrix) * child.reach + norm([child.matrix[i][3] for i in range(3)])
+                for child in node.children
+            ), default=0.0)
+
+
+def emit(root: Node, levels: int, tolerance: float, stats: OptimizeStats, keep=()) -> Tuple[List[str], Dict[str, str]]:
+    """
+    The commands of the tree, without walking it recursively. The tolerance is shared by
+    all levels, the budget of a node is scaled down by how much its ancestors stretch it.
+    Kept groups keep their names.
+    """
+    groups: Dict[str, str] = {}
+    ids = (short_id(n) for n in itertools.count())
+    # open groups: node, remaining children, commands so far, stretch of the node's content
+    stack = [(root, iter(root.children), [], 1.0)]
+    while True:
+        node, children, parts, stretch = stack[-1]
+        budget = tolerance / (stretch * levels) if stretch else tolerance
+        child = next(children, None)
+        if child is not None:
+            if child.kind == 'group':
+                stack.append((child, iter(child.children), [], stretch * frobenius(child.matrix)))
+            else:
+                parts.append(child.text)
+                if child.surface:
+                    parts.append(child.surface)
+                commands = transform_commands(child, budget)
+                parts.extend(commands)
+                stats.transforms_after += len(commands)
+            continue
+
+        stack.pop()
+        if not stack:
+            return parts, groups
+        # empty groups are left out with their transforms
+        if not parts:
+            continue
+        parent_parts, parent_stretch = stack[-1][2], stack[-1][3]
+        stats.depth_after = max(stats.depth_after, len(stack))
+        if node.text in keep:
+            name = node.text
+        else:
+            name = next(n for n in ids if n not in keep)
+            groups[name] = node.text
+        stats.groups_after += 1
+        parent_parts.append(f"BeginObjGroup('{name}')")
+        parent_parts.extend(parts)
+        parent_parts.append('EndObjGroup()')
+        commands = transform_commands(node, tolerance / (parent_stretch * levels) if parent_stretch else tolerance)
+        parent_parts.extend(commands)
+        stats.transforms_after += len(commands)
+
+
+def optimize_script(script: str, tolerance: float = 0.01, flatten_groups: bool = False, keep=()) -> OptimizedScript:
+    """
+    The smallest script with the same scene: no point moves by more than
+    `tolerance` (mm). With `flatten_groups` the hierarchy is flattened, except for the
+    groups named in `keep`. Raises `script_parser.ScriptSyntaxError` for scripts it can not read.
+    """
+    keep = frozenset(keep)
+    stats = OptimizeStats(characters_before=len(script))
+    root, depth = build_tree(script, stats)
+    stats.depth_before = depth - 1
+    if flatten_groups:
+        stats.groups_flattened = flatten(root, keep)
+        depth = tree_depth(root) + 1
+    measure(root)
+    parts, groups = emit(root, depth, tolerance, stats, keep)
+
+    optimized = ''.join(part + ';\n' for part in parts)
+    optimized = re.sub(rf"{PLACEHOLDER_COMMAND}\('([^']*)'\);\n", r'/*@\1*/', optimized)
+    stats.characters_after = len(optimized)
+    return OptimizedScript(optimized, groups, stats)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Shrink a Roomle script without changing its scene')
+    parser.add_argument('script')
+    parser.add_argument('output')
+    parser.add_argument('--groups', help='write the original group names of the short ids as JSON')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='max positional change in mm')
+    parser.add_argument('--flatten', action='store_true', help='dissolve single-child groups and groups of groups')
+    parser.add_argument('--keep', action='append', default=[], metavar='NAME', help='group that is neither dissolved nor renamed')
+    args = parser.parse_args(argv)
+
+    with open(args.script, 'r', encoding='utf-8') as f:
+        optimized = optimize_script(f.read(), args.tolerance, args.flatten, args.keep)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        f.write(optimized.script)
+    if args.groups:
+        with open(args.groups, 'w', encoding='utf-8') as f:
+            json.dump(optimized.groups, f, indent=2)
+    print(json.dumps(optimized.stats.to_dict(), indent=2))
+
+
+if __name__ == '__main__':
+    main()
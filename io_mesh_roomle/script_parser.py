@@ -0,0 +1,555 @@
+# -----------------------------------------------------------------------
+#
+#  Copyright 2019 Roomle GmbH. All Rights Reserved.
+#
+#  This Software is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND.
+#
+#  NOTICE: All information contained herein is, and remains
+#  the property of Roomle. The intellectual and technical concepts contained
+#  herein are proprietary to Roomle and are protected by copyright law.
+#  Dissemination of this information or reproduction of this material
+#  is strictly forbidden unless prior written permission is obtained
+#  from Roomle.
+# -----------------------------------------------------------------------
+
+'''
+Reference parser for the Roomle script commands the exporter writes.
+
+Pure Python (no Blender), so it can validate exported scripts anywhere and
+measure how expensive they are to load:
+
+    python script_parser.py product.txt
+
+The script is read in chunks and parsed statement by statement. Geometry is
+rebuilt into typed arrays, structural invariants (matched groups, index
+bounds, array lengths, ...) are collected as errors, and `compare_scenes`
+checks two scripts for round-trip equivalence.
+'''
+
+import io
+import json
+import math
+import re
+import sys
+import time
+
+from array import array
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional, TextIO, Tuple, Union
+
+# start of tokens that change how the following characters are read
+_SPECIAL = re.compile(r"[;']|/\*|//")
+_CALL = re.compile(r'\s*([A-Za-z_][A-Za-z0-9_]*)\s*\((.*)\)\s*$', re.S)
+_NUMBER = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+_VECTOR = re.compile(r'Vector([23])f\s*([\[{])')
+_SPACE = re.compile(r'\s*')
+
+
+class ScriptSyntaxError(Exception):
+    pass
+
+
+@dataclass
+class VectorArray:
+    dimension: int
+    values: array
+
+    def __len__(self) -> int:
+        return len(self.values) // self.dimension
+
+
+@dataclass
+class Command:
+    name: str
+    args: list
+    index: int          # number of the statement in the script
+
+
+@dataclass
+class MeshData:
+    positions: array                    # x,y,z,x,y,z,...
+    indices: array
+    uvs: Optional[array] = None         # u,v,u,v,...
+    normals: Optional[array] = None
+
+    @property
+    def vertex_count(self) -> int:
+        return len(self.positions) // 3
+
+    @property
+    def triangle_count(self) -> int:
+        return len(self.indices) // 3
+
+
+@dataclass
+class ScriptNode:
+    kind: str                           # group, mesh or external
+    name: str = ''                      # group name or external mesh id
+    mesh: Optional[MeshData] = None
+    bounds: Optional[Tuple[tuple, tuple]] = None   # external mesh size and origin
+    surface: Optional[str] = None
+    transforms: List[Tuple[str, list]] = field(default_factory=list)
+    children: List['ScriptNode'] = field(default_factory=list)
+
+
+@dataclass
+class ParseStats:
+    characters: int = 0
+    seconds: float = 0.0
+    commands: Counter = field(default_factory=Counter)
+    comments: int = 0
+    vertices: int = 0
+    triangles: int = 0
+
+    @property
+    def throughput(self) -> float:
+        """parsed megabytes (characters) per second"""
+        return self.characters / 1e6 / self.seconds if self.seconds > 0 else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            'characters': self.characters,
+            'seconds': round(self.seconds, 6),
+            'throughput_mb_s': round(self.throughput, 3),
+            'commands': dict(self.commands),
+            'comments': self.comments,
+            'vertices': self.vertices,
+            'triangles': self.triangles,
+        }
+
+
+@dataclass
+class FlatObject:
+    """an object of the scene with its world matrix applied"""
+    kind: str
+    name: str
+    surface: Optional[str]
+    matrix: list
+    positions: Optional[list] = None    # world positions of inline meshes
+    mesh: Optional[MeshData] = None
+
+
+@dataclass
+class ParsedScript:
+    root: ScriptNode
+    stats: ParseStats
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def valid(self) -> bool:
+        return not self.errors
+
+    def iter_nodes(self) -> Iterator[Tuple[ScriptNode, int]]:
+        """all nodes with their group depth, in document order"""
+        stack = [(child, 1) for child in reversed(self.root.children)]
+        while stack:
+            node, depth = stack.pop()
+            yield node, depth
+            stack.extend((child, depth + 1) for child in reversed(node.children))
+
+    def flatten(self) -> List[FlatObject]:
+        """all meshes in document order with their world matrices"""
+        result = []
+        stack = [(child, IDENTITY) for child in reversed(self.root.children)]
+        while stack:
+            node, parent_matrix = stack.pop()
+            matrix = matmul(parent_matrix, node_matrix(node))
+            if node.kind == 'group':
+                stack.extend((child, matrix) for child in reversed(node.children))
+                continue
+            flat = FlatObject(kind=node.kind, name=node.name, surface=node.surface, matrix=matrix, mesh=node.mesh)
+            if node.mesh is not None:
+                flat.positions = transform_points(matrix, node.mesh.positions)
+            result.append(flat)
+        return result
+
+
+# ------------------------------------------------------------ [ matrices ]
+
+IDENTITY = [[1.0 if i == j else 0.0 for j in range(4)] for i in range(4)]
+
+
+def matmul(a: list, b: list) -> list:
+    return [[sum(a[i][k] * b[k][j] for k in range(4)) for j in range(4)] for i in range(4)]
+
+
+def translation(x: float, y: float, z: float) -> list:
+    m = [row[:] for row in IDENTITY]
+    m[0][3], m[1][3], m[2][3] = x, y, z
+    return m
+
+
+def rotation(axis: tuple, degrees: float) -> list:
+    length = math.sqrt(sum(a * a for a in axis))
+    if length == 0:
+        return [row[:] for row in IDENTITY]
+    x, y, z = (a / length for a in axis)
+    angle = math.radians(degrees)
+    c, s, t = math.cos(angle), math.sin(angle), 1 - math.cos(angle)
+    return [
+        [t*x*x + c,   t*x*y - s*z, t*x*z + s*y, 0.0],
+        [t*x*y + s*z, t*y*y + c,   t*y*z - s*x, 0.0],
+        [t*x*z - s*y, t*y*z + s*x, t*z*z + c,   0.0],
+        [0.0, 0.0, 0.0, 1.0],
+    ]
+
+
+def transform_matrix(name: str, args: list) -> list:
+    if name == 'MoveMatrixBy':
+        return translation(*args[0])
+    if name == 'ScaleMatrixBy':
+        m = [row[:] for row in IDENTITY]
+        m[0][0], m[1][1], m[2][2] = args[0]
+        return m
+    if name == 'RotateMatrixBy':
+        axis, pivot, angle = args
+        px, py, pz = pivot
+        return matmul(translation(px, py, pz), matmul(rotation(axis, angle), translation(-px, -py, -pz)))
+    raise ScriptSyntaxError(f'unknown transform {name}')
+
+
+def node_matrix(node: ScriptNode) -> list:
+    """transforms are applied in order, each one to the result of the previous ones"""
+    matrix = IDENTITY
+    for name, args in node.transforms:
+        matrix = matmul(transform_matrix(name, args), matrix)
+    return matrix
+
+
+def transform_points(matrix: list, positions: array) -> list:
+    (a, b, c, d), (e, f, g, h), (i, j, k, l) = matrix[0], matrix[1], matrix[2]
+    result = []
+    for n in range(0, len(positions), 3):
+        x, y, z = positions[n], positions[n+1], positions[n+2]
+        result += (a*x + b*y + c*z + d, e*x + f*y + g*z + h, i*x + j*y + k*z + l)
+    return result
+
+
+# ------------------------------------------------------------ [ lexing ]
+
+def iter_statements(stream: TextIO, chunk_size: int = 1 << 20, stats: ParseStats = None) -> Iterator[str]:
+    """
+    Split the script into statements (without the `;`), comments removed.
+    Reads `chunk_size` characters at a time, only the current statement is kept in memory.
+    """
+    buffer = ''
+    pos = 0
+    parts = []
+    eof = False
+
+    def refill(keep_from: int):
+        nonlocal buffer, pos, eof
+        parts.append(buffer[pos:keep_from])
+        chunk = stream.read(chunk_size)
+        if stats is not None:
+            stats.characters += len(chunk)
+        if not chunk:
+            eof = True
+        buffer = buffer[keep_from:] + chunk
+        pos = 0
+
+    while True:
+        m = _SPECIAL.search(buffer, pos)
+        if m is None:
+            if eof:
+                rest = (''.join(parts) + buffer[pos:]).strip()
+                if rest:
+                    raise ScriptSyntaxError(f'statement without ";" at end of script: {rest[:40]}')
+                return
+            # a "/" at the end could be the start of a comment
+            refill(len(buffer) - 1 if buffer.endswith('/') else len(buffer))
+            continue
+
+        token = m.group()
+        if token == ';':
+            parts.append(buffer[pos:m.start()])
+            statement = ''.join(parts).strip()
+            parts = []
+            pos = m.end()
+            yield statement
+        elif token == "'":
+            end = buffer.find("'", m.end())
+            if end < 0:
+                if eof:
+                    raise ScriptSyntaxError('unterminated string')
+                refill(m.start())
+                continue
+            parts.append(buffer[pos:end + 1])
+            pos = end + 1
+        else:
+            block = token == '/*'
+            end = buffer.find('*/' if block else '\n', m.end())
+            if end < 0:
+                if eof:
+                    if block:
+                        raise ScriptSyntaxError('unterminated comment')
+                    end = len(buffer)
+                else:
+                    refill(m.start())
+                    continue
+            if stats is not None:
+                stats.comments += 1
+            parts.append(buffer[pos:m.start()])
+            pos = end + (2 if block else 1)
+
+
+def _parse_vector(text: str, pos: int, dimension: int) -> Tuple[tuple, int]:
+    end = text.find('}', pos)
+    if end < 0:
+        raise ScriptSyntaxError('unterminated vector')
+    values = tuple(float(v) for v in _NUMBER.findall(text, pos, end))
+    if len(values) != dimension:
+        raise ScriptSyntaxError(f'Vector{dimension}f with {len(values)} values')
+    return values, end + 1
+
+
+def _parse_vector_array(text: str, pos: int, dimension: int) -> Tuple[VectorArray, int]:
+    end = text.find(']', pos)
+    if end < 0:
+        raise ScriptSyntaxError('unterminated vector array')
+    values = array('d', map(float, _NUMBER.findall(text, pos, end)))
+    if text.count('{', pos, end) * dimension != len(values):
+        raise ScriptSyntaxError(f'Vector{dimension}f array with incomplete vectors')
+    return VectorArray(dimension, values), end + 1
+
+
+def parse_arguments(text: str) -> list:
+    args = []
+    pos = _SPACE.match(text, 0).end()
+    while pos < len(text):
+        char = text[pos]
+        if char == "'":
+            end = text.find("'", pos + 1)
+            args.append(text[pos + 1:end])
+            pos = end + 1
+        elif char == '[':
+            end = text.find(']', pos)
+            if end < 0:
+                raise ScriptSyntaxError('unterminated index array')
+            args.append(array('q', map(int, _NUMBER.findall(text, pos, end))))
+            pos = end + 1
+        else:
+            m = _VECTOR.match(text, pos)
+            if m:
+                dimension = int(m.group(1))
+                if m.group(2) == '{':
+                    value, pos = _parse_vector(text, m.end(), dimension)
+                else:
+                    value, pos = _parse_vector_array(text, m.end(), dimension)
+                args.append(value)
+            else:
+                m = _NUMBER.match(text, pos)
+                if not m:
+                    raise ScriptSyntaxError(f'unexpected argument {text[pos:pos+20]!r}')
+                args.append(float(m.group()))
+                pos = m.end()
+
+        pos = _SPACE.match(text, pos).end()
+        if pos < len(text):
+            if text[pos] != ',':
+                raise ScriptSyntaxError(f'expected "," but found {text[pos:pos+20]!r}')
+            pos = _SPACE.match(text, pos + 1).end()
+    return args
+
+
+def iter_commands(stream: TextIO, chunk_size: int = 1 << 20, stats: ParseStats = None) -> Iterator[Command]:
+    for index, statement in enumerate(iter_statements(stream, chunk_size, stats)):
+        if not statement:
+            continue
+        m = _CALL.match(statement)
+        if not m:
+            raise ScriptSyntaxError(f'statement {index}: not a command: {statement[:40]!r}')
+        yield Command(m.group(1), parse_arguments(m.group(2)), index)
+
+
+# ------------------------------------------------------------ [ scene ]
+
+class _SceneBuilder:
+    """applies commands to a node tree and checks the structural invariants"""
+
+    def __init__(self, stats: ParseStats) -> None:
+        self.root = ScriptNode('group')
+        self.stack = [self.root]
+        self.last: Optional[ScriptNode] = None
+        self.errors: List[str] = []
+        self.stats = stats
+
+    def error(self, command: Command, message: str):
+        self.errors.append(f'statement {command.index} {command.name}: {message}')
+
+    def add(self, node: ScriptNode):
+        self.stack[-1].children.append(node)
+        self.last = node
+
+    def expect(self, command: Command, *types) -> bool:
+        if len(command.args) != len(types) or not all(isinstance(a, t) for a, t in zip(command.args, types)):
+            self.error(command, 'unexpected arguments')
+            return False
+        return True
+
+    def apply(self, command: Command):
+        self.stats.commands[command.name] += 1
+        handler = getattr(self, f'cmd_{command.name}', None)
+        if handler is None:
+            self.error(command, 'unknown command')
+            return
+        handler(command)
+
+    def cmd_AddMesh(self, command: Command):
+        args = command.args
+        if len(args) < 2 or not isinstance(args[0], VectorArray) or not isinstance(args[1], array):
+            self.error(command, 'expected positions and indices')
+            return
+        positions, indices = args[0], args[1]
+        mesh = MeshData(positions=positions.values, indices=indices)
+
+        if positions.dimension != 3:
+            self.error(command, 'positions are not Vector3f')
+        count = len(positions)
+        if len(indices) % 3:
+            self.error(command, f'{len(indices)} indices is not a multiple of 3')
+        if len(indices) and (min(indices) < 0 or max(indices) >= count):
+            self.error(command, f'index out of bounds (0...{count-1})')
+
+        for extra in args[2:]:
+            if not isinstance(extra, VectorArray):
+                self.error(command, 'unexpected argument')
+            elif extra.dimension == 2 and mesh.uvs is None and mesh.normals is None:
+                mesh.uvs = extra.values
+            elif extra.dimension == 3 and mesh.normals is None:
+                mesh.normals = extra.values
+            else:
+                self.error(command, 'unexpected argument')
+                continue
+            if len(extra) != count:
+                self.error(command, f'{len(extra)} Vector{extra.dimension}f for {count} vertices')
+
+        self.stats.vertices += count
+        self.stats.triangles += len(indices) // 3
+        self.add(ScriptNode('mesh', mesh=mesh))
+
+    def cmd_AddExternalMesh(self, command: Command):
+        if not self.expect(command, str, tuple, tuple):
+            return
+        mesh_id, size, origin = command.args
+        if ':' not in mesh_id:
+            self.error(command, f'mesh id {mesh_id!r} without catalog')
+        if any(s < 0 for s in size):
+            self.error(command, 'negative bounding box size')
+        self.add(ScriptNode('external', name=mesh_id, bounds=(size, origin)))
+
+    def cmd_BeginObjGroup(self, command: Command):
+        if not self.expect(command, str):
+            return
+        group = ScriptNode('group', name=command.args[0])
+        self.stack[-1].children.append(group)
+        self.stack.append(group)
+        self.last = None
+
+    def cmd_EndObjGroup(self, command: Command):
+        if len(self.stack) < 2:
+            self.error(command, 'no open group')
+            return
+        self.last = self.stack.pop()
+
+    def cmd_SetObjSurface(self, command: Command):
+        if not self.expect(command, str):
+            return
+        if self.last is None or self.last.kind == 'group':
+            self.error(command, 'no mesh to apply the surface to')
+            return
+        self.last.surface = command.args[0]
+
+    def transform(self, command: Command, *types):
+        if not self.expect(command, *types):
+            return
+        if self.last is None:
+            self.error(command, 'nothing to transform')
+            return
+        self.last.transforms.append((command.name, command.args))
+
+    def cmd_MoveMatrixBy(self, command: Command):
+        self.transform(command, tuple)
+
+    def cmd_ScaleMatrixBy(self, command: Command):
+        self.transform(command, tuple)
+
+    def cmd_RotateMatrixBy(self, command: Command):
+        self.transform(command, tuple, tuple, float)
+
+    def finish(self):
+        for group in self.stack[1:]:
+            self.errors.append(f'group {group.name!r} is not closed')
+
+
+def parse_script(source: Union[str, TextIO], chunk_size: int = 1 << 20) -> ParsedScript:
+    """parse a script text or a text stream"""
+    if isinstance(source, str):
+        source = io.StringIO(source)
+
+    stats = ParseStats()
+    builder = _SceneBuilder(stats)
+    start = time.perf_counter()
+    try:
+        for command in iter_commands(source, chunk_size, stats):
+            builder.apply(command)
+        builder.finish()
+    except ScriptSyntaxError as e:
+        builder.errors.append(f'syntax error: {e}')
+    stats.seconds = time.perf_counter() - start
+    return ParsedScript(root=builder.root, stats=stats, errors=builder.errors)
+
+
+def parse_file(path, chunk_size: int = 1 << 20) -> ParsedScript:
+    with open(path, 'r', encoding='utf-8') as f:
+        return parse_script(f, chunk_size)
+
+
+def _close(a, b, tolerance: float) -> bool:
+    return len(a) == len(b) and all(abs(x - y) <= tolerance for x, y in zip(a, b))
+
+
+def compare_scenes(a: ParsedScript, b: ParsedScript, tolerance: float = 0.05) -> List[str]:
+    """
+    Differences between the scenes of two scripts, ignoring group names and structure.
+    Positions and translations are compared with `tolerance` (mm), normals and UVs
+    with a fixed 1e-3.
+    """
+    differences = []
+    flat_a, flat_b = a.flatten(), b.flatten()
+    if len(flat_a) != len(flat_b):
+        return [f'{len(flat_a)} objects != {len(flat_b)} objects']
+
+    for n, (x, y) in enumerate(zip(flat_a, flat_b)):
+        where = f'object {n}'
+        if (x.kind, x.name, x.surface) != (y.kind, y.name, y.surface):
+            differences.append(f'{where}: {(x.kind, x.name, x.surface)} != {(y.kind, y.name, y.surface)}')
+            continue
+        if x.mesh is None:
+            rows = zip(x.matrix[:3], y.matrix[:3])
+            if not all(_close(r[:3], s[:3], 1e-3) and abs(r[3] - s[3]) <= tolerance for r, s in rows):
+                differences.append(f'{where}: different transform')
+            continue
+        if not _close(x.positions, y.positions, tolerance):
+            differences.append(f'{where}: different positions')
+        if list(x.mesh.indices) != list(y.mesh.indices):
+            differences.append(f'{where}: different indices')
+        for attribute in ('uvs', 'normals'):
+            values_a, values_b = getattr(x.mesh, attribute), getattr(y.mesh, attribute)
+            if (values_a is None) != (values_b is None) or (values_a is not None and not _close(values_a, values_b, 1e-3)):
+                differences.append(f'{where}: different {attribute}')
+    return differences
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f'usage: {sys.argv[0]} script.txt [script.txt ...]')
+        sys.exit(2)
+    failed = False
+    for path in sys.argv[1:]:
+        parsed = parse_file(path)
+        print(json.dumps({'file': path, 'stats': parsed.stats.to_dict(), 'errors': parsed.errors}, indent=2))
+        failed |= not parsed.valid
+    sys.exit(1 if failed else 0)
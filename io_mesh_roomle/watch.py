@@ -0,0 +1,314 @@
+# -----------------------------------------------------------------------
+#
+#  Copyright 2019 Roomle GmbH. All Rights Reserved.
+#
+#  This Software is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND.
+#
+#  NOTICE: All information contained herein is, and remains
+#  the property of Roomle. The intellectual and technical concepts contained
+#  herein are proprietary to Roomle and are protected by copyright law.
+#  Dissemination of this information or reproduction of this material
+#  is strictly forbidden unless prior written permission is obtained
+#  from Roomle.
+# -----------------------------------------------------------------------
+
+"""
+Watch mode: after an export with "Watch Mode" the changes of objects, meshes and
+materials are tracked with a depsgraph handler. "Update Roomle Export" (or saving
+the blend file) exports again, reusing the cached mesh and material commands of
+all objects whose geometry did not change and only writing the changed material rows.
+Changed materials are compared again with the materials they were merged with.
+"""
+
+import logging
+import os
+import time
+
+import bpy
+
+from bpy.app.handlers import persistent
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Set
+
+log = logging.getLogger('roomle watch')
+
+
+@dataclass
+class CachedFragment:
+    signature: tuple
+    mesh: str
+    material: str
+
+
+def fragment_signature(frame) -> tuple:
+    """what the mesh and material commands of a frame were made from, besides the mesh data"""
+    object = frame.object
+    return (
+        object.data.name,
+        None if frame.scale is None else tuple(round(v, 6) for v in frame.scale),
+        None if frame.rotation is None else tuple(round(v, 6) for v in frame.rotation),
+        None if frame.bake is None else tuple(round(v, 6) for row in frame.bake for v in row),
+        tuple(slot.name for slot in object.material_slots),
+    )
+
+
+class FragmentCache:
+    """
+    Mesh and material commands per object of the last export.
+    Entries are dropped when the object's geometry changes and not used
+    when the object's scale, applied rotation, baked transform, mesh or materials differ.
+    """
+
+    def __init__(self) -> None:
+        self.fragments: Dict[str, CachedFragment] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def restore(self, frame) -> bool:
+        """fill the frame from the cache, False if there is no valid entry"""
+        cached = self.fragments.get(frame.object.name)
+        if cached is None or cached.signature != fragment_signature(frame):
+            self.misses += 1
+            return False
+        frame.mesh, frame.material = cached.mesh, cached.material
+        self.hits += 1
+        return True
+
+    def store(self, frame):
+        # placeholders of fragment files and encoder jobs are only valid in their export
+        if '/*@' in frame.mesh:
+            return
+        self.fragments[frame.object.name] = CachedFragment(fragment_signature(frame), frame.mesh, frame.material)
+
+    def invalidate(self, names: Set[str]):
+        for name in names:
+            self.fragments.pop(name, None)
+
+
+class LogReporter:
+    """stands in for an operator when the update runs from a handler"""
+
+    def report(self, type, message):
+        log.info(message)
+
+
+@dataclass
+class ExportWatcher:
+    keywords: Optional[dict] = None
+    global_matrix: object = None
+    cache: FragmentCache = field(default_factory=FragmentCache)
+    dirty_objects: Set[str] = field(default_factory=set)
+    dirty_meshes: Set[str] = field(default_factory=set)
+    dirty_materials: Set[str] = field(default_factory=set)
+    exporting: bool = False
+
+    @property
+    def active(self) -> bool:
+        return self.keywords is not None
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self.dirty_objects or self.dirty_meshes or self.dirty_materials)
+
+    def start(self, keywords: dict, global_matrix) -> Optional[str]:
+        """watch with the options of an export, returns why it is not possible or `None`"""
+        if keywords.get('package_zip'):
+            return 'Watch mode needs a folder export, not a zip archive'
+        if keywords.get('export_materials') and keywords.get('texture_atlas'):
+            # the atlas UVs only exist on the scene copy of a full export
+            return 'Watch mode can not be used with Texture Atlas'
+        self.keywords = {
+            key: value for key, value in keywords.items()
+            if key not in ('sink', 'report', 'fragment_cache', 'texture_reports', 'watch')
+        }
+        self.global_matrix = global_matrix.copy()
+        # the cache is filled by the first update, the full export may run on a split scene copy
+        self.cache = FragmentCache()
+        self.dirty_objects.clear()
+        self.dirty_meshes.clear()
+        self.dirty_materials.clear()
+        return None
+
+    def stop(self):
+        self.keywords = None
+        self.cache = FragmentCache()
+
+    def track(self, depsgraph):
+        if not self.active or self.exporting:
+            return
+        for update in depsgraph.updates:
+            datablock = getattr(update.id, 'original', update.id)
+            if isinstance(datablock, bpy.types.Object):
+                # transforms are written again on every update anyway
+                if update.is_updated_geometry:
+                    self.dirty_objects.add(datablock.name)
+            elif isinstance(datablock, bpy.types.Mesh):
+                self.dirty_meshes.add(datablock.name)
+            elif isinstance(datablock, bpy.types.Material):
+                self.dirty_materials.add(datablock.name)
+
+    def changed_objects(self, scene) -> Set[str]:
+        names = set(self.dirty_objects)
+        if self.dirty_meshes:
+            names.update(obj.name for obj in scene.objects if obj.data is not None and obj.data.name in self.dirty_meshes)
+        return names
+
+    def merged_materials(self, names: Set[str]) -> Set[str]:
+        """the materials with all materials they were merged with, their duplicates are decided again"""
+        from .roomle_script import get_material_id
+
+        aliases = self.keywords.get('material_aliases')
+        canonical = {get_material_id(name, aliases) for name in names}
+        return set(names) | {
+            material.name for material in bpy.data.materials
+            if get_material_id(material.name, aliases) in canonical
+        }
+
+    def update_aliases(self, names: Set[str], aliases: Dict[str, str]) -> Set[str]:
+        """replace the aliases of the exported materials, returns the materials whose id in the script changed"""
+        from .roomle_script import get_material_id, getValidName
+
+        before = self.keywords.get('material_aliases') or {}
+        ids = {getValidName(name) for name in names}
+        after = {alias: canonical for alias, canonical in before.items() if alias not in ids}
+        after.update(aliases)
+        self.keywords['material_aliases'] = after
+        return {name for name in names if get_material_id(name, before) != get_material_id(name, after)}
+
+    def update(self, operator=None) -> float:
+        """export again from the cache and the changes, returns the seconds it took"""
+        from . import roomle_script
+        from .material_exporter import export_materials
+        from .packaging import DirectorySink
+
+        start = time.perf_counter()
+        operator = operator or LogReporter()
+        keywords = dict(self.keywords)
+        preferences = bpy.context.preferences.addons[__package__].preferences
+        scene = bpy.context.scene
+        self.cache.hits = self.cache.misses = 0
+
+        self.exporting = True
+        try:
+            self.cache.invalidate(self.changed_objects(scene))
+            sink = DirectorySink(os.path.dirname(keywords['filepath']))
+            if keywords['export_materials'] and self.dirty_materials:
+                # a changed material may no longer equal the ones it was merged with
+                names = self.merged_materials(self.dirty_materials)
+                result = export_materials(
+                    **dict(
+                        keywords,
+                        sink=sink,
+                        material_names=names,
+                        materials_upsert=True,
+                    )
+                )
+                renamed = self.update_aliases(names, result.aliases)
+                keywords['material_aliases'] = self.keywords['material_aliases']
+                # the cached material commands of their objects name the old id
+                self.cache.invalidate({
+                    obj.name for obj in scene.objects
+                    if any(slot.material is not None and slot.material.name in renamed for slot in obj.material_slots)
+                })
+            self.dirty_objects.clear()
+            self.dirty_meshes.clear()
+            self.dirty_materials.clear()
+
+            roomle_script.write_roomle_script(
+                operator,
+                preferences,
+                bpy.context,
+                global_matrix=self.global_matrix,
+                sink=sink,
+                fragment_cache=self.cache,
+                **keywords
+            )
+        finally:
+            self.exporting = False
+
+        seconds = time.perf_counter() - start
+        operator.report({'INFO'}, f'Roomle export updated in {seconds:.2f}s ({self.cache.hits} objects from cache)')
+        return seconds
+
+
+watcher = ExportWatcher()
+
+
+@persistent
+def on_depsgraph_update(scene, depsgraph):
+    watcher.track(depsgraph)
+
+
+@persistent
+def on_save(*args):
+    if watcher.active and watcher.dirty:
+        try:
+            watcher.update()
+        except Exception:
+            log.exception('Roomle export update failed')
+
+
+@persistent
+def on_load(*args):
+    # the tracked names belong to the previous file
+    watcher.stop()
+
+
+class ExportRoomleWatchUpdate(bpy.types.Operator):
+    """Export again with the options of the watched export, only changed objects and materials are regenerated"""
+
+    bl_idname = "export_mesh.roomle_watch_update"
+    bl_label = "Update Roomle Export"
+
+    @classmethod
+    def poll(cls, context):
+        return watcher.active and context.mode == 'OBJECT'
+
+    def execute(self, context):
+        try:
+            watcher.update(self)
+        except Exception as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
+        return {'FINISHED'}
+
+
+class ExportRoomleWatchStop(bpy.types.Operator):
+    """Stop tracking changes for the Roomle export"""
+
+    bl_idname = "export_mesh.roomle_watch_stop"
+    bl_label = "Stop Roomle Watch Mode"
+
+    @classmethod
+    def poll(cls, context):
+        return watcher.active
+
+    def execute(self, context):
+        watcher.stop()
+        return {'FINISHED'}
+
+
+def menu_watch(self, context):
+    if watcher.active:
+        self.layout.operator(ExportRoomleWatchUpdate.bl_idname)
+        self.layout.operator(ExportRoomleWatchStop.bl_idname)
+
+
+def register():
+    bpy.utils.register_class(ExportRoomleWatchUpdate)
+    bpy.utils.register_class(ExportRoomleWatchStop)
+    bpy.types.TOPBAR_MT_file_export.append(menu_watch)
+    bpy.app.handlers.depsgraph_update_post.append(on_depsgraph_update)
+    bpy.app.handlers.save_post.append(on_save)
+    bpy.app.handlers.load_post.append(on_load)
+
+
+def unregister():
+    bpy.app.handlers.load_post.remove(on_load)
+    bpy.app.handlers.save_post.remove(on_save)
+    bpy.app.handlers.depsgraph_update_post.remove(on_depsgraph_update)
+    bpy.types.TOPBAR_MT_file_export.remove(menu_watch)
+    bpy.utils.unregister_class(ExportRoomleWatchStop)
+    bpy.utils.unregister_class(ExportRoomleWatchUpdate)
+    watcher.stop()
@@ -0,0 +1,300 @@
+"""
+Material export benchmark, runs inside Blender:
+
+    blender --background --factory-startup --python test/bench_materials.py -- [--materials 500] [--images 24] [--out bench.json]
+
+Generates materials with every node setup the `pbr_channels` testers recognize,
+random distractor nodes and images of different sizes shared between materials.
+Times the shader analysis (`PBR_ShaderData`), texture naming (`TextureNameManager`),
+image saving and CSV writing separately and checks that the analysis found the
+textures the node trees were built with.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from collections import Counter
+
+import bpy
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from io_mesh_roomle.material_exporter import (
+    BlenderMaterialForExport,
+    RoomleMaterialsCsv,
+    TextureNameManager,
+    pbr_2_material_definition,
+    save_image,
+)
+from io_mesh_roomle.material_exporter.socket_analyzer import PBR_ShaderData
+from io_mesh_roomle.packaging import DirectorySink
+
+DISTRACTOR_NODES = (
+    'ShaderNodeTexNoise',
+    'ShaderNodeMath',
+    'ShaderNodeRGB',
+    'ShaderNodeValue',
+    'ShaderNodeMapping',
+    'ShaderNodeBump',
+    'ShaderNodeHueSaturation',
+)
+
+
+def create_images(count, sizes, rng):
+    """shared images with blocky noise, compressing somewhere between flat color and pure noise"""
+    images = []
+    for n in range(count):
+        size = sizes[n % len(sizes)]
+        image = bpy.data.images.new(f'bench_{n}_{size}', size, size, alpha=False)
+        block = max(1, size // 64)
+        noise = rng.random((size // block, size // block, 4), dtype=np.float32)
+        pixels = np.kron(noise, np.ones((block, block, 1), dtype=np.float32))
+        pixels[..., 3] = 1
+        image.pixels.foreach_set(pixels.ravel())
+        image.file_format = 'PNG'
+        images.append(image)
+    return images
+
+
+def output_socket(node, identifier):
+    return next(s for s in node.outputs if s.identifier == identifier)
+
+
+def input_socket(node, identifier):
+    return next(s for s in node.inputs if s.identifier == identifier)
+
+
+class MaterialBuilder:
+    """node setups by channel, each returns the image the analysis should find"""
+
+    def __init__(self, material, images, rng):
+        self.material = material
+        self.tree = material.node_tree
+        self.principled = next(n for n in self.tree.nodes if n.type == 'BSDF_PRINCIPLED')
+        self.images = images
+        self.rng = rng
+
+    def link(self, output, input):
+        self.tree.links.new(output, input)
+
+    def texture(self):
+        node = self.tree.nodes.new('ShaderNodeTexImage')
+        node.image = self.rng.choice(self.images)
+        if self.rng.random() < 0.5:
+            # the usual glTF import setup in front of textures
+            coordinates = self.tree.nodes.new('ShaderNodeTexCoord')
+            mapping = self.tree.nodes.new('ShaderNodeMapping')
+            self.link(coordinates.outputs['UV'], mapping.inputs['Vector'])
+            self.link(mapping.outputs['Vector'], node.inputs['Vector'])
+        return node
+
+    def mix(self, factor):
+        node = self.tree.nodes.new('ShaderNodeMix')
+        node.data_type = 'RGBA'
+        input_socket(node, 'Factor_Float').default_value = factor
+        return node
+
+    @property
+    def base_color(self):
+        return self.principled.inputs[0]
+
+    def diffuse_color(self):
+        self.base_color.default_value = (self.rng.random(), self.rng.random(), self.rng.random(), 1)
+
+    def diffuse_image(self):
+        texture = self.texture()
+        self.link(texture.outputs['Color'], self.base_color)
+        return texture.image
+
+    def diffuse_mix_rgb(self):
+        # legacy mix node of Blender < 3.4 files
+        texture = self.texture()
+        mix = self.tree.nodes.new('ShaderNodeMixRGB')
+        self.link(texture.outputs['Color'], mix.inputs[1])
+        self.link(mix.outputs[0], self.base_color)
+        return texture.image
+
+    def diffuse_mix_image(self):
+        texture = self.texture()
+        mix = self.mix(self.rng.choice((0.0, 1.0)))
+        side = self.rng.choice(('A_Color', 'B_Color'))
+        self.link(texture.outputs['Color'], input_socket(mix, side))
+        self.link(output_socket(mix, 'Result_Color'), self.base_color)
+        return texture.image
+
+    def diffuse_mix_color(self):
+        # vertex color multiplied with a color
+        attribute = self.tree.nodes.new('ShaderNodeVertexColor')
+        mix = self.mix(1.0)
+        self.link(attribute.outputs['Color'], input_socket(mix, 'A_Color'))
+        input_socket(mix, 'B_Color').default_value = (self.rng.random(), self.rng.random(), self.rng.random(), 1)
+        self.link(output_socket(mix, 'Result_Color'), self.base_color)
+
+    def normal_map(self):
+        texture = self.texture()
+        normal_map = self.tree.nodes.new('ShaderNodeNormalMap')
+        self.link(texture.outputs['Color'], normal_map.inputs['Color'])
+        self.link(normal_map.outputs['Normal'], self.principled.inputs['Normal'])
+        return texture.image
+
+    def no_normal_map(self):
+        pass
+
+    def orm_values(self):
+        self.principled.inputs['Roughness'].default_value = self.rng.random()
+        self.principled.inputs['Metallic'].default_value = self.rng.choice((0.0, 1.0))
+        return None, None
+
+    def orm_image(self):
+        texture = self.texture()
+        separate = self.tree.nodes.new('ShaderNodeSeparateColor')
+        self.link(texture.outputs['Color'], separate.inputs[0])
+        self.link(separate.outputs[1], self.principled.inputs['Roughness'])
+        self.link(separate.outputs[2], self.principled.inputs['Metallic'])
+        return texture.image, texture.image
+
+    def metallic_image(self):
+        texture = self.texture()
+        self.link(texture.outputs['Color'], self.principled.inputs['Metallic'])
+        return None, texture.image
+
+    def scalars(self):
+        inputs = self.principled.inputs
+        for name in ('Alpha', 'IOR', 'Transmission Weight'):
+            if name in inputs:
+                inputs[name].default_value = self.rng.random() + (1 if name == 'IOR' else 0)
+
+    def distractors(self, count):
+        """nodes that are not connected to the output, or only among themselves"""
+        nodes = [self.tree.nodes.new(self.rng.choice(DISTRACTOR_NODES)) for _ in range(count)]
+        unused = self.tree.nodes.new('ShaderNodeTexImage')
+        unused.image = self.rng.choice(self.images)
+        nodes.append(unused)
+        for a, b in zip(nodes, nodes[1:]):
+            if a.outputs and b.inputs and self.rng.random() < 0.5:
+                self.link(a.outputs[0], b.inputs[0])
+
+
+DIFFUSE = ('diffuse_color', 'diffuse_image', 'diffuse_mix_rgb', 'diffuse_mix_image', 'diffuse_mix_color')
+NORMAL = ('normal_map', 'no_normal_map')
+ORM = ('orm_values', 'orm_image', 'metallic_image')
+
+
+def create_materials(count, images, rng):
+    """materials and the maps their channels are expected to have"""
+    if not hasattr(bpy.types, 'ShaderNodeMixRGB'):
+        diffuse_patterns = tuple(p for p in DIFFUSE if p != 'diffuse_mix_rgb')
+    else:
+        diffuse_patterns = DIFFUSE
+
+    created = []
+    for n in range(count):
+        material = bpy.data.materials.new(f'bench_{n}')
+        if material.node_tree is None:
+            material.use_nodes = True
+        builder = MaterialBuilder(material, images, rng)
+        patterns = (rng.choice(diffuse_patterns), rng.choice(NORMAL), rng.choice(ORM))
+        diffuse = getattr(builder, patterns[0])()
+        normal = getattr(builder, patterns[1])()
+        roughness, metallic = getattr(builder, patterns[2])()
+        builder.scalars()
+        builder.distractors(rng.randrange(0, 12))
+        expected = {'diffuse': diffuse, 'normal': normal, 'roughness': roughness, 'metallic': metallic}
+        created.append((material, patterns, expected))
+    return created
+
+
+def stage(name, seconds, **rates):
+    print(f'{name:>10}: {seconds:8.3f}s  ' + '  '.join(f'{value:10.1f} {unit}' for unit, value in rates.items()))
+    return dict(seconds=seconds, **rates)
+
+
+def run(materials, images, sizes, seed, directory):
+    rng = random.Random(seed)
+    pool = create_images(images, sizes, np.random.default_rng(seed))
+    created = create_materials(materials, pool, rng)
+
+    # shader analysis
+    exports = [BlenderMaterialForExport(material) for material, _, _ in created]
+    start = time.perf_counter()
+    for m in exports:
+        m.pbr = PBR_ShaderData(m.material)
+    analyze_seconds = time.perf_counter() - start
+
+    patterns, unrecognized = Counter(), Counter()
+    for m, (_, material_patterns, expected) in zip(exports, created):
+        patterns.update(material_patterns)
+        for channel, image in expected.items():
+            if getattr(m.pbr, channel).map is not image:
+                unrecognized[f'{channel} of {", ".join(material_patterns)}'] += 1
+
+    # texture names, as the exporter gives them to channels and used texture nodes
+    names = TextureNameManager()
+    textures = {}
+    start = time.perf_counter()
+    for m in exports:
+        for channel in m.pbr.all_pbr_channels:
+            channel.map = names.validate_name(channel.map)
+        for node in m.used_tex_nodes:
+            textures[names.validate_name(node.image)] = node.image
+    names_seconds = time.perf_counter() - start
+
+    sink = DirectorySink(directory)
+    start = time.perf_counter()
+    for name, image in textures.items():
+        save_image(image, f'materials/{name}', sink)
+    save_seconds = time.perf_counter() - start
+    texture_bytes = sum(os.path.getsize(os.path.join(directory, 'materials', name)) for name in textures)
+    pixel_bytes = sum(image.size[0] * image.size[1] * 4 for image in textures.values())
+
+    csv = RoomleMaterialsCsv()
+    start = time.perf_counter()
+    for m in exports:
+        csv.add_material_definition(pbr_2_material_definition(m))
+    sink.write_text('materials/materials.csv', csv.to_text())
+    csv_seconds = time.perf_counter() - start
+
+    print(f'{materials} materials, {len(textures)} of {images} images used, {pixel_bytes / 2**20:.1f} MB of pixels')
+    return {
+        'blender': bpy.app.version_string,
+        'materials': materials,
+        'images': len(textures),
+        'texture_mb': texture_bytes / 2**20,
+        'pixel_mb': pixel_bytes / 2**20,
+        'patterns': dict(patterns),
+        'unrecognized': dict(unrecognized),
+        'stages': {
+            'analyze': stage('analyze', analyze_seconds, materials_per_second=materials / analyze_seconds),
+            'names': stage('names', names_seconds, materials_per_second=materials / names_seconds),
+            'save': stage('save', save_seconds, mb_per_second=texture_bytes / 2**20 / save_seconds, pixel_mb_per_second=pixel_bytes / 2**20 / save_seconds),
+            'csv': stage('csv', csv_seconds, materials_per_second=materials / csv_seconds),
+        },
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='bench_materials')
+    parser.add_argument('--materials', type=int, default=500)
+    parser.add_argument('--images', type=int, default=24)
+    parser.add_argument('--sizes', default='128,256,512,1024,2048', help='image edge lengths, used in turn')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write the results as JSON')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = run(args.materials, args.images, [int(s) for s in args.sizes.split(',')], args.seed, directory)
+
+    for setup, count in results['unrecognized'].items():
+        print(f'not recognized: {setup} ({count}x)')
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else [])
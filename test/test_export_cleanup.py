@@ -0,0 +1,90 @@
+import os
+import json
+import tempfile
+import subprocess
+
+from unittest import TestCase, main, skipUnless
+
+BLENDER = os.environ.get('BLENDER_BIN')
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+
+SCRIPT = '''
+import json, os, sys
+import bpy
+from mathutils import Matrix
+sys.path.insert(0, {root!r})
+from io_mesh_roomle.export_service import enable_addon
+enable_addon()
+from io_mesh_roomle import roomle_script
+
+# two vertex instancers, the copies of their instanced meshes are made on the first object
+for n, add in enumerate((bpy.ops.mesh.primitive_cube_add, bpy.ops.mesh.primitive_cone_add)):
+    bpy.ops.mesh.primitive_plane_add(location=(n * 3, 0, 0))
+    instancer = bpy.context.object
+    instancer.instance_type = 'VERTS'
+    add()
+    bpy.context.object.parent = instancer
+
+class Reporter:
+    def report(self, type, message):
+        print(message)
+
+rna = bpy.ops.export_mesh.roomle_script.get_rna_type()
+keywords = {{p.identifier: p.default for p in rna.properties if p.identifier != 'rna_type' and not getattr(p, 'is_array', False)}}
+keywords.update(filepath=os.path.join({directory!r}, 'cancelled.txt'), catalog_id='test_id', export_materials=False, background=False)
+preferences = bpy.context.preferences.addons['io_mesh_roomle'].preferences
+
+meshes = len(bpy.data.meshes)
+steps = roomle_script.iter_roomle_script(Reporter(), preferences, bpy.context, global_matrix=Matrix.Scale(1000, 4), **keywords)
+next(steps)
+steps.close()
+print('RESULT ' + json.dumps({{'before': meshes, 'after': len(bpy.data.meshes)}}))
+'''
+
+
+FAILING_SCRIPT = '''
+import json, os, sys
+import bpy
+sys.path.insert(0, {root!r})
+from io_mesh_roomle.export_service import enable_addon
+enable_addon()
+
+# nothing to export: the script phase fails
+bpy.ops.object.select_all(action='SELECT')
+bpy.ops.object.delete()
+filepath = os.path.join({directory!r}, 'empty.txt')
+try:
+    result = bpy.ops.export_mesh.roomle_script(filepath=filepath, catalog_id='test_id', export_materials=False, package_zip=True)
+    error = ''
+except RuntimeError as e:
+    result, error = None, str(e)
+print('RESULT ' + json.dumps({{'result': sorted(result or []), 'error': error, 'archive': os.path.exists(os.path.join({directory!r}, 'empty.zip'))}}))
+'''
+
+
+def run_blender(script, **format):
+    output = subprocess.run(
+        [BLENDER, '--background', '--factory-startup', '--python-expr', script.format(root=os.path.abspath(ROOT), **format)],
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(next(line[7:] for line in output.splitlines() if line.startswith('RESULT ')))
+
+
+@skipUnless(BLENDER and os.path.isfile(BLENDER), 'set BLENDER_BIN to a Blender executable')
+class ExportCleanupTests(TestCase):
+
+    def test_cancel_removes_instance_copies(self):
+        with tempfile.TemporaryDirectory() as directory:
+            result = run_blender(SCRIPT, directory=directory)
+        self.assertEqual(result['after'], result['before'])
+
+    def test_failure_removes_archive(self):
+        with tempfile.TemporaryDirectory() as directory:
+            result = run_blender(FAILING_SCRIPT, directory=directory)
+        # the operator reports the error instead of finishing
+        self.assertIn('Empty export', result['error'])
+        self.assertFalse(result['archive'])
+
+
+if __name__ == '__main__':
+    main()
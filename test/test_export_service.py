@@ -0,0 +1,38 @@
+import os
+import tempfile
+import importlib.util
+
+from unittest import TestCase, main, skipUnless
+
+# load the client directly, the package itself needs Blender
+_spec = importlib.util.spec_from_file_location(
+    'export_client',
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'io_mesh_roomle', 'export_client.py')
+)
+export_client = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(export_client)
+
+BLENDER = os.environ.get('BLENDER_BIN')
+
+
+@skipUnless(BLENDER and os.path.isfile(BLENDER), 'set BLENDER_BIN to a Blender executable')
+class ExportServiceTests(TestCase):
+
+    def test_jobs(self):
+        with tempfile.TemporaryDirectory() as directory, export_client.ExportClient.start(BLENDER) as client:
+            self.assertTrue(client.ping()['ok'])
+            for n in range(2):
+                # the default cube of the factory startup scene
+                filepath = os.path.join(directory, str(n), 'cube.txt')
+                result = client.export(None, filepath, catalog_id='test_id', export_materials=False)
+                self.assertTrue(result['ok'], result.get('traceback'))
+                self.assertIn(filepath, result['files'])
+                self.assertIn('Cube', [o['name'] for o in result['report']['objects']])
+
+            result = client.export(os.path.join(directory, 'missing.blend'), filepath)
+            self.assertFalse(result['ok'])
+            self.assertTrue(client.ping()['ok'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+import os
+import json
+import subprocess
+
+from unittest import TestCase, main, skipUnless
+
+BLENDER = os.environ.get('BLENDER_BIN')
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+
+# seconds importing and registering the addon may take in a fresh Blender
+REGISTER_BUDGET = float(os.environ.get('ROOMLE_REGISTER_BUDGET', '0.1'))
+
+# modules that are only imported by the first export
+HEAVY_MODULES = (
+    'io_mesh_roomle.roomle_script',
+    'io_mesh_roomle.material_exporter',
+    'io_mesh_roomle.blender_utils',
+    'io_mesh_roomle.mesh_stats',
+)
+
+SCRIPT = '''
+import json, sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import io_mesh_roomle
+io_mesh_roomle.register()
+seconds = time.perf_counter() - start
+print('RESULT ' + json.dumps({{'seconds': seconds, 'modules': sorted(sys.modules)}}))
+'''
+
+
+@skipUnless(BLENDER and os.path.isfile(BLENDER), 'set BLENDER_BIN to a Blender executable')
+class ImportTimeTests(TestCase):
+
+    def test_register_budget(self):
+        output = subprocess.run(
+            [BLENDER, '--background', '--factory-startup', '--python-expr', SCRIPT.format(root=os.path.abspath(ROOT))],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        result = json.loads(next(line[7:] for line in output.splitlines() if line.startswith('RESULT ')))
+
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, result['modules'])
+        self.assertLess(result['seconds'], REGISTER_BUDGET)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import os
+import importlib.util
+
+import numpy as np
+
+from unittest import TestCase, main
+
+# load the encoder directly, the package itself needs Blender
+_spec = importlib.util.spec_from_file_location(
+    'mesh_encoder',
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'io_mesh_roomle', 'mesh_encoder.py')
+)
+mesh_encoder = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(mesh_encoder)
+
+PARAMS = {
+    'comment': '',
+    'matrix': np.diag([1000.0, 1000.0, 1000.0, 1.0]).tolist(),
+    'normal_linear': np.eye(3).tolist(),
+    'precision': 1,
+    'tolerance': None,
+    'uv_float_precision': 4,
+    'normal_float_precision': 5,
+    'export_normals': True,
+    'elide_normals': False,
+    'normal_tolerance': 1.0,
+}
+
+
+def quad(job):
+    positions = job.array((4, 3), np.float32)
+    positions[:] = [(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0)]
+    normals = job.array((4, 3), np.float32)
+    normals[:] = (0, 0, 1)
+    job.share('positions', positions)
+    job.share('normals', normals)
+    job.share('sources', np.arange(4, dtype=np.int32))
+    job.share('indices', np.array([[0, 1, 2], [0, 2, 3]], dtype=np.int32))
+    return job
+
+
+class MeshEncoderTests(TestCase):
+
+    def test_format_floats(self):
+        self.assertEqual(mesh_encoder.format_floats(np.array([1.25, -0.01, 100.0, 0.1]), 1), ['1.2', '0', '100', '0.1'])
+        self.assertEqual(mesh_encoder.format_floats(np.array([12.5]), 0), ['12'])
+
+    def test_encode(self):
+        job = quad(mesh_encoder.EncodeJob())
+        try:
+            data, decisions = mesh_encoder.encode_add_mesh(job.arrays(), PARAMS)
+        finally:
+            job.release()
+        self.assertEqual(
+            data.decode(),
+            'AddMesh(Vector3f[{0,0,0},{1000,0,0},{1000,1000,0},{0,1000,0}],[0,2,1,0,3,2]'
+            ',Vector3f[{0,0,-1},{0,0,-1},{0,0,-1},{0,0,-1}]);\n'
+        )
+        self.assertEqual(decisions['normals'], 'EXPORTED')
+
+    def test_elide_and_precision(self):
+        params = dict(PARAMS, elide_normals=True, tolerance=1.0)
+        job = quad(mesh_encoder.EncodeJob())
+        try:
+            data, decisions = mesh_encoder.encode_add_mesh(job.arrays(), params)
+        finally:
+            job.release()
+        self.assertEqual(decisions['normals'], 'ELIDED')
+        self.assertEqual(decisions['precision'], 0)
+        self.assertNotIn(b'{0,0,-1}', data)
+
+    def test_bake_normals(self):
+        # 90 degrees around x, baked into the positions by `matrix` and into the normals here
+        linear = np.array([[1.0, 0, 0], [0, 0, -1], [0, 1, 0]])
+        matrix = np.identity(4)
+        matrix[:3, :3] = linear
+        params = dict(PARAMS, matrix=matrix.tolist(), normal_linear=linear.tolist(), bake_normals=True)
+        job = quad(mesh_encoder.EncodeJob())
+        try:
+            data, _ = mesh_encoder.encode_add_mesh(job.arrays(), params)
+            _, decisions = mesh_encoder.encode_add_mesh(job.arrays(), dict(params, elide_normals=True))
+        finally:
+            job.release()
+        self.assertIn(b',Vector3f[{0,1,0},{0,1,0},{0,1,0},{0,1,0}]', data)
+        self.assertEqual(decisions['normals'], 'ELIDED')
+
+    def test_workers_keep_order(self):
+        with mesh_encoder.ParallelEncoder(workers=2) as encoder:
+            decided = []
+            placeholders = [
+                encoder.submit(quad(mesh_encoder.EncodeJob()), dict(PARAMS, comment=f'/*{n}*/'), decided.append)
+                for n in range(5)
+            ]
+            script = encoder.stitch('\n'.join(placeholders))
+        self.assertEqual([line[:5] for line in script.split('\n') if line], [f'/*{n}*/' for n in range(5)])
+        self.assertEqual(len(decided), 5)
+
+
+if __name__ == '__main__':
+    main()
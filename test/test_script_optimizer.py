@@ -0,0 +1,101 @@
+import os
+import importlib.util
+
+from unittest import TestCase, main
+
+# load the modules directly, the package itself needs Blender
+_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'io_mesh_roomle')
+
+
+def _load(name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(_directory, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+script_parser = _load('script_parser')
+script_optimizer = _load('script_optimizer')
+
+SCRIPT = """/* Roomle script */
+BeginObjGroup('Chair_Base_With_A_Long_Name');
+/* Object:Seat Mesh:Seat */
+AddMesh(Vector3f[{-100,-100,0},{100,-100,0},{100,100,0},{-100,100,0}],[0,1,2,0,2,3]);
+SetObjSurface('c:red');
+RotateMatrixBy(Vector3f{1,0,0},Vector3f{0,0,0},30);
+RotateMatrixBy(Vector3f{0,1,0},Vector3f{0,0,0},-45.5);
+RotateMatrixBy(Vector3f{0,0,1},Vector3f{0,0,0},12.25);
+MoveMatrixBy(Vector3f{10.5,0,0});
+BeginObjGroup('Empty');
+EndObjGroup();
+MoveMatrixBy(Vector3f{0,0,0});
+EndObjGroup();
+MoveMatrixBy(Vector3f{0,0,100});
+AddExternalMesh('c:leg',Vector3f{10,10,400},Vector3f{0,0,200});
+ScaleMatrixBy(Vector3f{1,1,1});
+MoveMatrixBy(Vector3f{1,0,0});
+MoveMatrixBy(Vector3f{2,0.5,0});
+"""
+
+
+class ScriptOptimizerTests(TestCase):
+
+    def test_same_scene(self):
+        optimized = script_optimizer.optimize_script(SCRIPT, tolerance=0.01)
+        parsed = script_parser.parse_script(optimized.script)
+        self.assertEqual(parsed.errors, [])
+        self.assertEqual(script_parser.compare_scenes(script_parser.parse_script(SCRIPT), parsed, tolerance=0.01), [])
+
+        self.assertNotIn('/*', optimized.script)
+        self.assertEqual(optimized.groups, {'0': 'Chair_Base_With_A_Long_Name'})
+        self.assertEqual(optimized.stats.comments, 2)
+        # three rotations merged into one, identities dropped, moves summed
+        self.assertEqual(optimized.stats.transforms_after, 4)
+        self.assertIn('MoveMatrixBy(Vector3f{3,0.5,0})', optimized.script)
+        self.assertLess(optimized.stats.characters_after, optimized.stats.characters_before)
+
+    def test_shear_is_kept(self):
+        # a non-uniform scale after a rotation can not be written as one scale and rotation
+        script = (
+            "AddExternalMesh('c:x',Vector3f{1,1,1},Vector3f{0,0,0});"
+            "RotateMatrixBy(Vector3f{0,0,1},Vector3f{0,0,0},30);"
+            "ScaleMatrixBy(Vector3f{2,1,1});"
+        )
+        optimized = script_optimizer.optimize_script(script)
+        self.assertEqual(optimized.stats.transforms_after, 2)
+        self.assertEqual(
+            script_parser.compare_scenes(script_parser.parse_script(script), script_parser.parse_script(optimized.script)),
+            [],
+        )
+
+    def test_flatten(self):
+        # CAD style chain of empties with one child each, the inner group is marked as meaningful
+        script = ''
+        for level in range(12):
+            script += f"BeginObjGroup('Empty_{level}');"
+        script += "BeginObjGroup('Door');"
+        script += "AddExternalMesh('c:door',Vector3f{10,10,400},Vector3f{0,0,0});RotateMatrixBy(Vector3f{0,0,1},Vector3f{0,0,0},90);"
+        script += "AddExternalMesh('c:knob',Vector3f{1,1,1},Vector3f{0,0,0});MoveMatrixBy(Vector3f{5,0,0});"
+        script += "EndObjGroup();MoveMatrixBy(Vector3f{0,3,0});"
+        for level in reversed(range(12)):
+            script += f"EndObjGroup();ScaleMatrixBy(Vector3f{{1,{level % 3 + 1},1}});RotateMatrixBy(Vector3f{{1,0,0}},Vector3f{{0,0,0}},{level * 7});MoveMatrixBy(Vector3f{{{level},0,0}});"
+
+        optimized = script_optimizer.optimize_script(script, flatten_groups=True, keep=['Door'])
+        self.assertEqual(
+            script_parser.compare_scenes(script_parser.parse_script(script), script_parser.parse_script(optimized.script), tolerance=0.01),
+            [],
+        )
+        self.assertIn("BeginObjGroup('Door')", optimized.script)
+        # one group carries the composed transforms of the chain, the kept group keeps its own
+        self.assertEqual(optimized.groups, {'0': 'Empty_11'})
+        self.assertEqual(optimized.stats.groups_flattened, 11)
+        self.assertEqual((optimized.stats.groups_before, optimized.stats.groups_after), (13, 2))
+        self.assertEqual((optimized.stats.depth_before, optimized.stats.depth_after), (13, 2))
+
+    def test_placeholders(self):
+        script = "/*@fragment 0*/SetObjSurface('c:x');\nMoveMatrixBy(Vector3f{1,0,0});\n"
+        self.assertEqual(script_optimizer.optimize_script(script).script, script)
+
+
+if __name__ == '__main__':
+    main()
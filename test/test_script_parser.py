@@ -0,0 +1,89 @@
+import io
+import os
+import importlib.util
+
+from unittest import TestCase, main
+
+# load the parser directly, the package itself needs Blender
+_spec = importlib.util.spec_from_file_location(
+    'script_parser',
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'io_mesh_roomle', 'script_parser.py')
+)
+script_parser = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(script_parser)
+
+SCRIPT = """/* exported by test */
+BeginObjGroup('Plane');
+AddMesh(Vector3f[{-1,-1,0},{1,-1,0},{1,1,0},{-1,1,0}],[0,1,2,0,2,3],Vector2f[{0,0},{1,0},{1,1},{0,1}]);
+SetObjSurface('test_id:red'); // a comment; with a semicolon
+RotateMatrixBy(Vector3f{0,0,1},Vector3f{0,0,0},90);
+MoveMatrixBy(Vector3f{10,0,0});
+EndObjGroup();
+AddExternalMesh('test_id:chair',Vector3f{100,200,300},Vector3f{-50,-100,0});
+MoveMatrixBy(Vector3f{0,0,5});
+"""
+
+
+class ScriptParserTests(TestCase):
+
+    def test_parse(self):
+        parsed = script_parser.parse_script(SCRIPT)
+        self.assertEqual(parsed.errors, [])
+        stats = parsed.stats
+        self.assertEqual(stats.commands['AddMesh'], 1)
+        self.assertEqual(stats.commands['MoveMatrixBy'], 2)
+        self.assertEqual(stats.comments, 2)
+        self.assertEqual((stats.vertices, stats.triangles), (4, 2))
+
+        group, mesh, external = [node for node, depth in parsed.iter_nodes()]
+        self.assertEqual(group.name, 'Plane')
+        self.assertEqual(mesh.surface, 'test_id:red')
+        self.assertEqual(len(mesh.mesh.uvs), 8)
+        self.assertEqual(external.bounds, ((100.0, 200.0, 300.0), (-50.0, -100.0, 0.0)))
+
+    def test_chunked_reading(self):
+        # tiny chunks split strings, comments and numbers
+        whole = script_parser.parse_script(SCRIPT)
+        chunked = script_parser.parse_script(io.StringIO(SCRIPT), chunk_size=3)
+        self.assertEqual(chunked.errors, [])
+        self.assertEqual(script_parser.compare_scenes(whole, chunked), [])
+
+    def test_flatten(self):
+        flat = script_parser.parse_script(SCRIPT).flatten()
+        # (1,-1,0) rotated by 90 degrees around z, then moved by 10 in x
+        x, y, z = flat[0].positions[3:6]
+        self.assertAlmostEqual(x, 11)
+        self.assertAlmostEqual(y, 1)
+        self.assertEqual(flat[1].matrix[2][3], 5)
+
+    def test_scale(self):
+        parsed = script_parser.parse_script(
+            "AddExternalMesh('x:y',Vector3f{1,1,1},Vector3f{0,0,0});"
+            "MoveMatrixBy(Vector3f{1,0,0});ScaleMatrixBy(Vector3f{2,2,2});"
+        )
+        self.assertEqual(parsed.errors, [])
+        self.assertEqual(parsed.flatten()[0].matrix[0][3], 2)
+
+    def test_compare(self):
+        moved = script_parser.parse_script(SCRIPT.replace('{10,0,0}', '{10,0,0.01}'))
+        original = script_parser.parse_script(SCRIPT)
+        self.assertEqual(script_parser.compare_scenes(original, moved, tolerance=0.05), [])
+        self.assertEqual(len(script_parser.compare_scenes(original, moved, tolerance=0.001)), 1)
+
+    def test_invariants(self):
+        broken = script_parser.parse_script(
+            "BeginObjGroup('a');"
+            "AddMesh(Vector3f[{0,0,0},{1,0,0},{0,1,0}],[0,1,3,0],Vector2f[{0,0}]);"
+            "EndObjGroup();EndObjGroup();"
+            "SetObjSurface('x:y');"
+            "BeginObjGroup('b');"
+        )
+        self.assertEqual(len(broken.errors), 6, broken.errors)
+
+    def test_syntax_error(self):
+        parsed = script_parser.parse_script("AddExternalMesh('x:y',Vector3f{1,2},Vector3f{0,0,0});")
+        self.assertFalse(parsed.valid)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import os
+import json
+import subprocess
+
+from unittest import TestCase, main, skipUnless
+
+BLENDER = os.environ.get('BLENDER_BIN')
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+
+SCRIPT = '''
+import json, sys
+import bpy
+sys.path.insert(0, {root!r})
+from io_mesh_roomle.material_exporter import BlenderMaterialForExport
+from io_mesh_roomle.material_exporter._atlas import build_atlases
+from io_mesh_roomle.material_exporter.socket_analyzer import PBR_ShaderData
+
+exports = []
+for n in range(2):
+    # plane UVs are within 0...1, image nodes keep their default REPEAT extension
+    bpy.ops.mesh.primitive_plane_add(location=(n * 3, 0, 0))
+    material = bpy.data.materials.new(f'label_{{n}}')
+    material.use_nodes = True
+    tree = material.node_tree
+    principled = next(node for node in tree.nodes if node.type == 'BSDF_PRINCIPLED')
+    texture = tree.nodes.new('ShaderNodeTexImage')
+    texture.image = bpy.data.images.new(f'label_{{n}}', 64, 32)
+    tree.links.new(texture.outputs['Color'], principled.inputs[0])
+    if n:
+        # the usual glTF import setup with an identity mapping
+        coordinates = tree.nodes.new('ShaderNodeTexCoord')
+        mapping = tree.nodes.new('ShaderNodeMapping')
+        tree.links.new(coordinates.outputs['UV'], mapping.inputs['Vector'])
+        tree.links.new(mapping.outputs['Vector'], texture.inputs['Vector'])
+    bpy.context.object.data.materials.append(material)
+    export = BlenderMaterialForExport(material)
+    export.pbr = PBR_ShaderData(material)
+    exports.append(export)
+
+atlases = build_atlases(exports, [obj for obj in bpy.context.scene.objects if obj.type == 'MESH'], 256)
+print('RESULT ' + json.dumps(sorted(material.name for material in atlases)))
+'''
+
+
+@skipUnless(BLENDER and os.path.isfile(BLENDER), 'set BLENDER_BIN to a Blender executable')
+class TextureAtlasTests(TestCase):
+
+    def test_repeat_images_with_unit_uvs_are_packed(self):
+        output = subprocess.run(
+            [BLENDER, '--background', '--factory-startup', '--python-expr', SCRIPT.format(root=os.path.abspath(ROOT))],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        packed = json.loads(next(line[7:] for line in output.splitlines() if line.startswith('RESULT ')))
+        self.assertEqual(packed, ['label_0', 'label_1'])
+
+
+if __name__ == '__main__':
+    main()
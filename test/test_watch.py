@@ -0,0 +1,141 @@
+import os
+import json
+import tempfile
+import subprocess
+
+from unittest import TestCase, main, skipUnless
+
+BLENDER = os.environ.get('BLENDER_BIN')
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+# seconds a one-object update of the 500 object scene may take
+BUDGET = float(os.environ.get('ROOMLE_WATCH_BUDGET', '1.0'))
+
+SCRIPT = '''
+import json, os, sys
+import bpy
+sys.path.insert(0, {root!r})
+from io_mesh_roomle.export_service import enable_addon
+enable_addon()
+from io_mesh_roomle import watch
+
+bpy.ops.object.select_all(action='SELECT')
+bpy.ops.object.delete()
+bpy.ops.mesh.primitive_cube_add()
+base = bpy.context.object
+objects = []
+for n in range(500):
+    obj = base.copy()
+    obj.name = f'Cube_{{n:03}}'
+    obj.data = base.data.copy()
+    obj.location = (n % 25 * 3, n // 25 * 3, 0)
+    bpy.context.collection.objects.link(obj)
+    objects.append(obj)
+bpy.data.objects.remove(base)
+# two objects with one mesh
+objects[1].data = objects[0].data
+objects[0].data.name = 'Shared'
+
+# identical materials, merged by the full export
+for name, obj in (('Wood', objects[2]), ('Wood.001', objects[3])):
+    material = bpy.data.materials.new(name)
+    material.use_nodes = True
+    obj.data.materials.append(material)
+
+filepath = os.path.join({directory!r}, 'watch.txt')
+bpy.ops.export_mesh.roomle_script(filepath=filepath, catalog_id='test_id', export_materials=True, watch=True, background=False)
+watcher = watch.watcher
+result = {{'aliases': dict(watcher.keywords['material_aliases'])}}
+
+def update():
+    seconds = watcher.update()
+    return {{'hits': watcher.cache.hits, 'misses': watcher.cache.misses, 'seconds': seconds}}
+
+def script():
+    with open(filepath) as file:
+        return file.read()
+
+result['first'] = update()
+
+# what the depsgraph handler records for a geometry edit
+objects[7].data.vertices[0].co.x += 0.1
+watcher.dirty_objects.add(objects[7].name)
+result['geometry'] = update()
+
+watcher.dirty_meshes.add('Shared')
+result['changed'] = sorted(watcher.changed_objects(bpy.context.scene))
+result['mesh'] = update()
+
+objects[5].data.materials.append(bpy.data.materials['Wood'])
+result['slot'] = update()
+
+objects[9].location.z += 1
+result['move'] = update()
+
+# an edited duplicate gets its own row and id
+principled = next(node for node in bpy.data.materials['Wood.001'].node_tree.nodes if node.type == 'BSDF_PRINCIPLED')
+principled.inputs[0].default_value = (0.8, 0.1, 0.1, 1)
+watcher.dirty_materials.add('Wood.001')
+result['material'] = update()
+result['surfaces'] = sorted({{line for line in script().splitlines() if line.startswith('SetObjSurface')}})
+result['after_material'] = dict(watcher.keywords['material_aliases'])
+with open(os.path.join({directory!r}, 'materials', 'materials.csv')) as file:
+    result['csv'] = file.read()
+
+watcher.keywords['bake_transforms'] = True
+result['bake_first'] = update()
+objects[9].location.z += 1
+result['bake_move'] = update()
+
+result['atlas'] = watcher.start(dict(watcher.keywords, export_materials=True, texture_atlas=True), watcher.global_matrix)
+print('RESULT ' + json.dumps(result))
+'''
+
+
+@skipUnless(BLENDER and os.path.isfile(BLENDER), 'set BLENDER_BIN to a Blender executable')
+class WatchTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with tempfile.TemporaryDirectory() as directory:
+            output = subprocess.run(
+                [BLENDER, '--background', '--factory-startup', '--python-expr', SCRIPT.format(root=os.path.abspath(ROOT), directory=directory)],
+                capture_output=True, text=True, check=True,
+            ).stdout
+        cls.result = json.loads(next(line[7:] for line in output.splitlines() if line.startswith('RESULT ')))
+
+    def test_first_update_fills_cache(self):
+        self.assertEqual(self.result['first']['hits'], 0)
+        self.assertEqual(self.result['first']['misses'], 500)
+
+    def test_geometry_change(self):
+        update = self.result['geometry']
+        self.assertEqual((update['hits'], update['misses']), (499, 1))
+        self.assertLess(update['seconds'], BUDGET)
+
+    def test_shared_mesh_change(self):
+        self.assertEqual(self.result['changed'], ['Cube_000', 'Cube_001'])
+        self.assertEqual(self.result['mesh']['hits'], 498)
+
+    def test_material_slot_change(self):
+        self.assertEqual(self.result['slot']['hits'], 499)
+
+    def test_transforms(self):
+        # transforms are written fresh, baked ones are part of the mesh
+        self.assertEqual(self.result['move']['hits'], 500)
+        self.assertEqual(self.result['bake_first']['hits'], 0)
+        self.assertEqual(self.result['bake_move']['hits'], 499)
+
+    def test_merged_material_change(self):
+        self.assertEqual(self.result['aliases'], {'Wood001': 'Wood'})
+        self.assertEqual(self.result['after_material'], {})
+        self.assertIn("SetObjSurface('test_id:Wood001');", self.result['surfaces'])
+        self.assertIn('Wood001', self.result['csv'])
+        # the object using it was exported again for its new id
+        self.assertEqual(self.result['material']['hits'], 499)
+
+    def test_atlas_refused(self):
+        self.assertIn('Texture Atlas', self.result['atlas'])
+
+
+if __name__ == '__main__':
+    main()